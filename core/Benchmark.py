@@ -0,0 +1,494 @@
+import argparse
+import csv
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# Stand-in jetson modules must be registered before any manager imports them.
+from utils import FakeJetson
+FakeJetson.Install()
+
+from utils.Detectors import JetsonDetector, DnnDetector
+from utils.FakeServo import FakeServoController
+from utils.Fixtures import SyntheticVideo
+from utils.FrameGovernor import FrameGovernor, Mode
+from utils.ImageSources import ImageSource, LocalVideo, ReplaySource
+from utils.MessageBus import MessageBus
+from utils.PerceptionUtils import BoundingBox, IoUMatrix
+from utils.Profiler import PROFILER
+from utils.SessionRecorder import TRACK
+from CameraMan import CameraMan
+from MotorMan import MotorMan
+from PerceptionMan import PerceptionMan
+from PipelineMan import PipelineMan
+from StorageMan import StorageMan
+
+# Resolution of the synthetic sequence for --high-res (the CSI camera's 16:9 full resolution mode).
+HIGH_RES = (3264, 1848)
+
+
+def LoadGroundTruth(path):
+    """
+    Loads ground truth boxes from a CSV file with frame,left,top,right,bottom rows.
+    :return: Dictionary mapping frame indices to (left, top, right, bottom).
+    """
+    groundTruth = {}
+    with open(path) as f:
+        for row in csv.reader(f):
+            if row and row[0].strip().isdigit():
+                groundTruth[int(row[0])] = tuple(float(v) for v in row[1:5])
+    return groundTruth
+
+
+def LoadSessionTrack(source):
+    """
+    Loads the boxes the tracker found while a session was recorded (see SessionRecorder), as a reference
+    to compare a replay of it against.
+    :param source: ReplaySource of the session.
+    :return: (first frame to replay, function mapping replayed frame indices to recorded (left, top, right, bottom) boxes).
+    """
+    track = {}
+    for index in range(len(source)):
+        for _, _, telemetry in source.Records(index, TRACK):
+            if telemetry.success:
+                track[index] = telemetry.bbox.topLeft + telemetry.bbox.bottomRight
+
+    # Start on the frame the tracker was initialized on, the one before the first tracked frame.
+    start = max(min(track) - 1, 0) if track else 0
+    return start, lambda index: track.get(index + start)
+
+
+def RunBenchmark(cam, per, mot, sto, numFrames, groundTruth=None, governor=None):
+    """
+    Drives the same capture -> track -> motor -> store loop as SystemMan.Launch.
+    Stage latencies are collected by the managers' instrumentation (see Profiler).
+    :param groundTruth: Function mapping a frame index to its (left, top, right, bottom) box, if known.
+    :param governor: FrameGovernor deciding which frames are tracked, if any (every frame is tracked otherwise).
+    :return: Dictionary of results (see main for the layout).
+    """
+    frame, width, height, _, _ = cam.Capture()
+    frameIndex = 0
+
+    # Pick the target like the "Start" flow does (the user picking the detection on the target when ground
+    # truth is known), falling back on ground truth if detection misses it.
+    detections, _ = per.DetectObjects(per.PrepareFrame(cam.HighResFrame()), width, height)
+    truthBbox = BoundingBox(*groundTruth(0)) if groundTruth is not None and groundTruth(0) is not None else None
+    initialBbox = per.FindClassInDetections(detections, classID=1, lastBbox=truthBbox)
+    if initialBbox is None and groundTruth is not None:
+        initialBbox = BoundingBox(*groundTruth(0))
+    if initialBbox is None:
+        raise Exception('Could not find a target to track in the first frame')
+    per.InitTracker(frame, initialBbox)
+
+    failures = 0
+    ious = []
+    centerErrors = []
+    processed = 0
+    droppedFrames = 0
+    PROFILER.Reset()
+    start = time.monotonic()
+
+    while processed < numFrames:
+        frameStart = time.monotonic()
+        try:
+            frame, width, height, captureTime, droppedFrames = cam.Capture()
+        except Exception:
+            # End of the clip.
+            break
+
+        # Index into the source's sequence, accounting for frames dropped by threaded capture.
+        frameIndex = processed + 1 + droppedFrames
+
+        mode = governor.Decide(captureTime) if governor is not None else Mode.TRACK
+        if mode == Mode.TRACK and per.TargetStatic(frame):
+            mode = Mode.HOLD
+            if governor is not None:
+                governor.Downgrade(mode)
+
+        if mode == Mode.HOLD:
+            success, opticalFlow, newBbox = per.HoldObjectInNewFrame(frame)
+        elif mode == Mode.TRACK:
+            success, opticalFlow, newBbox = per.TrackObjectInNewFrame(frame)
+            if success and per.ResetDue():
+                per.RequestReset(frame, width, height, classID=1, detectionFrame=cam.HighResFrame())
+        else:
+            success, opticalFlow, newBbox = per.PredictObjectInNewFrame()
+
+        if success:
+            mot.ProcessOpticalFlowCommand(opticalFlow, newBbox, captureTime)
+            PROFILER.EndTrace("glass_to_motor")
+        else:
+            failures += 1
+            per.RequestReset(frame, width, height, classID=1, detectionFrame=cam.HighResFrame())
+
+        if sto is not None:
+            sto.AppendFrame(frame, width, height)
+        if governor is not None:
+            governor.Finish(captureTime)
+        PROFILER.Record("frame", time.monotonic() - frameStart)
+
+        if groundTruth is not None:
+            truth = groundTruth(frameIndex)
+            if truth is not None:
+                ious.append(float(IoUMatrix([newBbox.topLeft + newBbox.bottomRight], [truth])[0, 0]))
+                centerErrors.append(np.hypot(newBbox.center[0] - (truth[0] + truth[2]) / 2,
+                                             newBbox.center[1] - (truth[1] + truth[3]) / 2))
+
+        processed += 1
+
+    elapsed = time.monotonic() - start
+    ious = np.array(ious)
+    centerErrors = np.array(centerErrors)
+
+    return {
+        "frames": processed,
+        "fps": round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+        "droppedFrames": droppedFrames,
+        "governor": governor.Stats() if governor is not None else None,
+        "motionGate": per.motionGate.Stats() if per.motionGate is not None else None,
+        "trackingFailures": failures,
+        "resets": per.resetScheduler.Stats(),
+        # Mapped RGBA buffers allocated and frames converted for detection (at most one conversion per detection).
+        "rgbaPool": ImageSource.rgbaPool.Stats(),
+        "stages": PROFILER.Snapshot()["stages"],
+        "iou": {
+            "frames": len(ious),
+            "mean": round(float(ious.mean()), 4) if len(ious) else None,
+            "p10": round(float(np.percentile(ious, 10)), 4) if len(ious) else None,
+            "over50": round(float((ious > 0.5).mean()), 4) if len(ious) else None,
+        },
+        # Distance (pixels) between tracked and true box centers.
+        "centerError": {
+            "mean": round(float(centerErrors.mean()), 3) if len(centerErrors) else None,
+            "p90": round(float(np.percentile(centerErrors, 90)), 3) if len(centerErrors) else None,
+        },
+    }
+
+
+def RunPipelineBenchmark(pipeline, numFrames, groundTruth=None, timeout=120):
+    """
+    Runs the multi-process pipeline (see PipelineMan) until it has tracked numFrames frames
+    or its source runs out.
+    :param groundTruth: Function mapping a frame index to its (left, top, right, bottom) box, if known.
+    :return: Dictionary of results, with per-process statistics under "processes".
+    """
+    pipeline.Launch()
+    pipeline.SelectTarget(classID=1)
+
+    processed = 0
+    failures = 0
+    ious = []
+    start = None
+    deadline = time.monotonic() + timeout
+
+    while processed < numFrames and pipeline.Running() and time.monotonic() < deadline:
+        for seq, _, success, box, _ in pipeline.Results(timeout=0.1):
+            # Throughput is measured from the first tracked frame (process startup is excluded).
+            if start is None:
+                start = time.monotonic()
+
+            processed += 1
+            failures += not success
+
+            truth = groundTruth(seq - 1) if groundTruth is not None else None
+            if truth is not None:
+                ious.append(float(IoUMatrix([box], [truth])[0, 0]))
+
+    elapsed = time.monotonic() - start if start is not None else 0.0
+    processStats = pipeline.Shutdown()
+    ious = np.array(ious)
+
+    return {
+        "frames": processed,
+        "fps": round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+        "trackingFailures": failures,
+        "processes": processStats,
+        "iou": {
+            "frames": len(ious),
+            "mean": round(float(ious.mean()), 4) if len(ious) else None,
+            "p10": round(float(np.percentile(ious, 10)), 4) if len(ious) else None,
+            "over50": round(float((ious > 0.5).mean()), 4) if len(ious) else None,
+        },
+    }
+
+
+def RunMultiTargetBenchmark(makeSource, per, numFrames, workerCounts):
+    """
+    Measures the multi-target tracker's per-frame cost against the number of threads its tracker updates
+    are spread across (see MultiTargetTracker), on the same sequence for every thread count.
+    :param makeSource: Function returning a new image source, positioned on the sequence's first frame.
+    :param workerCounts: Numbers of threads to measure.
+    :return: Dictionary of results, per number of threads under "workers".
+    """
+    results = {"cores": os.cpu_count(), "workers": {}}
+
+    for workers in workerCounts:
+        source = makeSource()
+        frame, width, height = source.GetFrame()
+
+        # Every person found in the first frame becomes a target.
+        detections, _ = per.DetectObjects(per.PrepareFrame(frame), width, height)
+        bboxes = [BoundingBox(d.Left, d.Top, d.Right, d.Bottom) for d in detections if d.ClassID == 1]
+        per.InitMultiTracker(frame, bboxes, maxWorkers=workers)
+
+        costs = []
+        tracks = {}
+        for _ in range(numFrames):
+            try:
+                frame, _, _ = source.GetFrame()
+            except Exception:
+                # End of the clip.
+                break
+
+            start = time.monotonic()
+            tracks, _ = per.TrackTargetsInNewFrame(frame)
+            costs.append(time.monotonic() - start)
+
+        source.Close()
+        costs = np.array(costs) * 1000
+        results["workers"][workers] = {
+            "targets": len(bboxes),
+            "tracked": sum(success for success, _ in tracks.values()),
+            "frameMs": {
+                "mean": round(float(costs.mean()), 3) if len(costs) else None,
+                "p90": round(float(np.percentile(costs, 90)), 3) if len(costs) else None,
+            },
+        }
+
+    return results
+
+
+def scaledToTracking(frameSize, trackingSize, groundTruth):
+    """
+    Maps a source's ground truth boxes to its downscaled tracking stream (--high-res).
+    :return: groundTruth function in tracking stream coordinates (None if there is no ground truth).
+    """
+    scaleX, scaleY = trackingSize[0] / frameSize[0], trackingSize[1] / frameSize[1]
+
+    def scaledTruth(index):
+        box = groundTruth(index)
+        return None if box is None else (box[0] * scaleX, box[1] * scaleY, box[2] * scaleX, box[3] * scaleY)
+
+    return scaledTruth if groundTruth is not None else None
+
+
+def makePerception(detectLatency, model=None, config=None, pyramid=False, appearance=False, tiled=False,
+                   motionGating=False):
+    """
+    Builds the benchmark's PerceptionMan (in the perception process for --processes).
+    """
+    options = dict(pyramidTracking=pyramid, appearanceMatching=appearance, tiledDetection=tiled,
+                   motionGating=motionGating)
+    if model is not None:
+        return PerceptionMan(detector=DnnDetector(model, config), **options)
+
+    FakeJetson.FakeDetectNet.DETECT_SECONDS = detectLatency
+    return PerceptionMan(detector=JetsonDetector(), **options)
+
+
+def runPipelineMode(args):
+    if args.session is not None:
+        probe = ReplaySource(args.session)
+        start, groundTruth = LoadSessionTrack(probe)
+        frameShape = probe.GetFrame()[0].shape
+        probe.Close()
+        sourceFactory = functools.partial(ReplaySource, args.session, realtime=args.realtime, start=start)
+    elif args.video is not None:
+        sourceFactory = functools.partial(LocalVideo, args.video, realtime=args.realtime)
+        truths = LoadGroundTruth(args.ground_truth) if args.ground_truth else None
+        groundTruth = truths.get if truths is not None else None
+        probe = LocalVideo(args.video)
+        frameShape = probe.GetFrame()[0].shape
+        probe.Close()
+    else:
+        synthetic = dict(numFrames=args.frames + 1, targetSize=tuple(args.target_size), speed=args.speed,
+                         fps=60 if args.realtime else None, pan=args.pan, distractors=args.distractors,
+                         pauses=args.pauses, noise=args.noise)
+        sourceFactory = functools.partial(SyntheticVideo, **synthetic)
+        groundTruth = SyntheticVideo(**synthetic).GroundTruth
+        frameShape = (720, 1280, 3)
+
+    outputPath = None if args.no_store else os.path.join(tempfile.mkdtemp(prefix="inframe_bench_"), "bench.mp4")
+    pipeline = PipelineMan(sourceFactory=sourceFactory,
+                           perceptionFactory=functools.partial(makePerception, args.detect_latency, args.model, args.config,
+                                                               args.pyramid, args.appearance),
+                           outputPath=outputPath, frameShape=frameShape, profile=True)
+
+    return RunPipelineBenchmark(pipeline, args.frames, groundTruth)
+
+
+def runMultiTargetMode(args):
+    # The target and its distractors are all tracked.
+    makeSource = functools.partial(SyntheticVideo, numFrames=args.frames + 1, targetSize=tuple(args.target_size),
+                                   speed=args.speed, pan=args.pan, distractors=args.multi_target - 1,
+                                   pauses=args.pauses, noise=args.noise, colorFormat='BGRx' if args.bgrx else 'BGR')
+    workerCounts = args.workers or sorted({1, 2, 4, os.cpu_count() or 1})
+
+    per = makePerception(args.detect_latency, args.model, args.config)
+    try:
+        return RunMultiTargetBenchmark(makeSource, per, args.frames, workerCounts)
+    finally:
+        per.Release()
+
+
+def runSingleProcessMode(args):
+    if args.session is not None:
+        source = ReplaySource(args.session, realtime=args.realtime)
+        start, groundTruth = LoadSessionTrack(source)
+        source.Seek(start)
+    elif args.video is not None:
+        source = LocalVideo(args.video, realtime=args.realtime)
+        truths = LoadGroundTruth(args.ground_truth) if args.ground_truth else None
+        groundTruth = truths.get if truths is not None else None
+    else:
+        source = SyntheticVideo(numFrames=args.frames + 1, res=HIGH_RES if args.high_res else (1280, 720),
+                                targetSize=tuple(args.target_size), speed=args.speed, fps=60 if args.realtime else None,
+                                pan=args.pan, distractors=args.distractors, pauses=args.pauses, noise=args.noise,
+                                colorFormat='BGRx' if args.bgrx else 'BGR')
+        groundTruth = source.GroundTruth
+
+    trackingSize = None
+    if args.high_res:
+        # Tracked (and scored) on the downscaled stream, like CameraMan feeds SystemMan.
+        trackingSize = (1280, 720)
+        if args.video is not None:
+            probe = LocalVideo(args.video)
+            frameSize = probe.GetFrame()[0].shape[1::-1]
+            probe.Close()
+        else:
+            frameSize = HIGH_RES
+        groundTruth = scaledToTracking(frameSize, trackingSize, groundTruth)
+
+    cam = CameraMan(source=source, threaded=args.threaded, trackingSize=trackingSize)
+    per = makePerception(args.detect_latency, args.model, args.config, args.pyramid, args.appearance, args.high_res,
+                         args.motion_gate)
+    # Motor commands go out over a serial line to the stand-in servo controller.
+    servos = FakeServoController() if args.fake_servo else None
+    mot = MotorMan(servoPort=servos.path if servos is not None else None)
+
+    sto, stoThread, outputDir = None, None, None
+    if not args.no_store:
+        outputDir = tempfile.mkdtemp(prefix="inframe_bench_")
+        sto = StorageMan(MessageBus(), os.path.join(outputDir, "bench.mp4"))
+        stoThread = threading.Thread(target=sto.Launch)
+        stoThread.start()
+
+    try:
+        governor = FrameGovernor(budget=args.budget / 1000) if args.budget is not None else None
+        results = RunBenchmark(cam, per, mot, sto, args.frames, groundTruth, governor)
+    finally:
+        cam.Release()
+        per.Release()
+        scheduler = mot.servos
+        mot.Release()
+        if servos is not None:
+            servos.Stop()
+        if sto is not None:
+            sto.Compile()
+            stoThread.join()
+
+    if servos is not None:
+        results["servos"] = {"scheduler": scheduler.Stats(), "controller": servos.Stats()}
+
+    if sto is not None:
+        results["storage"] = {"framesWritten": sto.framesWritten, "droppedFrames": sto.droppedFrames}
+
+    # Rates per minute of footage (synthetic clips play at 60 fps).
+    minutes = (results["frames"] + results["droppedFrames"]) / (getattr(source, "fps", None) or 60) / 60
+    results["perMinute"] = {
+        "trackingFailures": round(results["trackingFailures"] / minutes, 2),
+        "resets": round(results["resets"]["resets"] / minutes, 2),
+    }
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay benchmark of the InFrame tracking pipeline.")
+    parser.add_argument("--video", help="Local video to replay (a synthetic sequence is generated otherwise).")
+    parser.add_argument("--session",
+                        help="Recorded session to replay (see SessionRecorder), compared against the boxes tracked while recording.")
+    parser.add_argument("--ground-truth", help="CSV of frame,left,top,right,bottom boxes for --video.")
+    parser.add_argument("--frames", type=int, default=600, help="Number of frames to process.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Synthetic target speed multiplier.")
+    parser.add_argument("--target-size", type=int, nargs=2, default=(120, 240), metavar=("WIDTH", "HEIGHT"),
+                        help="Synthetic target size in pixels.")
+    parser.add_argument("--pan", type=float, default=0.0,
+                        help="Amplitude (pixels) of a simulated camera pan/tilt moving the synthetic scene.")
+    parser.add_argument("--distractors", type=int, default=0,
+                        help="Number of other (differently colored) people crossing the synthetic target's path.")
+    parser.add_argument("--pauses", type=float, default=0.0,
+                        help="Fraction of the time the synthetic target stands still, in stretches of a few seconds.")
+    parser.add_argument("--noise", type=float, default=0.0,
+                        help="Standard deviation of the sensor noise added to the synthetic frames.")
+    parser.add_argument("--bgrx", action="store_true",
+                        help="Generate 4 channel BGRx frames, like the CSI camera delivers them to CameraMan.")
+    parser.add_argument("--realtime", action="store_true", help="Pace the source at its frame rate like a live camera.")
+    parser.add_argument("--threaded", action="store_true", help="Capture in a separate thread (like SystemMan).")
+    parser.add_argument("--model", help="Run detection with DnnDetector on this model instead of detectNet.")
+    parser.add_argument("--config", help="Config file for --model, if its format needs one.")
+    parser.add_argument("--detect-latency", type=float, default=0.0,
+                        help="Seconds each stand-in detectNet call takes, to emulate the Jetson's detector.")
+    parser.add_argument("--pyramid", action="store_true",
+                        help="Track on a grayscale pyramid level picked by the target's size (see PerceptionMan).")
+    parser.add_argument("--budget", type=float,
+                        help="Per-frame latency budget in ms, frames that would miss it are extrapolated or skipped "
+                             "(see FrameGovernor). Use with --realtime, the budget is counted from capture.")
+    parser.add_argument("--appearance", action="store_true",
+                        help="Re-acquire the target by its appearance on resets (see AppearanceModel).")
+    parser.add_argument("--high-res", action="store_true",
+                        help="Capture at %dx%d (synthetic sequence) or the video's resolution, track on a 1280x720 stream "
+                             "of it and detect in tiles of the full resolution frames (see PerceptionMan's tiledDetection). "
+                             "With --target-size 100 200, a person a few meters away, the target is a 39x78 box moving "
+                             "by about a sixth of its width per frame on the tracking stream."
+                             % HIGH_RES)
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="Hold the target's box instead of tracking while nothing moves around it (see MotionGate).")
+    parser.add_argument("--fake-servo", action="store_true",
+                        help="Send the motor commands over a serial line to a stand-in servo controller on a pseudo-terminal "
+                             "(see FakeServo).")
+    parser.add_argument("--multi-target", type=int,
+                        help="Track this many synthetic people at once (the target and its distractors) with the "
+                             "multi-target tracker, and report its per-frame cost for each of --workers threads.")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        help="Thread counts for --multi-target (1, 2, 4 and the number of cores by default).")
+    parser.add_argument("--no-store", action="store_true", help="Skip the storage stage.")
+    parser.add_argument("--processes", action="store_true",
+                        help="Run capture, perception and storage as separate processes (see PipelineMan). "
+                             "Use with --realtime, perception skips frames an unpaced source produces faster than it tracks.")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+
+    if args.high_res and (args.processes or args.session is not None):
+        parser.error("--high-res only applies to single process runs on a video or a synthetic sequence")
+    if (args.motion_gate or args.fake_servo) and args.processes:
+        parser.error("--motion-gate and --fake-servo only apply to single process runs")
+    if (args.bgrx or args.multi_target) and (args.processes or args.video is not None or args.session is not None):
+        parser.error("--bgrx and --multi-target only apply to single process runs on a synthetic sequence")
+
+    PROFILER.enabled = True
+
+    if args.processes:
+        results = runPipelineMode(args)
+    elif args.multi_target:
+        results = runMultiTargetMode(args)
+    else:
+        results = runSingleProcessMode(args)
+
+    results["config"] = {k: v for k, v in vars(args).items() if k != "output"}
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,15 @@
-from utils.ImageSources import CSICamera, LocalVideo
+from utils.ImageSources import CSICamera, LocalVideo, ThreadedCapture
+from utils.Profiler import PROFILER
 
-import jetson.utils
+try:
+    import jetson.utils
+except ImportError:
+    # Not running on a Jetson, the RGBA-only gstCamera mode (onlyDetect) is unavailable.
+    jetson = None
+
+import cv2
+import numpy as np
+import time
 
 class CameraMan():
     """
@@ -9,34 +18,97 @@ class CameraMan():
     See CSICamera class in ImageSources for more information.
     """
 
-    def __init__(self, path=None, onlyDetect=True, width=1280, height=720, camFile='0'):
+    def __init__(self, path=None, onlyDetect=True, width=1280, height=720, camFile='0',
+                 source=None, threaded=False, realtime=False, trackingSize=None, colorFormat='BGRx'):
         """
         Initializes the input stream from the CSI camera by default.
         For testing purposes, if a path is specified, it treats a
-        locally saved video as its input.
+        locally saved video as its input (paced at its native frame rate if
+        realtime is set). Any other ImageSource can be passed in through source.
+        If threaded is set, frames are captured in a dedicated thread and Capture
+        returns the newest one without waiting on the sensor (see ThreadedCapture).
+        If trackingSize (width, height) is set, the CSI camera captures at its full
+        resolution (16:9 sensor mode), and Capture returns frames downscaled to
+        trackingSize for everything downstream, the full resolution frame being kept
+        for detection (see HighResFrame).
+        The CSI camera delivers frames in colorFormat (see CSICamera), BGRx by default:
+        it skips the pipeline's BGRx to BGR conversion, so frames are only converted
+        once more, straight into the detector's RGBA input (see ImageSource.rgb2crgba).
         """
-        if path is None:
+        self.onlyDetecting = False
+        self.trackingSize = trackingSize
+        self.trackingBuffer = None
+        self.highResFrame = None
+
+        if source is not None:
+            self.source = source
+        elif path is None:
             if onlyDetect:
                 # Can only return RGBA image, so only good for standalone object detection.
                 self.onlyDetecting = True
                 self.source = jetson.utils.gstCamera(width, height, camFile)
+            elif trackingSize is not None:
+                self.source = CSICamera(sensor_mode=1, display_width=3264, display_height=1848,
+                                        color_format=colorFormat)
             else:
-                self.onlyDetecting = False
-                self.source = CSICamera()
+                self.source = CSICamera(color_format=colorFormat)
         else:
-            self.source = LocalVideo(path)
+            self.source = LocalVideo(path, realtime=realtime)
+
+        if threaded and not self.onlyDetecting:
+            self.source = ThreadedCapture(self.source)
 
 
     def Capture(self):
         """
         API function call for pulling the next frame from camera.
-        :returns: frame, width, height
+        Also starts the frame's trace in the profiler (see Profiler.BeginTrace), stamped with its capture time.
+        :returns: frame, width, height, capture timestamp (time.monotonic), total dropped frames
+        """
+        with PROFILER.Stage("capture"):
+            frame, width, height, captureTime, droppedFrames = self.captureInternal()
+            self.highResFrame = frame
+
+            if self.trackingSize is not None:
+                frame, width, height = self.downscale(frame)
+
+        PROFILER.BeginTrace(captureTime)
+
+        return frame, width, height, captureTime, droppedFrames
+
+
+    def HighResFrame(self):
         """
+        :return: The latest captured frame at full resolution (the same as Capture returned unless frames are
+                 downscaled to a trackingSize), only valid until the next call to Capture.
+        """
+        return self.highResFrame
+
+
+    def downscale(self, frame):
+        """
+        Internal function downscaling a frame to trackingSize, into a buffer reused from frame to frame
+        (bilinear, several times cheaper than area averaging at these sizes).
+        :return: frame, width, height
+        """
+        width, height = self.trackingSize
+        shape = (height, width) + frame.shape[2:]
+        if self.trackingBuffer is None or self.trackingBuffer.shape != shape:
+            self.trackingBuffer = np.empty(shape, dtype=frame.dtype)
+
+        return cv2.resize(frame, self.trackingSize, dst=self.trackingBuffer, interpolation=cv2.INTER_LINEAR), width, height
+
+
+    def captureInternal(self):
         if self.onlyDetecting:
             # Much faster than capturing regular image and then transforming.
-            return self.source.CaptureRGBA()
+            frame, width, height = self.source.CaptureRGBA()
+            return frame, width, height, time.monotonic(), 0
+        elif isinstance(self.source, ThreadedCapture):
+            return self.source.Capture()
         else:
-            return self.source.GetFrame()
+            frame, width, height = self.source.GetFrame()
+            return frame, width, height, time.monotonic(), 0
 
 
     def Release(self):
@@ -1,20 +1,65 @@
 import threading
-import queue
 import time
 
+import cv2
+
+from utils.Exceptions import BusClosed, ProtocolError
+from utils.MessageBus import MessageBus, Policy, TO_SYSTEM, TO_REMOTE, BLUETOOTH_IN, REMOTE_PREVIEW, ENCODED_PREVIEW
+from utils.PerceptionUtils import BoundingBox, Detections
+from utils.PreviewEncoder import PreviewEncoder
+from utils.Transports import StreamTransport
+from utils.WireProtocol import Batcher, Command, Invalid, Status, Telemetry
+
 class CommsMan():
+    """
+    Communications manager between the system and the remote interface.
+    With a transport (see Transports), messages travel in the binary format of WireProtocol:
+    incoming commands and bboxes are forwarded to SystemMan, outgoing messages are batched
+    into frames every batchInterval seconds (telemetry coalesced to the newest).
+    Previews of the camera feed are encoded in a worker thread (see PreviewEncoder) and paced
+    to a share of the link's bandwidth. Only the latest frame waits to be encoded, and only the
+    latest preview waits to be sent (after any pending control message), older ones are dropped
+    rather than queued.
+    args:
+    - bus: MessageBus shared with SystemMan.
+    - transport: Link to the remote interface, messages are only logged if None.
+    - batchInterval: Seconds outgoing messages are held for, to be sent together.
+    - previewFps: Maximum rate of previews while filming.
+    - previewSize: (width, height) frames are downscaled to before being handed to the preview encoder.
+    - previewBudget: Target size of a single preview in bytes.
+    - previewBytesPerSecond: Share of the link's bandwidth previews may use.
+    """
+
+    def __init__(self, bus, transport=None, batchInterval=0.05, previewFps=5, previewSize=(320, 180),
+                 previewBudget=12000, previewBytesPerSecond=40000):
+        self.bus = bus
 
-    def __init__(self, commsQueue, termCommsQueue):
         # Sending data CommsMan --> SystemMan
-        self.sysQueueSend = commsQueue
-        # Sending data SystemMan --> CommsMan
-        self.sysQueueRecv = queue.Queue(maxsize=1)
+        self.bus.CreateChannel(TO_SYSTEM, maxsize=8, policy=Policy.BLOCK)
+        # Sending data SystemMan --> CommsMan (stale status messages are dropped rather than blocking the system)
+        self.bus.CreateChannel(TO_REMOTE, maxsize=16, policy=Policy.DROP_OLDEST)
 
-        # Queue from which Bluetooth cmds are simulated as being received
-        self.btQueue = queue.Queue(maxsize=1)
+        # Channel from which Bluetooth cmds are simulated as being received
+        self.bus.CreateChannel(BLUETOOTH_IN, maxsize=8, policy=Policy.BLOCK)
 
-        # Queue indicating CommsMan thread to terminate
-        self.terminateComms = queue.Queue(maxsize=1)
+        # Frames waiting to be encoded as previews, and previews waiting to be sent (only the newest is kept)
+        self.bus.CreateChannel(REMOTE_PREVIEW, policy=Policy.COALESCE_LATEST)
+        self.bus.CreateChannel(ENCODED_PREVIEW, policy=Policy.COALESCE_LATEST)
+
+        self.transport = transport
+        self.batcher = Batcher(interval=batchInterval)
+        self.receiveThread = None
+        self.running = True
+
+        self.previewEncoder = PreviewEncoder(byteBudget=previewBudget)
+        self.previewInterval = 1.0 / previewFps
+        self.previewSize = previewSize
+        self.previewBytesPerSecond = previewBytesPerSecond
+        self.nextPreviewTime = 0.0
+        # Set by SendPreview (or when a preview is dropped) and cleared by the preview thread.
+        self.keyframeLock = threading.Lock()
+        self.keyframeRequested = False
+        self.previewThread = None
 
         # Array representing log of messages marked to send out to remote interface
         self.testSendOutput = []
@@ -23,23 +68,84 @@ class CommsMan():
         """
         External function which enables users to message CommsMan to send
         message to the remote interface via Bluetooth for user operation.
-        :param message: Contents of message to send to remote (String)
+        :param message: Contents of message to send to remote (String, or a WireProtocol message)
+        """
+        self.bus.Publish(TO_REMOTE, message)
+
+    def SendDetections(self, detections):
+        """
+        External function for sending object detection results to the remote interface, for the user to pick a target.
+        :param detections: Detections (or list of detection records, see PerceptionUtils).
+        """
+        self.SendMessageToRemote(Detections.FromRecords(detections))
+
+    def SendTelemetry(self, seq, bbox, deltaTilt, deltaTurn, quality, success):
+        """
+        External function for sending a tracking update to the remote interface. Updates are
+        coalesced, only the newest one is sent per batch. No-op without a transport.
+        :param seq: Frame number.
+        :param bbox: Target's BoundingBox.
+        :param deltaTilt, deltaTurn: Latest motor command in degrees.
+        :param quality: Tracking quality (0-1, see ResetScheduler.TrackingQuality).
+        :param success: Whether tracking succeeded on this frame.
+        """
+        if self.transport is not None:
+            self.bus.Publish(TO_REMOTE, Telemetry(seq, bbox, deltaTilt, deltaTurn, quality, success))
+
+    def SendPreview(self, frame, keyframe=False):
+        """
+        External function for sending a preview of a frame to the remote interface. Only costs a
+        downscale of the frame on the calling thread, and only when a preview is due.
+        No-op without a transport.
+        :param frame: Frame in BGR(x) space (not kept, the caller is free to reuse it).
+        :param keyframe: Send the whole preview rather than what changed, regardless of the preview rate
+                         (e.g. for the user to pick a target on).
+        :return: True if the frame was handed to the preview encoder.
+        """
+        if self.transport is None:
+            return False
+
+        now = time.monotonic()
+        if not keyframe and now < self.nextPreviewTime:
+            return False
+        self.nextPreviewTime = now + self.previewInterval
+
+        if keyframe:
+            # Set aside from the frame, so the request survives the frame being replaced by a newer one.
+            with self.keyframeLock:
+                self.keyframeRequested = True
+
+        thumbnail = cv2.resize(frame, self.previewSize, interpolation=cv2.INTER_AREA)
+        return self.bus.Publish(REMOTE_PREVIEW, (thumbnail, (frame.shape[1], frame.shape[0])))
+
+    def TransportStats(self):
+        """
+        External function for retrieving the link's throughput and latency statistics.
+        :return: Dictionary (see StreamTransport.Stats), None without a transport.
         """
-        self.sysQueueRecv.put(message)
+        if self.transport is None:
+            return None
+
+        stats = self.transport.Stats()
+        stats["telemetryCoalesced"] = self.batcher.coalesced
+        stats["previews"] = self.previewEncoder.Stats()
+        stats["previews"]["dropped"] = self.bus.Stats()[REMOTE_PREVIEW]["dropped"]
+        stats["previews"]["unsent"] = self.bus.Stats()[ENCODED_PREVIEW]["dropped"]
+        return stats
 
     def TerminateCommsMan(self):
         """
         External function to terminate CommsMan thread operations.
         :return: Int 0 indicating no error terminating CommsMan, -1 indicating error (e.g. termination already signaled)
         """
-        try:
-            self.terminateComms.put(-1, block=False)
-            return 0
-        except:
-            # If user spams terminateCommsMan, this will disable holding
-            # the system up, handling exception raised by terminateComms
-            # Queue being full during time of insertion.
-            return -1
+        # Closing our input channels wakes up the CommsMan thread, which then terminates.
+        # If user spams terminateCommsMan, the channels are already closed and we return -1.
+        closedBT = self.bus.Close(BLUETOOTH_IN)
+        closedRemote = self.bus.Close(TO_REMOTE)
+        self.bus.Close(REMOTE_PREVIEW)
+        self.bus.Close(ENCODED_PREVIEW)
+
+        return 0 if closedBT == 0 or closedRemote == 0 else -1
 
     def SimulateReceiveBT(self, message):
         """
@@ -47,9 +153,7 @@ class CommsMan():
         and send them to SystemMan.
         :param message: Contents of message being received via "Bluetooth" (String)
         """
-        try:
-            self.btQueue.put(message, timeout=10)
-        except:
+        if not self.bus.Publish(BLUETOOTH_IN, message, timeout=10):
             print("SRBT         : Bluetooth-Receive queue insertion blocked > 10s on: %s" % message)
 
     def SimulateLogBluetooth(self):
@@ -61,56 +165,180 @@ class CommsMan():
 
     def Launch(self):
         # print("CommsMan     : Main thread launching.")
-        while self.terminateComms.empty():
-            if not self.btQueue.empty():
-                message = self.btQueue.get()
+        if self.transport is not None:
+            self.receiveThread = threading.Thread(target=self.receiveLoop)
+            self.receiveThread.start()
+            self.previewThread = threading.Thread(target=self.previewLoop)
+            self.previewThread.start()
+
+        while True:
+            # Sleeps until there is a message to forward, a batch is due or our channels are closed.
+            try:
+                channel, message = self.bus.Receive([BLUETOOTH_IN, TO_REMOTE, ENCODED_PREVIEW],
+                                                    timeout=self.batcher.TimeToFlush())
+            except BusClosed:
+                break
+
+            if channel == BLUETOOTH_IN:
                 self.sendMessageToSystem(message)
-            elif not self.sysQueueRecv.empty():
-                message = self.sysQueueRecv.get()
-                self.testSendOutput.append(message)
-                print("CommsMan     : Sent message: %s" % message)
+            elif channel in (TO_REMOTE, ENCODED_PREVIEW):
+                self.sendMessageToRemote(message)
+
+            if self.transport is not None and self.batcher.Due():
+                self.flush()
+
+        if self.transport is not None:
+            self.previewThread.join()
+            self.flush()
+            self.running = False
+            self.receiveThread.join()
+            self.transport.Close()
         print("CommsMan     : Main thread terminating.")
 
     def sendMessageToSystem(self, message):
         """
         Internal function for sending message to main System.
-        :param message: Contents of message to send to system (String)
+        :param message: Contents of message to send to system (String or BoundingBox)
         """
-        try:
-            self.sysQueueSend.put(message, timeout=10)
-            # print("SCTS         : Message Sent to System: %s" % message)
-        except:
+        if not self.bus.Publish(TO_SYSTEM, message, timeout=10):
             print("SCTS         : Message to System insertion blocked > 10s on: %s" % message)
 
+    def sendMessageToRemote(self, message):
+        """
+        Internal function queuing a message for the remote interface (logging it if there is no link).
+        """
+        if isinstance(message, str):
+            self.testSendOutput.append(message)
+
+        if self.transport is not None:
+            try:
+                self.batcher.Add(Status(message) if isinstance(message, str) else message)
+            except ProtocolError as e:
+                print("CommsMan     : Dropping message that can't be sent: %s" % e)
+        else:
+            print("CommsMan     : Sent message: %s" % (message,))
+
+    def flush(self):
+        for frame in self.batcher.Flush():
+            try:
+                self.transport.Send(frame)
+            except OSError as e:
+                print("CommsMan     : Could not send to remote: %s" % e)
+
+    def previewLoop(self):
+        """
+        Internal function run in a thread, encoding the latest frame offered by SendPreview.
+        """
+        while True:
+            try:
+                _, (thumbnail, sourceSize) = self.bus.Receive([REMOTE_PREVIEW])
+            except BusClosed:
+                break
+
+            with self.keyframeLock:
+                keyframe, self.keyframeRequested = self.keyframeRequested, False
+            preview = self.previewEncoder.Encode(thumbnail, sourceSize, keyframe)
+            if preview is None:
+                continue
+
+            unsent = self.bus.Stats()[ENCODED_PREVIEW]["dropped"]
+            if not self.bus.Publish(ENCODED_PREVIEW, preview):
+                break
+
+            if self.bus.Stats()[ENCODED_PREVIEW]["dropped"] > unsent:
+                # Replaced a preview that was never sent, the remote can only resynchronize on a keyframe.
+                with self.keyframeLock:
+                    self.keyframeRequested = True
+
+            # Leave the link to other messages for as long as the preview takes to send at the allotted rate
+            # (frames offered in the meantime replace each other).
+            time.sleep(len(preview.data) / self.previewBytesPerSecond)
+
+    def receiveLoop(self):
+        """
+        Internal function run in a thread, forwarding commands and bboxes received from the remote interface.
+        """
+        while self.running:
+            try:
+                messages = self.transport.Receive(timeout=0.1)
+            except ProtocolError as e:
+                print("CommsMan     : Dropping link after bad data from remote: %s" % e)
+                break
+
+            if messages is None:
+                break
+
+            for message in messages:
+                # The stream itself is fine, only this message is skipped.
+                if isinstance(message, Invalid):
+                    print("CommsMan     : Ignoring invalid message from remote: %s" % message.reason)
+                elif isinstance(message, Command):
+                    self.sendMessageToSystem(message.name)
+                elif isinstance(message, BoundingBox):
+                    self.sendMessageToSystem(message)
+                else:
+                    print("CommsMan     : Ignoring unexpected message from remote: %s" % (message,))
+
 
 if __name__ == '__main__':
     # Instantiate Comms object and launch thread
-    commsQueue = queue.Queue(maxsize=1)
-    cm = CommsMan(commsQueue)
-    x = threading.Thread(target=cm.launch)
+    bus = MessageBus()
+    cm = CommsMan(bus)
+    x = threading.Thread(target=cm.Launch)
     print("CommsMan     : before running thread")
     x.start()
     print("CommsMan     : after launching thread")
-    
+
     # Simulate message send requests to remote
-    cm.sendMessageToRemote("Hello")
-    cm.sendMessageToRemote("My name is ike")
+    cm.SendMessageToRemote("Hello")
+    cm.SendMessageToRemote("My name is ike")
 
     # Simulate message retrieval from "Bluetooth" channel
-    cm.simulateReceiveBT("my name is Tim... the Enchanter!!")
+    cm.SimulateReceiveBT("my name is Tim... the Enchanter!!")
 
     # Confirm message retrieval
-    newMsg = commsQueue.get()
-    testOutputBT = cm.simulateLogBluetooth()
+    _, newMsg = bus.Receive([TO_SYSTEM])
+    time.sleep(0.1)
+    testOutputBT = cm.SimulateLogBluetooth()
     print("CommsMan     : received message: %s" % newMsg)
     print("CommsMan     : Bluetooth message log:", testOutputBT)
+    print("CommsMan     : Bus stats:", bus.Stats())
 
     # Terminate CommsMan & rejoin thread
-    if (cm.terminateCommsMan() == -1):
+    if (cm.TerminateCommsMan() == -1):
         print("CommsMan     : Thread terminate has failed/timed-out.")
         raise TimeoutError
     x.join()
     print("CommsMan     : thread rejoined and main ends")
 
+    # Same over a local link standing in for Bluetooth: the remote sends a command and a
+    # target, CommsMan streams telemetry at 60 Hz for a second.
+    bus = MessageBus()
+    local, remote = StreamTransport.SocketPair()
+    cm = CommsMan(bus, transport=local)
+    x = threading.Thread(target=cm.Launch)
+    x.start()
+
+    from utils.WireProtocol import EncodeFrame, EncodeMessage
+    remote.Send(EncodeFrame([EncodeMessage(Command("Start")), EncodeMessage(BoundingBox(100, 80, 300, 400))]))
+    print("CommsMan     : received from remote: %s, %s" % (bus.Receive([TO_SYSTEM])[1], bus.Receive([TO_SYSTEM])[1].topLeft))
+
+    received = []
+    for seq in range(60):
+        cm.SendTelemetry(seq, BoundingBox(100 + seq, 80, 300 + seq, 400), 0.1, -0.2, 0.9, True)
+        received.extend(remote.Receive(timeout=0) or [])
+        time.sleep(1 / 60)
+    cm.SendMessageToRemote("Done")
 
+    cm.TerminateCommsMan()
+    x.join()
+    while True:
+        messages = remote.Receive(timeout=1)
+        if messages is None:
+            break
+        received.extend(messages)
 
+    print("CommsMan     : remote received %d messages, last: %s" % (len(received), received[-1]))
+    print("CommsMan     : link stats (local):", cm.TransportStats())
+    print("CommsMan     : link stats (remote):", remote.Stats())
+    remote.Close()
@@ -1,20 +1,74 @@
+import time
+
+from utils.MotorControl import PredictiveController
+from utils.Profiler import PROFILER
+from utils.ServoLink import SerialLink
+from utils.ServoScheduler import ServoScheduler
+
 class MotorMan():
+    """
+    Manager module for the pan/tilt motors.
+    See PredictiveController in MotorControl for how tracking results become motor deltas.
+    args:
+    - frameSize, fov: Size (pixels) and field of view (degrees) of the tracked frames.
+    - servoPort: Serial device of the servo controller, the orientation is sent to it after every command
+      (see ServoScheduler). Without it, commands are only computed.
+    - servoBaudrate: Speed of the servo controller's serial line.
+    - controlRate: Max commands per second sent to the servo controller.
+    """
 
-    def __init__(self):
+    def __init__(self, frameSize=(1280, 720), fov=(62.2, 48.8), servoPort=None, servoBaudrate=115200, controlRate=50.0):
         self.orientationTilt = 0
         self.orientationTurn = 0
 
-    def ProcessOpticalFlowCommand(self, optical_flow):
+        self.controller = PredictiveController(frameSize=frameSize, fov=fov)
+        self.targetCenter = None
+
+        # Commands are written to the servos from the scheduler's thread, never blocking the tracking loop.
+        self.servos = ServoScheduler(SerialLink(servoPort, servoBaudrate), rate=controlRate) if servoPort is not None else None
+
+    def ProcessOpticalFlowCommand(self, optical_flow, bbox=None, captureTime=None):
         """
         Converts optical flow data (vectors) into deltas motor must
-        turn to re-center camera view.
+        turn to re-center camera view. Target motion is predicted ahead by the
+        time elapsed since the frame was captured, to make up for pipeline latency.
+        :param optical_flow: (x, y) target motion since the last frame (from TrackObjectInNewFrame).
+        :param bbox: Target's latest BoundingBox; if not given, its center is integrated from optical_flow.
+        :param captureTime: Time (time.monotonic) the frame was captured (now if not given).
+        :return: (deltaTilt, deltaTurn) in degrees.
         """
-        # [INSERT CODE BELOW] CONVERTING OPTICAL FLOW TO MOTOR DELTAS
+        now = time.monotonic()
+        captureTime = now if captureTime is None else captureTime
+
+        if bbox is not None:
+            self.targetCenter = bbox.center
+        elif self.targetCenter is not None:
+            self.targetCenter = (self.targetCenter[0] + optical_flow[0], self.targetCenter[1] + optical_flow[1])
+        else:
+            # Nothing to steer towards until we know where the target is.
+            return 0, 0
+
+        with PROFILER.Stage("motor"):
+            deltaTurn, deltaTilt = self.controller.Step(self.targetCenter, captureTime, now)
 
-        deltaTilt, deltaTurn = 0,0
-        
         self.orientationTilt += deltaTilt
         self.orientationTurn += deltaTurn
 
+        if self.servos is not None:
+            self.servos.Command(self.orientationTurn, self.orientationTilt)
 
+        return deltaTilt, deltaTurn
 
+    def GetServoStats(self):
+        """
+        :return: Dictionary of the servo commands sent and their latency (see ServoScheduler.Stats), None without servos.
+        """
+        return self.servos.Stats() if self.servos is not None else None
+
+    def Release(self):
+        """
+        Stops the servo scheduler's thread and closes the serial line, if they were started.
+        """
+        if self.servos is not None:
+            self.servos.Stop()
+            self.servos = None
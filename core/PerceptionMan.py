@@ -1,12 +1,15 @@
-import jetson.inference
-import jetson.utils
-from imutils.video import FPS
-
 import cv2
-import time
-
-from utils.ImageSources import ImageSource, LocalVideo, LocalImage, CSICamera
-from utils.PerceptionUtils import BoundingBox
+import numpy as np
+
+from utils.PerceptionUtils import BoundingBox, Detections, CreateMOSSETracker, GrayPyramid, PlanTiles
+from utils.Appearance import AppearanceModel
+from utils.MotionGate import MotionGate
+from utils.SessionRecorder import DETECTIONS
+from utils.DetectionWorker import DetectionWorker
+from utils.Detectors import JetsonDetector
+from utils.ResetScheduler import ResetScheduler, TrackingQuality
+from utils.MultiTracker import MultiTargetTracker
+from utils.Profiler import PROFILER
 from CameraMan import CameraMan
 
 class PerceptionMan:
@@ -15,40 +18,159 @@ class PerceptionMan:
     args:
     - net: Pre-trained network to use for object detection (ssd-mobilenet-v2 by default).
     - conf: Minimum confidence threshold to qualify as a detected object (0.5 by default).
+    - detector: Detection backend (see Detectors), a JetsonDetector built from net and conf by default.
+    - roiReset: Whether resets detect in a window around the last known bbox rather than the full frame.
+    - roiSize: Resolution detection runs at in ROI mode; larger windows are downscaled to it.
+    - maxResetsPerSecond: Cap on how often tracker resets can invoke the detector.
+    - pyramidTracking: Whether the tracker runs on a grayscale pyramid level picked by the target's size
+      rather than on the full resolution frame.
+    - minTrackSize: Smallest size (pixels, shorter side) the target is tracked at in pyramid mode.
+    - appearanceMatching: Whether resets also pick the detection that looks most like the target (see
+      AppearanceModel), rather than only the one closest to where it should be.
+    - recorder: SessionRecorder the detections run for resets are recorded to (not recorded by default).
+    - tiledDetection: Whether objects are detected in overlapping tiles of the frame, submitted to the detector as
+      one batch (see DetectObjectsInTiles), rather than in the whole frame at once. Meant for high resolution
+      frames (see CameraMan's trackingSize), where distant subjects are too small for the detector otherwise.
+    - tileGrid: (columns, rows) of tiles in tiled detection mode.
+    - tileOverlap: Fraction of a tile shared with its neighbors, so objects cut by a tile's edge are whole in another.
+    - motionGating: Whether frames in which nothing moves around the target can be held instead of tracked (see
+      TargetStatic and MotionGate), which spares the tracker and pushes resets back while the target stands still.
     """
 
-    # Number of frames before tracker is reset to account for accumulated error.
+    # Typical number of frames before tracker is reset to account for accumulated error.
+    # The actual interval adapts to tracking quality (see ResetScheduler), between a
+    # quarter and three times this value.
     RESET_TRACKER_FREQ = 20
 
-    def __init__(self, network='ssd-mobilenet-v2', threshold=0.5):
-        # Load pre-trained object detection network.
-        self.net = jetson.inference.detectNet(network=network, threshold=threshold)
+    # Factor by which the last bbox is grown to get the ROI reset search window.
+    ROI_EXPANSION = 2.5
+
+    # Number of consecutive ROI reset misses before falling back to full-frame detection.
+    ROI_MAX_MISSES = 2
+
+    # Largest fraction of its size a target is believed to move by from one tracked frame to the next, when
+    # estimating its velocity from a reset (see mergePendingReset).
+    MAX_SEEDED_MOTION = 0.25
+
+    def __init__(self, network='ssd-mobilenet-v2', threshold=0.5, detector=None, roiReset=True, roiSize=(640, 360),
+                 maxResetsPerSecond=2.0, pyramidTracking=False, minTrackSize=64, appearanceMatching=False, recorder=None,
+                 tiledDetection=False, tileGrid=(3, 2), tileOverlap=0.25, motionGating=False):
+        # Load pre-trained object detection network, on the Jetson's GPU unless told otherwise.
+        if detector is None:
+            detector = JetsonDetector(network=network, threshold=threshold)
+        self.detector = detector
+
+        # Region of interest detection for resets.
+        self.roiReset = roiReset
+        self.roiSize = roiSize
+        self.roiBuffer = None
+        self.roiMisses = 0
+
+        # Background worker for non-blocking tracker resets (created on first use).
+        self.resetWorker = None
+        self.resetSnapshot = None
+        self.currBoundingBox = None
+
+        # Smoothed target motion (pixels per frame) and frames since the target was last tracked,
+        # used to predict where the target is when associating detections with it.
+        self.velocity = (0.0, 0.0)
+        self.framesSinceTracked = 0
+
+        # Box extrapolated for the latest frame handled without a tracker update (see PredictObjectInNewFrame).
+        self.predictedBbox = None
+
+        # Tracking quality of the latest frame and the reset schedule driven by it.
+        self.trackingQuality = 1.0
+        self.resetScheduler = ResetScheduler(minInterval=self.RESET_TRACKER_FREQ // 4,
+                                             maxInterval=self.RESET_TRACKER_FREQ * 3,
+                                             maxResetsPerSecond=maxResetsPerSecond)
+
+        # Engine for tracking several targets at once (created on first use).
+        self.multiTracker = None
+
+        # Pyramid level the tracker runs on (0 is full resolution) and the pyramid it is built into
+        # (only its grayscale level 0 is used without pyramidTracking, for BGRx frames, see trackingFrame).
+        self.pyramidTracking = pyramidTracking
+        self.minTrackSize = minTrackSize
+        self.pyramid = GrayPyramid() if pyramidTracking else GrayPyramid(maxLevel=0)
+        self.trackLevel = 0
+
+        # Predicted motion of the target (tracker image pixels) taken out of the images handed to the tracker, as of
+        # its last successful update, and the buffer those images are shifted into (see motionCompensated).
+        self.trackOffset = (0, 0)
+        self.shiftBuffer = None
+
+        # Appearance signature of the target, to re-acquire it among similar objects.
+        self.appearance = AppearanceModel() if appearanceMatching else None
+
+        # Session recording (reset detections are recorded when they finish, i.e. a few frames after their snapshot).
+        self.recorder = recorder
+
+        # Tiled detection, with the tiles planned once per frame size (and a snapshot of the frame detected in
+        # for background resets, when it isn't the one tracked).
+        self.tiledDetection = tiledDetection
+        self.tileGrid = tileGrid
+        self.tileOverlap = tileOverlap
+        self.tiles = {}
+        self.resetDetectionSnapshot = None
+
+        # Cheap check of whether anything moves around the target, to skip tracking while it stands still.
+        self.motionGate = MotionGate() if motionGating else None
 
 
     def DetectObjects(self, image, width, height):
         """
         Detects objects in a given image according to the confidence threshold
         specified in the constructor. Overlays results on input image by default.
-        :param image: The input image in RGBA space like network expects.
+        In tiled detection mode, the image is the frame itself, which can be of a higher resolution than the
+        one tracked (e.g. CameraMan.HighResFrame): it is detected in tile by tile, and the detections are
+        scaled to width x height.
+        :param image: The input image as the detector expects it (see PrepareFrame).
         :param width: Width of the input image.
         :param height: Height of the input image.
-        :return detections: A list of the detected object bounding boxes (type jetson.inference.detectNet.Detection)
-        :return result_img: CUDA rgba image with object detection results overlaid
+        :return detections: A list of the detected object bounding boxes (type PerceptionUtils.Detection)
+        :return result_img: Input image (with object detection results overlaid for the Jetson backend)
         """
+        self.waitForReset()
 
-        last_time = time.time()
-
-        # Transform image into RGBA space and place into a cuda container since object detection model expects it.
-        #cudaImg = ImageSource.rgb2crgba(image)
+        if self.tiledDetection:
+            return self.DetectObjectsInTiles(image, width, height)[0], image
 
         # Detect objects in a given image and overlay results on top of it.
-        detections = self.net.Detect(image, width, height)
-
-        print("DETECT OBJECTS TIME", time.time() - last_time)
+        with PROFILER.Stage("detect"):
+            detections = self.detector.Detect(image, width, height)
 
         return detections, image
 
 
+    def PrepareFrame(self, frame):
+        """
+        Transforms a frame from an image source into the input the detector expects
+        (e.g. RGBA inside a cuda container for the Jetson backend).
+        :param frame: Frame in BGR(x) space as returned by an image source.
+        :return: Image to pass to DetectObjects.
+        """
+        self.waitForReset()
+
+        # Tiles are converted as they are cut from the frame.
+        if self.tiledDetection:
+            return frame
+
+        with PROFILER.Stage("convert"):
+            return self.detector.Prepare(frame)
+
+
+    def DetectObjectsBatch(self, frames):
+        """
+        Detects objects in several frames with as few calls into the detector as it allows.
+        :param frames: List of frames in BGR(x) space as returned by an image source.
+        :return: List with a list of Detection records per frame.
+        """
+        self.waitForReset()
+
+        return self.detector.DetectBatch(frames)
+
+
     def InitTracker(self, firstFrame, bbox):
         """
         Initializes a CSRT tracker to track the object in the given bounding box.
@@ -56,26 +178,20 @@ class PerceptionMan:
         :param bbox: The box surrounding the target object (BoundingBox from PerceptionUtils).
         :return success: True if tracker was successfully initialized, false otherwise.
         """
+        # A reset still running (or not merged yet) for the previous target must not land on the new one, nor its
+        # ROI misses count against it.
+        if self.resetWorker is not None:
+            self.resetWorker.Cancel()
+            self.resetWorker.Wait()
+        self.roiMisses = 0
 
-        last_time = time.time()
-
-        x1, y1 = bbox.topLeft
-        x2, y2 = bbox.bottomRight
-
-        # Tracker API uses width and height to define second point.
-        width = x2 - x1
-        height = y2 - y1
-
-        # CSRT tracker yields higher tracking accuracy with slower throughput.
-        # Since we are ussing MOSSE for higher throughput, we need to run object
-        # detection to recenter the tracker every certain number of frames.
-        self.tracker = cv2.TrackerMOSSE_create()
-        success = self.tracker.init(firstFrame, (x1, y1, width, height))
-
-        # Update current bounding box.
-        self.currBoundingBox = bbox
+        # A new target: nothing is known about how it moves yet.
+        self.velocity = (0.0, 0.0)
+        success = self.restartTracker(firstFrame, bbox)
 
-        print("INIT TRACKER TIME", time.time() - last_time)
+        # A new target: start learning what it looks like.
+        if self.appearance is not None:
+            self.appearance.Reset(firstFrame, bbox)
 
         return success
 
@@ -89,9 +205,22 @@ class PerceptionMan:
         :return newBbox: New bounding box around target object.
         """
 
-        last_time = time.time()
+        with PROFILER.Stage("track"):
+            scale = 2 ** self.trackLevel
+            if self.pyramidTracking:
+                image = self.pyramid.Build(currFrame, self.trackLevel)
+            else:
+                image = self.trackingFrame(currFrame)
 
-        success, newBbox = self.tracker.update(currFrame)
+            image, (offsetX, offsetY) = self.motionCompensated(image, scale)
+            success, newBbox = self.tracker.update(image)
+            if success:
+                self.trackOffset = (offsetX, offsetY)
+
+            # Back to full resolution frame coordinates, scaling the unrounded box so its center keeps sub-pixel
+            # accuracy.
+            newBbox = [(newBbox[0] + offsetX) * scale, (newBbox[1] + offsetY) * scale, newBbox[2] * scale,
+                       newBbox[3] * scale]
 
         # Turn new bbox into our definition of a bbox (note: tracker's bbox uses width and height instead of a second point).
         width = newBbox[2]
@@ -99,59 +228,557 @@ class PerceptionMan:
         newBbox = BoundingBox(left=newBbox[0], top=newBbox[1],
                                right=newBbox[0] + width, bottom=newBbox[1] + height)
 
-        # Calculate optical flow using the two most recent bboxes and update current bbox.
-        opticalFlow = self.currBoundingBox.VectorTo(newBbox)
-        self.currBoundingBox = newBbox
+        # On failure we keep the last good bbox, so a pending reset still has a reference point.
+        # Motion is measured from the previous frame's box, which was extrapolated if that frame wasn't tracked.
+        prevBbox = self.currBoundingBox if self.predictedBbox is None else self.predictedBbox
+        self.predictedBbox = None
+        self.trackingQuality = TrackingQuality(success, prevBbox, newBbox, self.velocity)
+
+        # A box that doesn't look like the target means the tracker switched to something else, which
+        # the motion based quality misses when it happens smoothly (e.g. someone passing in front).
+        if success and self.appearance is not None:
+            similarity = self.appearance.Update(currFrame, newBbox, self.trackingQuality)
+            if similarity is not None:
+                self.trackingQuality = min(self.trackingQuality, similarity)
+
+        self.resetScheduler.Update(self.trackingQuality)
+
+        if success:
+            self.currBoundingBox = newBbox
+            self.updateVelocity(prevBbox.VectorTo(newBbox))
+        else:
+            self.framesSinceTracked += 1
+
+        # Merge the result of an asynchronous reset into the tracker if one has finished.
+        correctedBbox = self.mergePendingReset(currFrame)
+        if correctedBbox is not None:
+            success, newBbox = True, correctedBbox
+        elif success and self.motionGate is not None:
+            self.motionGate.Rebase(currFrame, newBbox)
 
-        print("TRACKING TIME", time.time() - last_time)
+        # Calculate optical flow using the two most recent bboxes.
+        opticalFlow = prevBbox.VectorTo(newBbox)
 
         return success, opticalFlow, newBbox
 
 
-    def FindClassInDetections(self, detectionsList, classID):
+    def TargetStatic(self, currFrame):
+        """
+        Whether nothing moved around the target since the tracker last ran (see MotionGate), in which case
+        HoldObjectInNewFrame can stand in for TrackObjectInNewFrame on this frame. Only while tracking is going
+        well (the camera moving shows as motion too). Always False without motion gating.
+        :param currFrame: Current frame.
+        :return: True if the frame can be held.
         """
-        Finds the first bounding box pertaining to an object with a target classID
-        in a list of detection results.
+        if self.motionGate is None or self.predictedBbox is not None:
+            return False
+
+        with PROFILER.Stage("motion_gate"):
+            if self.trackingQuality < self.resetScheduler.lowQuality:
+                # Tracking is shaky: the tracker runs and the gate starts over from its next result.
+                return self.motionGate.Check(currFrame, moved=True)
+
+            return self.motionGate.Check(currFrame)
+
+
+    def HoldObjectInNewFrame(self, currFrame):
+        """
+        Cheap stand-in for TrackObjectInNewFrame on frames in which the target stands still (see TargetStatic):
+        its box stays where it was last tracked. Held frames don't count towards the next reset (see ResetDue),
+        so resets are pushed back for as long as nothing moves, but one in progress is still merged.
+        :param currFrame: Current frame.
+        :return success: Whether the last tracker update succeeded.
+        :return opticalFlow: Vector from the center of the previous bounding box to the held one.
+        :return newBbox: Bounding box around target object.
+        """
+        prevBbox = newBbox = self.currBoundingBox
+
+        # The target doesn't move: neither should predictions once it does again.
+        self.updateVelocity((0.0, 0.0))
+
+        correctedBbox = self.mergePendingReset(currFrame)
+        if correctedBbox is not None:
+            newBbox = correctedBbox
+
+        return self.trackingQuality > 0, prevBbox.VectorTo(newBbox), newBbox
+
+
+    def PredictObjectInNewFrame(self):
+        """
+        Cheap stand-in for TrackObjectInNewFrame when there is no time to run the tracker on a frame
+        (see FrameGovernor): the target's box is extrapolated from its last tracked box and velocity.
+        :return success: Whether the last tracker update succeeded (the prediction is only as good as it).
+        :return opticalFlow: Vector from the center of the previous bounding box to the predicted one.
+        :return newBbox: Predicted bounding box around target object.
+        """
+        prevBbox = self.currBoundingBox if self.predictedBbox is None else self.predictedBbox
+        self.framesSinceTracked += 1
+
+        dx, dy = self.velocity[0] * self.framesSinceTracked, self.velocity[1] * self.framesSinceTracked
+        self.predictedBbox = self.currBoundingBox.Shifted(dx, dy)
+
+        return self.trackingQuality > 0, prevBbox.VectorTo(self.predictedBbox), self.predictedBbox
+
+
+    def InitMultiTracker(self, frame, bboxes, maxWorkers=None):
+        """
+        Starts tracking a group of targets, each with its own tracker and a stable ID.
+        :param frame: Frame in which the targets' bboxes were found.
+        :param bboxes: List of BoundingBoxes, one per target.
+        :param maxWorkers: Number of threads tracker updates are spread across (see MultiTargetTracker).
+        :return: List of track IDs, in the same order as bboxes.
+        """
+        if self.multiTracker is not None:
+            self.multiTracker.Release()
+        self.multiTracker = MultiTargetTracker(maxWorkers=maxWorkers)
+
+        frame = self.trackingFrame(frame)
+        return [self.multiTracker.AddTarget(frame, bbox) for bbox in bboxes]
+
+
+    def TrackTargetsInNewFrame(self, currFrame, trackIds=None):
+        """
+        Tracks every target of the multi-target tracker in the current frame.
+        :param currFrame: Current frame in which to look for the targets.
+        :param trackIds: IDs of the targets to frame together (all of them by default).
+        :return tracks: Dictionary mapping track IDs to (success, BoundingBox).
+        :return framingBox: BoundingBox enclosing the selected targets (None if all were lost).
+        """
+        tracks = self.multiTracker.Update(self.trackingFrame(currFrame))
+
+        return tracks, self.multiTracker.FramingBox(trackIds)
+
+
+    def AssociateDetectionsToTargets(self, frame, detections, classID, spawn=False):
+        """
+        Re-centers the multi-target tracker's targets on matching detections (globally, by IoU).
+        :param frame: Frame the detections were found in.
+        :param detections: Results from object detection.
+        :param classID: Class of the tracked targets (see FindClassInDetections).
+        :param spawn: Whether detections that match no target start new tracks.
+        :return: Dictionary mapping track IDs to the index of the detection they were matched with.
+        """
+        candidates = Detections.FromRecords(detections).Filter(classID=classID)
+
+        return self.multiTracker.Associate(self.trackingFrame(frame), candidates, spawn)
+
+
+    def FindClassInDetections(self, detectionsList, classID, lastBbox=None, framesAhead=0, frame=None):
+        """
+        Finds the bounding box pertaining to an object with a target classID in a list of
+        detection results. If the target was tracked before, picks the detection that best
+        matches its last bbox and its motion-predicted bbox (see Detections.BestMatch), and
+        its appearance in appearance matching mode, otherwise the most confident one.
         Note: Class ID is an index into this list of classes:
         https://github.com/dusty-nv/jetson-inference/blob/master/data/networks/ssd_coco_labels.txt
-        :param detectionsList: Results from object detection.
+        :param detectionsList: Results from object detection (Detections or list of detection records).
         :param classID: target classID to look for.
+        :param lastBbox: Last known bbox of the target, if any.
+        :param framesAhead: Frames elapsed since lastBbox, to predict the target's current position.
+        :param frame: Frame the detections were found in, to compare their appearance with the target's.
         :return: bounding box around target with specified classID or none if not found
         """
-        target = None
-
-        for detection in detectionsList:
-            if detection.ClassID == classID:
-                target = detection
+        candidates = Detections.FromRecords(detectionsList).Filter(classID=classID)
 
-        if target is None:
+        if len(candidates) == 0:
             return None
+
+        if lastBbox is None:
+            best = int(candidates.scores.argmax())
         else:
-            return BoundingBox(left=target.Left, top=target.Top, right=target.Right, bottom=target.Bottom)
+            appearance, minSimilarity = None, 0.0
+            if self.appearance is not None and frame is not None:
+                # All candidates are scored in one pass.
+                appearance = self.appearance.Similarity(frame, candidates.boxes)
+                minSimilarity = self.appearance.minSimilarity
+
+            best = candidates.BestMatch(lastBbox, self.velocity, framesAhead, appearance=appearance,
+                                        minAppearance=minSimilarity)
+
+            # Nothing plausible near where the target should be (e.g. it was lost for a while): re-acquire it
+            # by its looks alone.
+            if best < 0 and appearance is not None and appearance.max() >= minSimilarity:
+                best = int(appearance.argmax())
 
+            if best < 0:
+                return None
 
-    def ResetTracker(self, frame, width, height, classID):
+        return candidates.BoundingBox(best)
+
+
+    def ResetTracker(self, frame, width, height, classID, detectionFrame=None):
         """
         Re-initializes the tracker to center on a bounding box returned from
         object detection with a given classID.
         :param frame, width, height: Latest frame and frame metadata
         :param classID: desired classID to recenter tracker on, there can only be one per frame
         See FindClassInDetections method for more information on classID
+        :param detectionFrame: The same frame at a higher resolution to detect in (tiled detection mode only).
         """
         print("Resetting tracker...")
+        self.waitForReset()
 
-        cudaImg = ImageSource.rgb2crgba(frame)
-        detections, _ = self.DetectObjects(cudaImg, width, height)
-        resetBbox = self.FindClassInDetections(detections, classID)
+        resetBbox = self.detectTarget(frame, width, height, classID, self.currBoundingBox, self.framesSinceTracked,
+                                      detectionFrame)
 
         if resetBbox is not None:
-            self.InitTracker(frame, resetBbox)
+            self.restartTracker(frame, resetBbox)
+
+
+    def RequestReset(self, frame, width, height, classID, detectionFrame=None):
+        """
+        Non-blocking version of ResetTracker. Hands a snapshot of the given frame to a
+        background detection worker and returns immediately, so the caller can keep
+        calling TrackObjectInNewFrame at full rate. Once detection finishes, its box is
+        corrected for the motion the tracker saw since the snapshot and merged into
+        the tracker on the next call to TrackObjectInNewFrame.
+        :param frame, width, height: Latest frame and frame metadata
+        :param classID: desired classID to recenter tracker on (see FindClassInDetections)
+        :param detectionFrame: The same frame at a higher resolution to detect in (tiled detection mode only).
+        :return: True if a reset was started, False if one is already in progress or resets are being throttled.
+        """
+        if self.resetWorker is None:
+            self.resetWorker = DetectionWorker(self.detectForReset)
+
+        if self.resetWorker.IsBusy() or not self.resetScheduler.Acquire():
+            return False
+
+        # The caller keeps drawing on/reusing its frame, so the worker gets its own copy
+        # (in a buffer reused across resets, since only one reset can be in flight).
+        if self.resetSnapshot is None or self.resetSnapshot.shape != frame.shape:
+            self.resetSnapshot = np.empty_like(frame)
+        np.copyto(self.resetSnapshot, frame)
+
+        detectionSnapshot = None
+        if self.tiledDetection and detectionFrame is not None:
+            if self.resetDetectionSnapshot is None or self.resetDetectionSnapshot.shape != detectionFrame.shape:
+                self.resetDetectionSnapshot = np.empty_like(detectionFrame)
+            np.copyto(self.resetDetectionSnapshot, detectionFrame)
+            detectionSnapshot = self.resetDetectionSnapshot
+
+        return self.resetWorker.Submit(self.resetSnapshot, width, height, classID,
+                                       self.currBoundingBox, self.framesSinceTracked, detectionSnapshot)
+
+
+    def ResetDue(self):
+        """
+        Whether the tracker should be reset given how well tracking has been going lately:
+        early when tracking quality drops, less often while it stays high.
+        :return: True if a reset should be requested.
+        """
+        return self.resetScheduler.ResetDue()
+
+
+    def Release(self):
+        """
+        Stops the background reset worker and multi-target tracker threads, if they were started.
+        """
+        if self.resetWorker is not None:
+            self.resetWorker.Stop()
+            self.resetWorker = None
+
+        if self.multiTracker is not None:
+            self.multiTracker.Release()
+            self.multiTracker = None
+
+
+    def restartTracker(self, frame, bbox):
+        """
+        Internal function (re)starting the tracker on the same target (unlike InitTracker, what was learnt
+        about the target is kept).
+        :return: True if the tracker was successfully initialized.
+        """
+        success = self.startTracker(frame, bbox)
+
+        # Update current bounding box and start counting frames towards the next reset.
+        self.currBoundingBox = bbox
+        self.predictedBbox = None
+        self.framesSinceTracked = 0
+        self.resetScheduler.framesSinceReset = 0
+
+        if self.motionGate is not None:
+            self.motionGate.Rebase(frame, bbox)
+
+        return success
+
+
+    def startTracker(self, frame, bbox):
+        """
+        Internal function (re)starting the tracker on a bbox, without touching the reset schedule.
+        :return: True if the tracker was successfully initialized.
+        """
+        x1, y1 = bbox.topLeft
+        x2, y2 = bbox.bottomRight
+
+        # Tracker API uses width and height to define second point.
+        width = x2 - x1
+        height = y2 - y1
+
+        # CSRT tracker yields higher tracking accuracy with slower throughput.
+        # Since we are ussing MOSSE for higher throughput, we need to run object
+        # detection to recenter the tracker every certain number of frames.
+        with PROFILER.Stage("init_tracker"):
+            if self.pyramidTracking:
+                # Large targets are tracked on a smaller image, as long as they stay minTrackSize across.
+                self.trackLevel = self.pyramid.LevelFor(bbox, self.minTrackSize)
+                scale = 2 ** self.trackLevel
+                image = self.pyramid.Build(frame, self.trackLevel)
+                x1, y1, width, height = x1 / scale, y1 / scale, width / scale, height / scale
+            else:
+                image = self.trackingFrame(frame)
+
+            self.tracker = CreateMOSSETracker()
+            self.trackOffset = (0, 0)
+            return self.tracker.init(image, (x1, y1, width, height))
+
+
+    def motionCompensated(self, image, scale):
+        """
+        Internal function shifting the image the tracker runs on back by the target's predicted motion since the
+        tracker was started, so that it looks for the target where it should be rather than where it last was
+        (MOSSE loses targets that move more than a small fraction of their size from one frame to the next, e.g.
+        medium sized subjects in the downscaled stream of high resolution frames). The prediction is one frame of
+        motion past the last successful update: a lost target isn't extrapolated any further, as a velocity that is
+        off would then take the tracker ever further from it. Only the part of the image around the target (its
+        last box grown by ROI_EXPANSION), which is all the tracker looks at, is copied into a buffer reused from
+        frame to frame.
+        :param image: Image the tracker runs on.
+        :param scale: Size of the image's pixels in frame pixels (see trackLevel).
+        :return image: Shifted image.
+        :return offset: (x, y) by which it is shifted, image coordinates being tracker coordinates plus offset.
+        """
+        baseX, baseY = self.trackOffset
+        offsetX = baseX + int(round(self.velocity[0] / scale))
+        offsetY = baseY + int(round(self.velocity[1] / scale))
+        if (offsetX, offsetY) == (0, 0):
+            return image, (0, 0)
+
+        if self.shiftBuffer is None or self.shiftBuffer.shape != image.shape:
+            self.shiftBuffer = np.zeros_like(image)
+
+        # Where the tracker looks, in tracker coordinates (clipped so that it comes from within the image).
+        height, width = image.shape[:2]
+        (x1, y1), (x2, y2) = self.currBoundingBox.topLeft, self.currBoundingBox.bottomRight
+        centerX, centerY = self.currBoundingBox.center[0] / scale - baseX, self.currBoundingBox.center[1] / scale - baseY
+        halfW, halfH = (x2 - x1) * self.ROI_EXPANSION / (2 * scale), (y2 - y1) * self.ROI_EXPANSION / (2 * scale)
+        left, right = max(int(centerX - halfW), 0, -offsetX), min(int(np.ceil(centerX + halfW)), width, width - offsetX)
+        top, bottom = max(int(centerY - halfH), 0, -offsetY), min(int(np.ceil(centerY + halfH)), height, height - offsetY)
+
+        if left < right and top < bottom:
+            self.shiftBuffer[top:bottom, left:right] = image[top + offsetY:bottom + offsetY, left + offsetX:right + offsetX]
+
+        return self.shiftBuffer, (offsetX, offsetY)
+
+
+    def trackingFrame(self, frame):
+        """
+        Internal function returning a frame as the tracker takes it at full resolution. MOSSE only takes BGR or
+        grayscale frames (and only looks at their luminance), so BGRx frames are converted to grayscale.
+        """
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            return self.pyramid.Build(frame, 0)
+
+        return frame
+
+
+    def waitForReset(self):
+        """
+        Internal function waiting for the background reset in flight, if any, before the detector is used from the
+        tracking thread: the detector, its input buffers and the ROI/tile state are only ever used by one thread
+        at a time (see DetectionWorker.Wait).
+        """
+        if self.resetWorker is not None:
+            self.resetWorker.Wait()
+
+
+    def detectForReset(self, snapshot, width, height, classID, snapshotBbox, framesAhead, detectionSnapshot=None):
+        """
+        Internal function run in the reset worker thread.
+        :return: (bbox found by detection or None, tracker bbox at the time of the snapshot, frames it had been lost for)
+        """
+        return (self.detectTarget(snapshot, width, height, classID, snapshotBbox, framesAhead, detectionSnapshot),
+                snapshotBbox, framesAhead)
+
+
+    def DetectObjectsInRegion(self, frame, bbox):
+        """
+        Detects objects in a window around a bbox rather than in the full frame. The window is
+        the bbox grown by ROI_EXPANSION (at least roiSize), downscaled to roiSize if larger.
+        :param frame: Frame in BGR(x) space as returned by an image source.
+        :param bbox: Last known bbox of the target.
+        :return detections: Detections in full-frame coordinates.
+        :return window: (left, top, right, bottom) window that was searched.
+        """
+        self.waitForReset()
+
+        frameH, frameW = frame.shape[:2]
+        left, top, right, bottom = bbox.SearchWindow(self.ROI_EXPANSION, self.roiSize, (frameW, frameH))
+        crop = frame[top:bottom, left:right]
+
+        # Downscale into a reused buffer so the detector always sees the same resolution.
+        roiW, roiH = self.roiSize
+        if (right - left, bottom - top) != (roiW, roiH):
+            if self.roiBuffer is None or self.roiBuffer.shape[2:] != frame.shape[2:]:
+                self.roiBuffer = np.empty((roiH, roiW) + frame.shape[2:], dtype=frame.dtype)
+            crop = cv2.resize(crop, (roiW, roiH), dst=self.roiBuffer, interpolation=cv2.INTER_AREA)
+
+        detections, _ = self.DetectObjects(self.PrepareFrame(crop), roiW, roiH)
+
+        # Map detections back to full-frame coordinates.
+        scaleX, scaleY = (right - left) / roiW, (bottom - top) / roiH
+        mapped = Detections.FromRecords(detections).Transformed(scaleX, scaleY, left, top)
+
+        return mapped, (left, top, right, bottom)
+
+
+    def DetectObjectsInTiles(self, frame, width, height, near=None):
+        """
+        Detects objects in overlapping tiles of a frame, all submitted to the detector as one batch, so that
+        subjects only a few dozen pixels tall in a high resolution frame are seen at a size the detector finds
+        them at. Objects seen by several tiles are merged (see Detections.NonMaxSuppression).
+        :param frame: Frame in BGR(x) space, of any resolution.
+        :param width, height: Size of the frames tracked, which the detections are scaled to.
+        :param near: Last known BoundingBox of the target (in tracked frame coordinates), to only detect in the
+                     tiles overlapping it once grown by ROI_EXPANSION (all tiles by default).
+        :return detections: Detections in tracked frame coordinates.
+        :return tiles: (N, 4) array of the (left, top, right, bottom) tiles detected in, in frame coordinates.
+        """
+        self.waitForReset()
+
+        frameH, frameW = frame.shape[:2]
+        if (frameW, frameH) not in self.tiles:
+            self.tiles[(frameW, frameH)] = PlanTiles((frameW, frameH), self.tileGrid, self.tileOverlap)
+        tiles = self.tiles[(frameW, frameH)]
+        scaleX, scaleY = frameW / width, frameH / height
+
+        if near is not None:
+            (x1, y1), (x2, y2) = near.topLeft, near.bottomRight
+            halfW, halfH = (x2 - x1) * self.ROI_EXPANSION / 2, (y2 - y1) * self.ROI_EXPANSION / 2
+            left, right = (near.center[0] - halfW) * scaleX, (near.center[0] + halfW) * scaleX
+            top, bottom = (near.center[1] - halfH) * scaleY, (near.center[1] + halfH) * scaleY
+            overlapping = (tiles[:, 0] < right) & (tiles[:, 2] > left) & (tiles[:, 1] < bottom) & (tiles[:, 3] > top)
+            if overlapping.any():
+                tiles = tiles[overlapping]
+
+        with PROFILER.Stage("detect"):
+            results = self.detector.DetectBatch([frame[top:bottom, left:right] for left, top, right, bottom in tiles])
+
+        # Map every tile's detections back to tracked frame coordinates, and merge them.
+        mapped = [Detections.FromRecords(detections).Transformed(1 / scaleX, 1 / scaleY, left / scaleX, top / scaleY)
+                  for detections, (left, top, _, _) in zip(results, tiles)]
+        groups = np.repeat(np.arange(len(mapped)), [len(detections) for detections in mapped])
+        merged = Detections(np.concatenate([detections.boxes for detections in mapped]),
+                            np.concatenate([detections.scores for detections in mapped]),
+                            np.concatenate([detections.classes for detections in mapped]))
+
+        return merged.NonMaxSuppression(groups=groups), tiles
+
+
+    def detectTarget(self, frame, width, height, classID, lastBbox, framesAhead=0, detectionFrame=None):
+        """
+        Internal function that runs detection for a reset, in a window around the last
+        known bbox when possible and on the full frame otherwise (in the tiles around the
+        last known bbox, or in all of them, in tiled detection mode).
+        :return: bbox found by detection or None.
+        """
+        if not self.tiledDetection or detectionFrame is None:
+            detectionFrame = frame
+
+        if self.roiReset and lastBbox is not None and self.roiMisses < self.ROI_MAX_MISSES:
+            if self.tiledDetection:
+                detections, _ = self.DetectObjectsInTiles(detectionFrame, width, height, near=lastBbox)
+            else:
+                detections, _ = self.DetectObjectsInRegion(frame, lastBbox)
+            self.recordDetections(detections)
+            bbox = self.FindClassInDetections(detections, classID, lastBbox, framesAhead, frame)
+
+            self.roiMisses = 0 if bbox is not None else self.roiMisses + 1
+            return bbox
+
+        detections, _ = self.DetectObjects(self.PrepareFrame(detectionFrame), width, height)
+        self.recordDetections(detections)
+        bbox = self.FindClassInDetections(detections, classID, lastBbox, framesAhead, frame)
+
+        # Go back to ROI resets once the target has been found again.
+        if bbox is not None:
+            self.roiMisses = 0
+
+        return bbox
+
+
+    def recordDetections(self, detections):
+        """
+        Internal function adding detections to the session being recorded, if any.
+        """
+        if self.recorder is not None:
+            self.recorder.Record(DETECTIONS, detections)
+
+
+    def updateVelocity(self, opticalFlow):
+        """
+        Internal function that folds the latest optical flow into the smoothed target velocity.
+        """
+        alpha = 0.5
+        self.velocity = (alpha * opticalFlow[0] + (1 - alpha) * self.velocity[0],
+                         alpha * opticalFlow[1] + (1 - alpha) * self.velocity[1])
+        self.framesSinceTracked = 0
+
+
+    def mergePendingReset(self, currFrame):
+        """
+        Internal function that re-initializes the tracker with the result of a finished
+        asynchronous reset, if there is one.
+        :param currFrame: Frame the tracker was just updated with.
+        :return: The corrected bbox the tracker was re-initialized on, or None.
+        """
+        if self.resetWorker is None:
+            return None
+
+        result = self.resetWorker.Poll()
+        if result is None:
+            return None
+
+        detectedBbox, snapshotBbox, framesLost = result
+        if detectedBbox is None:
+            return None
+
+        dx, dy = 0.0, 0.0
+        if framesLost > 0 and snapshotBbox is self.currBoundingBox:
+            # The tracker had lost the target at the time of the snapshot and hasn't found it since: the detection
+            # is all there is to tell how fast the target moves (which the tracker needs to find it again, see
+            # motionCompensated), and where it went since the snapshot. Unless it implies a motion the target can't
+            # have, which means the frames tracked weren't consecutive (skipped frames) or the detection is of
+            # something else: the target's motion is then unknown.
+            velocityX = (detectedBbox.center[0] - snapshotBbox.center[0]) / framesLost
+            velocityY = (detectedBbox.center[1] - snapshotBbox.center[1]) / framesLost
+            (x1, y1), (x2, y2) = detectedBbox.topLeft, detectedBbox.bottomRight
+            if (abs(velocityX) <= self.MAX_SEEDED_MOTION * (x2 - x1)
+                    and abs(velocityY) <= self.MAX_SEEDED_MOTION * (y2 - y1)):
+                self.velocity = (velocityX, velocityY)
+                elapsed = self.framesSinceTracked - framesLost
+                dx, dy = velocityX * elapsed, velocityY * elapsed
+            else:
+                self.velocity = (0.0, 0.0)
+        elif snapshotBbox is not None:
+            # Shift the detection by however much the target moved between the snapshot and now (unrounded, unlike
+            # VectorTo, so slow motion isn't lost).
+            dx = self.currBoundingBox.center[0] - snapshotBbox.center[0]
+            dy = self.currBoundingBox.center[1] - snapshotBbox.center[1]
+
+        correctedBbox = detectedBbox.Shifted(dx, dy)
+
+        self.restartTracker(currFrame, correctedBbox)
+
+        return correctedBbox
 
 
 
 # Outline of full system CSM if only perception code was running.
 if __name__ == '__main__':
     # If not path is specified, CameraMan instantiates a CSICamera image source.
+    import jetson.utils
+    from imutils.video import FPS
+
     source = CameraMan()
     perception = PerceptionMan(threshold=0.3)
     display = jetson.utils.glDisplay()
@@ -167,7 +794,7 @@ if __name__ == '__main__':
         # they can select a target.
         # Note: For info on the detections list returned from detectObjects, see jetson.inference.detectNet.Detection
         # from here https://rawgit.com/dusty-nv/jetson-inference/python/docs/html/python/jetson.inference.html#detectNet
-        frame, width, height = source.Capture()
+        frame, width, height, _, _ = source.Capture()
         detections, _ = perception.DetectObjects(frame, width, height)
 
         # TODO(@Ike): Send image to phone to select target class
@@ -183,7 +810,7 @@ if __name__ == '__main__':
         fps = FPS().start()
         while True:
             # Get latest frame.
-            frame, width, height = source.Capture()
+            frame, width, height, _, _ = source.Capture()
             detections, _ = perception.DetectObjects(frame, width, height)
             display.RenderOnce(frame, width, height)
 
@@ -0,0 +1,426 @@
+import multiprocessing as mp
+import queue
+import threading
+import time
+
+import numpy as np
+
+from utils.ImageSources import CSICamera
+from utils.MessageBus import MessageBus
+from utils.PerceptionUtils import BoundingBox
+from utils.Profiler import PROFILER
+from utils.SharedFrameRing import SharedFrameRing
+
+# Processes are spawned rather than forked so that none of them inherits the parent's
+# camera, CUDA or GStreamer state. Everything handed to them must therefore be picklable
+# (e.g. classes, module level functions or functools.partial objects as factories).
+CONTEXT = mp.get_context("spawn")
+
+
+class PipelineMan():
+    """
+    Optional multi-process version of the tracking pipeline, to spread capture, perception
+    and storage over separate cores instead of having them compete for a single GIL.
+    - Capture process: decodes frames straight into a SharedFrameRing and announces each one
+      as a (sequence number, capture time) record.
+    - Perception process: tracks the target on the newest announced frame (older ones are
+      skipped if it falls behind) and commands the motors, publishing a small result record
+      per frame.
+    - Storage process: encodes every announced frame it can keep up with (see StorageMan).
+    Frames never go through a queue, only their records do, so no frame is ever pickled.
+    The owning process drives the pipeline (target selection, results, preview) through
+    the methods below.
+    args:
+    - sourceFactory: Callable building the ImageSource in the capture process (CSICamera by default).
+    - perceptionFactory: Callable building the PerceptionMan in the perception process.
+    - outputPath: Path of the take (see StorageMan), no storage process is started if None.
+    - frameShape: Shape of the source's frames, (height, width, channels).
+    - numSlots: Number of frames in the shared ring.
+    - profile: Whether the perception process collects stage latencies (see Profiler).
+    """
+
+    def __init__(self, sourceFactory=CSICamera, perceptionFactory=None, outputPath=None,
+                 frameShape=(720, 1280, 3), numSlots=8, profile=False):
+        self.ring = SharedFrameRing(frameShape, numSlots=numSlots)
+        self.stop = CONTEXT.Event()
+
+        # Perception only ever wants the newest frame, storage wants them all (up to what the ring holds).
+        self.perceptionFrames = CONTEXT.Queue(maxsize=2)
+        self.storageFrames = CONTEXT.Queue(maxsize=max(numSlots - 2, 1)) if outputPath is not None else None
+        self.commands = CONTEXT.Queue()
+        self.results = CONTEXT.Queue(maxsize=64)
+        self.stats = CONTEXT.Queue()
+
+        ringArgs = self.ring.Attach()
+        self.processes = [
+            CONTEXT.Process(target=runCapture, name="InFrameCapture",
+                            args=(sourceFactory, ringArgs, self.perceptionFrames, self.storageFrames, self.stop, self.stats)),
+            CONTEXT.Process(target=runPerception, name="InFramePerception",
+                            args=(perceptionFactory, ringArgs, self.perceptionFrames, self.commands, self.results,
+                                  self.stop, self.stats, profile)),
+        ]
+        if outputPath is not None:
+            self.processes.append(
+                CONTEXT.Process(target=runStorage, name="InFrameStorage",
+                                args=(outputPath, ringArgs, self.storageFrames, self.stop, self.stats)))
+
+
+    def Launch(self):
+        """
+        Starts the pipeline's processes.
+        """
+        for process in self.processes:
+            process.start()
+
+
+    def TrackTarget(self, bbox):
+        """
+        Starts tracking a target from a user-selected bounding box (on the next frame perception picks up).
+        :param bbox: BoundingBox around the target.
+        """
+        self.commands.put(("track", bbox.topLeft + bbox.bottomRight))
+
+
+    def SelectTarget(self, classID):
+        """
+        Detects objects on the next frame and starts tracking the most confident one of a class.
+        :param classID: Class of the target (see PerceptionMan.FindClassInDetections).
+        """
+        self.commands.put(("select", classID))
+
+
+    def StopTracking(self):
+        """
+        Stops tracking (and moving the motors), frames keep being captured and stored.
+        """
+        self.commands.put(("stop",))
+
+
+    def Results(self, timeout=0):
+        """
+        Collects the records published by perception since the last call.
+        :param timeout: Seconds to wait for the first record (0 to only poll, None to wait forever).
+        :return: List of (seq, captureTime, success, (left, top, right, bottom) or None, (deltaTilt, deltaTurn))
+        """
+        records = []
+        try:
+            records.append(self.results.get(block=timeout != 0, timeout=timeout))
+            while True:
+                records.append(self.results.get_nowait())
+        except queue.Empty:
+            pass
+
+        return records
+
+
+    def Preview(self, seq, out):
+        """
+        Copies a frame out of the shared ring, e.g. to draw a result on it and display it.
+        :param seq: Sequence number of the frame (from a result record).
+        :param out: Preallocated array of frameShape.
+        :return: True if out holds the frame, False if it was already overwritten.
+        """
+        return self.ring.Read(seq, out)
+
+
+    def Running(self):
+        """
+        :return: Whether the pipeline is still running (the source may have run out of frames).
+        """
+        return all(process.is_alive() for process in self.processes[:2])
+
+
+    def Shutdown(self, timeout=10):
+        """
+        Stops every process (storage finishes writing the frames it was handed) and frees the ring.
+        :return: Dictionary mapping process names to their statistics.
+        """
+        self.stop.set()
+
+        stats = {}
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            # Keep the queues drained, a process can't exit while its queued records wait to be flushed.
+            while process.is_alive() and time.monotonic() < deadline:
+                self.Results()
+                stats.update(self.collectStats())
+                process.join(0.05)
+
+            if process.is_alive():
+                print("PipelineMan  : %s did not stop, terminating it." % process.name)
+                process.terminate()
+                process.join()
+
+        stats.update(self.collectStats())
+        self.ring.Close()
+
+        return stats
+
+
+    def collectStats(self):
+        stats = {}
+        try:
+            while True:
+                name, processStats = self.stats.get_nowait()
+                stats[name] = processStats
+        except queue.Empty:
+            pass
+
+        return stats
+
+
+def putLatest(q, record):
+    """
+    Puts a record on a queue that only needs to hold the latest records, dropping the oldest one if it's full.
+    :return: True if a record had to be dropped.
+    """
+    try:
+        q.put_nowait(record)
+        return False
+    except queue.Full:
+        pass
+
+    try:
+        q.get_nowait()
+    except queue.Empty:
+        pass
+
+    try:
+        q.put_nowait(record)
+    except queue.Full:
+        pass
+
+    return True
+
+
+def runCapture(sourceFactory, ringArgs, perceptionFrames, storageFrames, stop, stats):
+    """
+    Capture process: reads frames into the shared ring and announces them.
+    """
+    ring = SharedFrameRing(**ringArgs)
+    source = sourceFactory()
+
+    seq = 0
+    coalesced = 0
+    storageDropped = 0
+    slot = frame = None
+    start = time.monotonic()
+
+    try:
+        while not stop.is_set():
+            slot = ring.BeginWrite(seq + 1)
+            try:
+                frame = source.ReadInto(slot)
+            except Exception as e:
+                print("PipelineMan  : Capture stopped: %s" % e)
+                break
+
+            # Sources that can't decode in place hand back their own array.
+            if not np.shares_memory(frame, slot):
+                if frame.shape != slot.shape:
+                    raise ValueError("Source frames are %s, pipeline expects %s" % (frame.shape, slot.shape))
+                np.copyto(slot, frame)
+
+            seq += 1
+            ring.EndWrite(seq)
+            record = (seq, time.monotonic())
+
+            if putLatest(perceptionFrames, record):
+                coalesced += 1
+
+            if storageFrames is not None:
+                try:
+                    storageFrames.put_nowait(record)
+                except queue.Full:
+                    storageDropped += 1
+    finally:
+        # Let the consumers know no more frames are coming.
+        putLatest(perceptionFrames, None)
+        if storageFrames is not None:
+            try:
+                storageFrames.put(None, timeout=5)
+            except queue.Full:
+                pass
+
+        source.Close()
+        elapsed = time.monotonic() - start
+        stats.put(("capture", {
+            "frames": seq,
+            "fps": round(seq / elapsed, 2) if elapsed > 0 else 0.0,
+            "skippedByPerception": coalesced,
+            "droppedByStorage": storageDropped,
+        }))
+        # Views into the ring have to go before it can be closed.
+        slot = frame = None
+        ring.Close()
+
+
+def runPerception(perceptionFactory, ringArgs, frames, commands, results, stop, stats, profile):
+    """
+    Perception process: tracks the target on the newest frame and commands the motors.
+    """
+    # Imported here so the parent process doesn't have to load the detector's dependencies.
+    from MotorMan import MotorMan
+    from PerceptionMan import PerceptionMan
+
+    PROFILER.enabled = profile
+    ring = SharedFrameRing(**ringArgs)
+    height, width = ring.shape[:2]
+
+    per = (perceptionFactory or PerceptionMan)()
+    mot = MotorMan(frameSize=(width, height))
+    frame = np.empty(ring.shape, dtype=ring.dtype)
+
+    tracking = False
+    processed = 0
+    overwritten = 0
+    resultsDropped = 0
+    start = time.monotonic()
+
+    try:
+        while True:
+            try:
+                record = frames.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    break
+                continue
+
+            # Skip to the newest frame if we fell behind.
+            try:
+                while record is not None:
+                    record = frames.get_nowait()
+            except queue.Empty:
+                pass
+
+            if record is None:
+                break
+
+            seq, captureTime = record
+            if not ring.Read(seq, frame):
+                overwritten += 1
+                continue
+
+            PROFILER.BeginTrace(captureTime)
+
+            # Apply commands from the owning process before working on the frame.
+            try:
+                while True:
+                    command = commands.get_nowait()
+                    if command[0] == "track":
+                        tracking = per.InitTracker(frame, BoundingBox(*command[1])) is not False
+                    elif command[0] == "select":
+                        detections, _ = per.DetectObjects(per.PrepareFrame(frame), width, height)
+                        bbox = per.FindClassInDetections(detections, classID=command[1])
+                        tracking = bbox is not None and per.InitTracker(frame, bbox) is not False
+                    elif command[0] == "stop":
+                        tracking = False
+            except queue.Empty:
+                pass
+
+            if not tracking:
+                continue
+
+            success, opticalFlow, newBbox = per.TrackObjectInNewFrame(frame)
+
+            deltas = (0, 0)
+            if success:
+                deltas = mot.ProcessOpticalFlowCommand(opticalFlow, newBbox, captureTime)
+                PROFILER.EndTrace("glass_to_motor")
+                # Reset after tracking, so that the snapshot is of the frame the tracker is at.
+                if per.ResetDue():
+                    per.RequestReset(frame, width, height, classID=1)
+            else:
+                per.RequestReset(frame, width, height, classID=1)
+
+            processed += 1
+            try:
+                results.put_nowait((seq, captureTime, success, newBbox.topLeft + newBbox.bottomRight, deltas))
+            except queue.Full:
+                # Nobody is consuming the results, which is fine.
+                resultsDropped += 1
+    finally:
+        per.Release()
+        mot.Release()
+        elapsed = time.monotonic() - start
+        stats.put(("perception", {
+            "frames": processed,
+            "fps": round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+            "overwritten": overwritten,
+            "resultsDropped": resultsDropped,
+            "profile": PROFILER.Snapshot(),
+        }))
+        ring.Close()
+
+
+def runStorage(outputPath, ringArgs, frames, stop, stats):
+    """
+    Storage process: encodes every announced frame that is still in the ring.
+    """
+    from StorageMan import StorageMan
+
+    ring = SharedFrameRing(**ringArgs)
+    height, width = ring.shape[:2]
+    frame = np.empty(ring.shape, dtype=ring.dtype)
+
+    sto = StorageMan(MessageBus(), outputPath)
+    stoThread = threading.Thread(target=sto.Launch)
+    stoThread.start()
+
+    overwritten = 0
+    try:
+        while True:
+            try:
+                record = frames.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    break
+                continue
+
+            if record is None:
+                break
+
+            # Copied out of the ring first: by the time the encoder gets to it, the slot may have been reused.
+            if not ring.Read(record[0], frame):
+                overwritten += 1
+                continue
+
+            sto.AppendFrame(frame, width, height)
+    finally:
+        sto.Compile()
+        stoThread.join()
+        stats.put(("storage", {
+            "framesWritten": sto.framesWritten,
+            "droppedFrames": sto.droppedFrames,
+            "overwritten": overwritten,
+            "segments": sto.segments,
+        }))
+        ring.Close()
+
+
+if __name__ == '__main__':
+    # Run the pipeline on the camera and display its results, until ESC is pressed.
+    import cv2
+
+    pipeline = PipelineMan(outputPath="../testData/pipeline.mp4", profile=True)
+    pipeline.Launch()
+    pipeline.SelectTarget(classID=1)
+
+    preview = np.empty(pipeline.ring.shape, dtype=pipeline.ring.dtype)
+    try:
+        while pipeline.Running():
+            records = pipeline.Results(timeout=0.1)
+            if not records:
+                continue
+
+            seq, _, success, box, _ = records[-1]
+            if pipeline.Preview(seq, preview):
+                if success:
+                    cv2.rectangle(preview, (int(box[0]), int(box[1])), (int(box[2]), int(box[3])), (0, 0, 255), 2)
+                cv2.imshow("Tracking Result", preview)
+
+            if cv2.waitKey(1) & 0xFF == 27:
+                break
+    finally:
+        print("PipelineMan  : Stats:", pipeline.Shutdown())
+        cv2.destroyAllWindows()
@@ -0,0 +1,151 @@
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from utils.Exceptions import BusClosed
+from utils.MessageBus import MessageBus, Policy, PREVIEW_FRAMES, TO_SYSTEM
+
+class PreviewMan():
+    """
+    Optional preview window, kept off the tracking loop's hot path. At most fps times per
+    second, Offer downscales the latest frame into one of two reused buffers and hands it to
+    the renderer thread (Launch), which draws the overlay and displays it. Frames offered in
+    between, or while both buffers are busy, are skipped, so the loop never waits on the GUI.
+    ESC in the window is forwarded to SystemMan as a "Terminate" message on the bus.
+    args:
+    - bus: MessageBus shared with SystemMan.
+    - fps: Maximum preview refresh rate.
+    - scale: Factor frames are downscaled by before being handed to the renderer.
+    - windowName: Title of the preview window.
+    """
+
+    NUM_BUFFERS = 2
+
+    # Seconds between GUI event polls while no frames are coming in.
+    EVENT_POLL_INTERVAL = 0.05
+
+    def __init__(self, bus, fps=10, scale=0.5, windowName="Tracking Result"):
+        self.bus = bus
+        # One frame in flight: a new one is only handed over once the renderer picked up the last one.
+        self.bus.CreateChannel(PREVIEW_FRAMES, maxsize=1, policy=Policy.BLOCK)
+
+        self.interval = 1.0 / fps
+        self.scale = scale
+        self.windowName = windowName
+        self.nextPreviewTime = 0.0
+
+        self.freeBuffers = collections.deque()
+        self.allocatedBuffers = 0
+        self.poolLock = threading.Lock()
+
+        self.framesShown = 0
+        self.framesSkipped = 0
+
+    def Offer(self, frame, bbox=None, success=True):
+        """
+        Offers the latest frame and tracking result to the preview. Cheap when the preview
+        isn't due, otherwise costs a downscale of the frame.
+        :param frame: Latest frame (not kept, the caller is free to reuse it).
+        :param bbox: Target's BoundingBox in frame coordinates, if any.
+        :param success: Whether tracking succeeded on this frame (changes the overlay's color).
+        :return: True if the frame was handed to the renderer.
+        """
+        now = time.monotonic()
+        if now < self.nextPreviewTime:
+            return False
+
+        height, width = frame.shape[:2]
+        size = (max(1, int(width * self.scale)), max(1, int(height * self.scale)))
+
+        with self.poolLock:
+            if self.freeBuffers:
+                buffer = self.freeBuffers.popleft()
+            elif self.allocatedBuffers < self.NUM_BUFFERS:
+                buffer = None
+                self.allocatedBuffers += 1
+            else:
+                self.framesSkipped += 1
+                return False
+
+        if buffer is None or buffer.shape[:2] != (size[1], size[0]) or buffer.shape[2:] != frame.shape[2:]:
+            buffer = np.empty((size[1], size[0]) + frame.shape[2:], dtype=frame.dtype)
+        cv2.resize(frame, size, dst=buffer, interpolation=cv2.INTER_NEAREST)
+
+        box = None
+        if bbox is not None:
+            (x1, y1), (x2, y2) = bbox.topLeft, bbox.bottomRight
+            box = (int(x1 * self.scale), int(y1 * self.scale), int(x2 * self.scale), int(y2 * self.scale))
+
+        if not self.bus.Publish(PREVIEW_FRAMES, (buffer, box, success), timeout=0):
+            self.releaseBuffer(buffer)
+            self.framesSkipped += 1
+            return False
+
+        self.nextPreviewTime = now + self.interval
+        return True
+
+    def Stop(self):
+        """
+        Stops the renderer thread, which then closes the preview window.
+        :return: 0 if the preview was stopped, -1 if it was already stopped.
+        """
+        return self.bus.Close(PREVIEW_FRAMES)
+
+    def Launch(self):
+        """
+        Renderer loop: draws and displays frames handed over by Offer, and polls GUI events.
+        """
+        while True:
+            try:
+                _, message = self.bus.Receive([PREVIEW_FRAMES], timeout=self.EVENT_POLL_INTERVAL)
+            except BusClosed:
+                break
+
+            if message is not None:
+                buffer, box, success = message
+                if box is not None:
+                    color = (0, 0, 255) if success else (0, 255, 255)
+                    cv2.rectangle(buffer, box[:2], box[2:], color, 2)
+
+                cv2.imshow(self.windowName, buffer)
+                self.releaseBuffer(buffer)
+                self.framesShown += 1
+
+            # Stop the program on the ESC key.
+            if cv2.waitKey(1) & 0xFF == 27:
+                self.bus.Publish(TO_SYSTEM, "Terminate", timeout=1)
+
+        cv2.destroyWindow(self.windowName)
+        print("PreviewMan   : %d frames shown, %d skipped." % (self.framesShown, self.framesSkipped))
+
+    def releaseBuffer(self, buffer):
+        with self.poolLock:
+            self.freeBuffers.append(buffer)
+
+
+if __name__ == '__main__':
+    # Preview a local video at 10 fps while "tracking" it as fast as it decodes.
+    import sys
+
+    from utils.ImageSources import LocalVideo
+
+    bus = MessageBus()
+    bus.CreateChannel(TO_SYSTEM, maxsize=8)
+    preview = PreviewMan(bus)
+    previewThread = threading.Thread(target=preview.Launch)
+    previewThread.start()
+
+    source = LocalVideo(sys.argv[1] if len(sys.argv) > 1 else "../testData/video0.mp4")
+    try:
+        while bus.Receive([TO_SYSTEM], timeout=0)[1] != "Terminate":
+            frame, _, _ = source.GetFrame()
+            preview.Offer(frame)
+    except Exception as e:
+        print("PreviewMan   : %s" % e)
+    finally:
+        source.Close()
+        preview.Stop()
+        previewThread.join()
@@ -0,0 +1,278 @@
+import argparse
+import concurrent.futures
+import functools
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import numpy as np
+
+# Footage generated by SyntheticVideo can be processed with stand-in jetson modules, which must be registered
+# before any module imports them (worker processes see the same command line, so they do it too).
+from utils import FakeJetson
+if "--fake-detector" in sys.argv:
+    FakeJetson.Install()
+
+from utils.ImageSources import LocalVideo
+from utils.Reframing import PlanChunks, TrackChunk, StitchTracks, SeedFor, CameraPath, RenderChunk
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+
+# Detectors loaded by this (worker) process, shared by all the chunks it tracks.
+detectors = {}
+
+
+def makePerception(model=None, config=None, pyramid=False):
+    """
+    Builds the PerceptionMan a chunk is tracked with (in a worker process, which is where the
+    detector's dependencies are imported).
+    """
+    from PerceptionMan import PerceptionMan
+    from utils.Detectors import JetsonDetector, DnnDetector
+
+    if (model, config) not in detectors:
+        detectors[(model, config)] = DnnDetector(model, config) if model is not None else JetsonDetector()
+
+    # Other people walking by are told apart from the subject by their looks.
+    return PerceptionMan(detector=detectors[(model, config)], pyramidTracking=pyramid, appearanceMatching=True)
+
+
+def ListVideos(paths):
+    """
+    :param paths: Video files and directories of video files.
+    :return: List of the video files.
+    """
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            videos += [os.path.join(path, name) for name in sorted(os.listdir(path))
+                       if name.lower().endswith(VIDEO_EXTENSIONS)]
+        else:
+            videos.append(path)
+    return videos
+
+
+def probeVideo(path):
+    source = LocalVideo(path)
+    try:
+        frame = source.GetFrame()[0]
+        numFrames = len(source)
+    except Exception:
+        return None
+    finally:
+        source.Close()
+
+    height, width = frame.shape[:2]
+    return {"path": path, "numFrames": numFrames, "fps": source.fps, "frameSize": (width, height)}
+
+
+def trackChunks(executor, tasks, perceptionFactory, classID):
+    """
+    Tracks chunks in the pool, longest first so the last ones to finish are short.
+    :param tasks: List of (video, chunk index, start frame, seed box or None).
+    :return: Iterator of (video, chunk index, start frame, boxes, stats), as they finish.
+    """
+    tasks = sorted(tasks, key=lambda task: task[2] - task[0]["chunks"][task[1]][1])
+    futures = {executor.submit(TrackChunk, video["path"], start, video["chunks"][k][1], perceptionFactory, classID,
+                               seedBox): (video, k, start)
+               for video, k, start, seedBox in tasks}
+
+    for future in concurrent.futures.as_completed(futures):
+        video, k, start = futures[future]
+        boxes, stats = future.result()
+        yield video, k, start, boxes, stats
+
+
+def Reframe(videos, outputDir, workers, perceptionFactory, classID=1, target=None, chunkSeconds=60, overlapSeconds=2,
+            cropScale=0.5, smoothing=1.0):
+    """
+    Reframes videos shot on a static camera around a target, spreading the work over a process pool.
+    Every video is split into overlapping chunks tracked independently (see Reframing), and the
+    chunks are rendered to segments of the output in parallel as well.
+    :param videos: Video files.
+    :param outputDir: Directory the reframed segments (<name>_reframed_000.mp4, ...) and the target's
+                      track (<name>_track.csv, frame,left,top,right,bottom rows) are written to.
+    :param workers: Number of worker processes.
+    :param perceptionFactory: Picklable callable building the PerceptionMan chunks are tracked with.
+    :param classID: Class of the target (see PerceptionMan.FindClassInDetections).
+    :param target: (left, top, right, bottom) box of the target in the first frame of the videos, the most
+                   confident detection of classID otherwise.
+    :param chunkSeconds, overlapSeconds: Length of the chunks, and how much consecutive chunks overlap.
+    :param cropScale: Size of the crop relative to the frame.
+    :param smoothing: Standard deviation (seconds) of the smoothing of the virtual camera's motion.
+    :return: Dictionary report of the run.
+    """
+    # Spawned rather than forked, like PipelineMan's processes, so workers don't inherit the parent's state.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as executor:
+        return reframeInPool(videos, outputDir, executor, workers, perceptionFactory, classID, target, chunkSeconds,
+                             overlapSeconds, cropScale, smoothing)
+
+
+def reframeInPool(videos, outputDir, executor, workers, perceptionFactory, classID, target, chunkSeconds,
+                  overlapSeconds, cropScale, smoothing):
+    """
+    Internal function running Reframe's phases (tracking, fixing up mismatched chunks, rendering) in a pool.
+    """
+    startTime = time.monotonic()
+    os.makedirs(outputDir, exist_ok=True)
+
+    jobs = []
+    for path in videos:
+        video = probeVideo(path)
+        if video is None:
+            print("Reframe      : Skipping %s, it could not be read." % path)
+            continue
+
+        video["name"] = os.path.splitext(os.path.basename(path))[0]
+        chunkFrames = max(int(chunkSeconds * video["fps"]), 3)
+        overlapFrames = min(int(overlapSeconds * video["fps"]), (chunkFrames - 1) // 2)
+        video["chunks"] = PlanChunks(video["numFrames"], chunkFrames, overlapFrames)
+        video["tracks"] = [None] * len(video["chunks"])
+        video["seeds"] = {}
+        video["resets"] = 0
+        video["retrackedChunks"] = 0
+        video["retrackedFrames"] = 0
+        jobs.append(video)
+
+    # Track every chunk independently.
+    tasks = [(video, k, video["chunks"][k][0], target if k == 0 else None)
+             for video in jobs for k in range(len(video["chunks"]))]
+    for video, k, _, boxes, stats in trackChunks(executor, tasks, perceptionFactory, classID):
+        video["tracks"][k] = boxes
+        video["resets"] += stats["resets"]
+
+    # Chunks that followed another target than the chunk before them (e.g. it started while someone else was
+    # more visible) are tracked again from where that chunk had the target, until they all agree. A chunk is
+    # only tracked again from a seed it wasn't already tracked from, so this ends.
+    rounds = 0
+    while True:
+        tasks = []
+        for video in jobs:
+            _, mismatched = StitchTracks(video["chunks"], video["tracks"])
+            for k in mismatched:
+                seed = SeedFor(video["chunks"], video["tracks"], k)
+                if seed is not None and video["seeds"].get(k) != seed:
+                    video["seeds"][k] = seed
+                    tasks.append((video, k, seed[0], seed[1]))
+
+        if not tasks:
+            break
+
+        rounds += 1
+        for video, k, start, boxes, stats in trackChunks(executor, tasks, perceptionFactory, classID):
+            chunkStart = video["chunks"][k][0]
+            video["tracks"][k] = np.concatenate([np.full((start - chunkStart, 4), np.nan, dtype=np.float32), boxes])
+            video["resets"] += stats["resets"]
+            video["retrackedChunks"] += 1
+            video["retrackedFrames"] += stats["frames"]
+
+    trackTime = time.monotonic()
+
+    # Plan the virtual camera of every video, and render each chunk (up to where the next one starts) to its own segment.
+    futures = {}
+    for video in jobs:
+        track, _ = StitchTracks(video["chunks"], video["tracks"])
+        width, height = video["frameSize"]
+        cropSize = (int(width * cropScale) // 2 * 2, int(height * cropScale) // 2 * 2)
+        centers = CameraPath(track, video["frameSize"], cropSize, smoothing * video["fps"])
+
+        with open(os.path.join(outputDir, "%s_track.csv" % video["name"]), "w") as f:
+            for index in np.flatnonzero(~np.isnan(track[:, 0])):
+                f.write("%d,%d,%d,%d,%d\n" % ((index,) + tuple(int(round(v)) for v in track[index])))
+
+        video["found"] = float((~np.isnan(track[:, 0])).mean()) if len(track) else 0.0
+        video["segments"] = []
+        starts = [start for start, _ in video["chunks"]]
+        ends = starts[1:] + [len(track)]
+        for k, (start, end) in enumerate(zip(starts, ends)):
+            segment = os.path.join(outputDir, "%s_reframed_%03d.mp4" % (video["name"], k))
+            video["segments"].append(segment)
+            futures[executor.submit(RenderChunk, video["path"], start, end, centers[start:end], cropSize, segment,
+                                    video["fps"])] = video
+
+    framesRendered = 0
+    for future in concurrent.futures.as_completed(futures):
+        framesRendered += future.result()[0]
+
+    endTime = time.monotonic()
+    totalFrames = sum(video["numFrames"] for video in jobs)
+
+    def rate(frames, seconds):
+        return round(frames / seconds, 2) if seconds > 0 else 0.0
+
+    return {
+        "videos": [{
+            "path": video["path"],
+            "frames": video["numFrames"],
+            "chunks": len(video["chunks"]),
+            "resets": video["resets"],
+            "retrackedChunks": video["retrackedChunks"],
+            "retrackedFrames": video["retrackedFrames"],
+            "targetFound": round(video["found"], 4),
+            "segments": video["segments"],
+        } for video in jobs],
+        "frames": totalFrames,
+        "framesRendered": framesRendered,
+        "fixupRounds": rounds,
+        "workers": workers,
+        "seconds": {
+            "tracking": round(trackTime - startTime, 3),
+            "rendering": round(endTime - trackTime, 3),
+            "total": round(endTime - startTime, 3),
+        },
+        "fps": {
+            "tracking": rate(totalFrames, trackTime - startTime),
+            "rendering": rate(framesRendered, endTime - trackTime),
+            "overall": rate(totalFrames, endTime - startTime),
+            "perWorker": rate(totalFrames / workers, endTime - startTime),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch reframing of footage shot on a static camera: tracks the target "
+                                                 "through every video and renders a crop panning smoothly along with it.")
+    parser.add_argument("inputs", nargs="+", help="Video files, or directories of video files.")
+    parser.add_argument("--output-dir", required=True, help="Directory the reframed videos and tracks are written to.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--chunk-seconds", type=float, default=60.0,
+                        help="Length of the chunks videos are split into, to be tracked in parallel.")
+    parser.add_argument("--overlap-seconds", type=float, default=2.0,
+                        help="How much consecutive chunks overlap, to stitch their tracks together.")
+    parser.add_argument("--crop-scale", type=float, default=0.5, help="Size of the crop relative to the frame.")
+    parser.add_argument("--smoothing", type=float, default=1.0,
+                        help="Standard deviation (seconds) of the smoothing of the crop's motion.")
+    parser.add_argument("--class-id", type=int, default=1, help="Class of the target (1 is person).")
+    parser.add_argument("--target", type=float, nargs=4, metavar=("LEFT", "TOP", "RIGHT", "BOTTOM"),
+                        help="Box of the target in the first frame of the videos (the most confident detection otherwise).")
+    parser.add_argument("--model", help="Run detection with DnnDetector on this model instead of detectNet.")
+    parser.add_argument("--config", help="Config file for --model, if its format needs one.")
+    parser.add_argument("--pyramid", action="store_true",
+                        help="Track on a grayscale pyramid level picked by the target's size (see PerceptionMan).")
+    parser.add_argument("--fake-detector", action="store_true",
+                        help="Use the stand-in detectNet (see FakeJetson), for footage generated by SyntheticVideo.")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+
+    videos = ListVideos(args.inputs)
+    perceptionFactory = functools.partial(makePerception, args.model, args.config, args.pyramid)
+
+    target = tuple(args.target) if args.target is not None else None
+    results = Reframe(videos, args.output_dir, args.workers, perceptionFactory, classID=args.class_id, target=target,
+                      chunkSeconds=args.chunk_seconds, overlapSeconds=args.overlap_seconds, cropScale=args.crop_scale,
+                      smoothing=args.smoothing)
+
+    results["config"] = {k: v for k, v in vars(args).items() if k != "output"}
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,174 @@
-import queue
+import collections
+import threading
+import cv2
 import numpy as np
 import os
-from os.path import isfile, join
+
+from utils.Exceptions import BusClosed
+from utils.MessageBus import Policy, STORAGE_FRAMES, STORAGE_COMPILE
+from utils.Profiler import PROFILER
 
 class StorageMan():
+    """
+    Storage subsystem that streams frames into video files while filming.
+    Frames are copied into a fixed pool of buffers and handed to the encoder
+    thread (Launch), which writes them incrementally with cv2.VideoWriter. Output
+    is split into segment files once a segment reaches a size or duration limit,
+    so memory use stays flat no matter how long the take runs.
+    args:
+    - bus: MessageBus shared with SystemMan.
+    - outputPath: Base path of the take, segments are saved as <base>_000<ext>, <base>_001<ext>...
+    - fps: Frame rate of the output video.
+    - maxSegmentBytes: Roll over to a new segment once the current file reaches this size.
+    - maxSegmentSeconds: Roll over to a new segment once the current one reaches this duration.
+    - poolSize: Number of frames that can be waiting to be encoded before new ones are dropped.
+    """
+
+    # Number of frames between output file size checks.
+    SIZE_CHECK_FREQ = 30
 
-    def __init__(self):
-        self.frames = []
-        self.recvFrameQ = queue.Queue(maxsize=1)
-        self.compileQ = queue.Queue(maxsize=1)
+    def __init__(self, bus, outputPath, fps=30, maxSegmentBytes=512 * 1024 * 1024, maxSegmentSeconds=300, poolSize=8):
+        self.bus = bus
+        self.bus.CreateChannel(STORAGE_FRAMES, maxsize=poolSize, policy=Policy.BLOCK)
+        self.bus.CreateChannel(STORAGE_COMPILE, maxsize=1, policy=Policy.BLOCK)
+
+        self.outputPath = outputPath
+        self.fps = fps
+        self.maxSegmentBytes = maxSegmentBytes
+        self.maxSegmentFrames = int(maxSegmentSeconds * fps)
         self.width = -1
         self.height = -1
 
+        # Free frame buffers (allocated lazily on the first frame, then reused).
+        self.poolSize = poolSize
+        self.freeBuffers = collections.deque()
+        self.allocatedBuffers = 0
+        self.poolLock = threading.Lock()
+
+        # Encoder only takes 3 channel frames, BGRx frames are converted into this buffer.
+        self.bgrBuffer = None
+
+        self.writer = None
+        self.segments = []
+        self.segmentFrames = 0
+        self.framesWritten = 0
+        self.droppedFrames = 0
+
     def AppendFrame(self, frame, frame_width, frame_height):
-        self.recvFrameQ.put((frame, frame_width, frame_height))
+        """
+        Queues a frame to be encoded without blocking the caller. The frame is copied,
+        so the caller is free to reuse or draw on it afterwards.
+        :return: True if the frame was queued, False if it was dropped because the encoder is behind.
+        """
+        with self.poolLock:
+            if self.freeBuffers:
+                buffer = self.freeBuffers.popleft()
+            elif self.allocatedBuffers < self.poolSize:
+                buffer = np.empty_like(frame)
+                self.allocatedBuffers += 1
+            else:
+                self.droppedFrames += 1
+                return False
+
+        with PROFILER.Stage("store"):
+            if buffer.shape != frame.shape:
+                buffer = np.empty_like(frame)
+            np.copyto(buffer, frame)
 
-    def Compile(self, outputPath, fps):
-        self.compileQ.put((outputPath, fps))
+        # Never blocks for long since the pool bounds how many frames can be in the channel.
+        if not self.bus.Publish(STORAGE_FRAMES, (buffer, frame_width, frame_height), timeout=1):
+            self.releaseBuffer(buffer)
+            self.droppedFrames += 1
+            return False
+
+        return True
+
+    def Compile(self):
+        """
+        Signals the encoder to finalize the take once queued frames are written.
+        Only the current segment has to be closed, so this takes constant time
+        regardless of the length of the take.
+        """
+        self.bus.Publish(STORAGE_COMPILE, self.outputPath)
 
     def Launch(self):
         """
-        Launches the Storage Manager. Loop will repeatedly listen to concurrent
-        frame insertions. When a compile command is given, 
+        Launches the Storage Manager's encoder loop. Loop will sleep until frames are
+        inserted concurrently and writes them out as they arrive. When a compile command
+        is given, pending frames are written and the take is finalized.
         """
-        while self.compileQ.empty():
-            if not self.recvFrameQ.empty():
-                frame, self.width, self.height = self.recvFrameQ.get()
-                self.frames.append(frame)
-                print("StorageMan   : Frame received and stored.")
+        while True:
+            try:
+                # Frames are checked first so that none are lost when compile is requested.
+                channel, message = self.bus.Receive([STORAGE_FRAMES, STORAGE_COMPILE])
+            except BusClosed:
+                print("StorageMan   : Bus closed before compile was requested.")
+                break
+
+            if channel == STORAGE_COMPILE:
+                break
 
-        opPath = self.compileInternal()
-        print("StorageMan   : Frames compiled and output saved at: %s" % opPath)
+            frame, self.width, self.height = message
+            with PROFILER.Stage("encode"):
+                self.writeFrame(frame)
+            self.releaseBuffer(frame)
+
+        segments = self.compileInternal()
+        print("StorageMan   : %d frames compiled (%d dropped) and output saved at: %s"
+              % (self.framesWritten, self.droppedFrames, segments))
 
     def compileInternal(self):
-        outputPath, fps = self.compileQ.get()
+        self.closeSegment()
+
+        return self.segments
+
+    def writeFrame(self, frame):
+        """
+        Internal function for encoding a single frame, rolling over to a new segment if needed.
+        """
+        if self.writer is not None and self.segmentFull():
+            self.closeSegment()
+
+        if self.writer is None:
+            self.openSegment()
+
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            if self.bgrBuffer is None or self.bgrBuffer.shape[:2] != frame.shape[:2]:
+                self.bgrBuffer = np.empty(frame.shape[:2] + (3,), dtype=frame.dtype)
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR, dst=self.bgrBuffer)
+
+        self.writer.write(frame)
+        self.segmentFrames += 1
+        self.framesWritten += 1
+
+    def segmentFull(self):
+        if self.segmentFrames >= self.maxSegmentFrames:
+            return True
+
+        # Checking the file size is a syscall, so only do it every so often.
+        if self.segmentFrames % self.SIZE_CHECK_FREQ == 0:
+            try:
+                return os.path.getsize(self.segments[-1]) >= self.maxSegmentBytes
+            except OSError:
+                return False
+
+        return False
+
+    def openSegment(self):
+        base, ext = os.path.splitext(self.outputPath)
+        path = "%s_%03d%s" % (base, len(self.segments), ext or ".mp4")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (self.width, self.height))
+        self.segments.append(path)
+        self.segmentFrames = 0
 
-        # # [WIP] For bringing together frames and saving video [Saved for later date once MVP reached]
-        # output = cv2.VideoWriter(outputPath, cv2.VideoWriter_fourcc(*'DIVX'), fps, (width, height))
-        # for frame in range(len(self.frames)):
-        #     output.write(frame)
-        # output.release()
-        
-        return outputPath
+    def closeSegment(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
 
+    def releaseBuffer(self, buffer):
+        with self.poolLock:
+            self.freeBuffers.append(buffer)
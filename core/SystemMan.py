@@ -1,43 +1,92 @@
-import queue
+import re
 import threading
 import time
-import cv2
 import sys
 
 import utils.Exceptions as newExceptions
-from utils.PerceptionUtils import BoundingBox
+from utils.FrameGovernor import FrameGovernor, Mode
 from utils.ImageSources import ImageSource
+from utils.MessageBus import MessageBus, TO_SYSTEM
+from utils.PerceptionUtils import BoundingBox
+from utils.Profiler import PROFILER
+from utils.SessionRecorder import SessionRecorder, MESSAGE, DETECTIONS, TRACK
+from utils.WireProtocol import Telemetry
 
 from CommsMan import CommsMan
 from StorageMan import StorageMan
 from MotorMan import MotorMan
 from CameraMan import CameraMan
 from PerceptionMan import PerceptionMan
+from PreviewMan import PreviewMan
+
+# Target selected on the remote interface, as a "left;top;right;bottom" string.
+BBOX_MSG = re.compile(r"\s*-?\d+\s*(;\s*-?\d+\s*){3}")
 
 
 class SystemMan():
+    """
+    args:
+    - profile: Whether to collect stage latencies and per-frame traces (see Profiler), which the
+      remote interface can request with a "Status" message.
+    - preview: Whether to show a preview window of the tracking results (see PreviewMan). Without
+      it the system runs headless, with no GUI calls at all.
+    - previewFps, previewScale: Refresh rate and downscaling factor of the preview.
+    - transport: Link to the remote interface (see CommsMan and Transports).
+    - frameBudget: Seconds from capture each frame should be processed within. When set, frames that
+      would miss it are extrapolated or skipped instead of tracked (see FrameGovernor); by default
+      every frame is tracked, however late.
+    - recordPath: Session file the captured frames, messages from the remote interface, detections and
+      tracking results are recorded to, to be replayed later (see SessionRecorder and ReplaySource).
+      Nothing is recorded by default.
+    - highResDetection: Whether the camera captures at its full resolution, tracking running on a downscaled
+      stream of it as usual while detection runs in tiles of the full resolution frames (see PerceptionMan's
+      tiledDetection), to find distant subjects too small to be detected at the tracking resolution.
+    - servoPort: Serial device of the pan/tilt servo controller the motor commands are sent to (see MotorMan and
+      ServoScheduler). Commands are only computed by default.
+    - appearanceMatching: Whether resets re-acquire the target by its looks among other people (see PerceptionMan's
+      appearanceMatching), rather than only by where it should be.
+    - motionGating: Whether the tracker rests on frames where nothing moves around the target (see MotionGate and
+      PerceptionMan's motionGating), which spares it while the target stands still.
+    """
+
+    def __init__(self, profile=False, preview=False, previewFps=10, previewScale=0.5, transport=None, frameBudget=None,
+                 recordPath=None, highResDetection=False, servoPort=None, appearanceMatching=False,
+                 motionGating=False):
+        PROFILER.enabled = profile
 
-    def __init__(self):
         self.running = True
         self.inFrame = False
+        self.framesTracked = 0
         self.currVideo = 0
-        self.framesSinceReset = -1
+
+        self.recorder = SessionRecorder(recordPath) if recordPath is not None else None
 
         # Instantiate sequential subsystems
-        self.per = PerceptionMan()
-        self.cam = CameraMan(onlyDetect=False)
-        self.mot = MotorMan()
+        self.per = PerceptionMan(appearanceMatching=appearanceMatching, recorder=self.recorder,
+                                 tiledDetection=highResDetection, motionGating=motionGating)
+        self.cam = CameraMan(onlyDetect=False, threaded=True, trackingSize=(1280, 720) if highResDetection else None)
+        self.mot = MotorMan(servoPort=servoPort)
+        self.governor = FrameGovernor(budget=frameBudget) if frameBudget is not None else None
+
+        # Blocking message bus shared by the threaded managers.
+        self.bus = MessageBus()
 
         # Instantiate and launch in threads: CommsMan, StorageMan
-        self.comQ, self.comT = queue.Queue(maxsize=1), queue.Queue(maxsize=1)
-        self.com = CommsMan(self.comQ, self.comT)
+        self.com = CommsMan(self.bus, transport=transport)
         self.comThread = threading.Thread(target=(self.com.Launch))
         self.comThread.start()
 
-        self.sto = StorageMan()
+        self.sto = StorageMan(self.bus, self.videoPath())
         self.stoThread = threading.Thread(target=(self.sto.Launch))
         self.stoThread.start()
 
+        # Optional preview window, rendered in its own thread.
+        self.pre = None
+        if preview:
+            self.pre = PreviewMan(self.bus, fps=previewFps, scale=previewScale)
+            self.preThread = threading.Thread(target=(self.pre.Launch))
+            self.preThread.start()
+
     def SendMessageToRemote(self, message):
         """
         API for indicating to SystemMan to send a message to the remote interface.
@@ -59,23 +108,71 @@ class SystemMan():
         """
         return self.com.SimulateLogBluetooth()
 
+    def GetBusStats(self):
+        """
+        API for retrieving per-channel depth and wait-time statistics of the message bus.
+        :return: Dictionary mapping channel names to their statistics.
+        """
+        return self.bus.Stats()
+
+    def GetProfile(self):
+        """
+        API for retrieving a snapshot of the pipeline's stage latencies and most recent frame traces.
+        :return: Dictionary (see Profiler.Snapshot).
+        """
+        return PROFILER.Snapshot()
+
+    def GetGovernorStats(self):
+        """
+        API for retrieving the frame governor's deadline misses and skip ratios.
+        :return: Dictionary (see FrameGovernor.Stats), None if frames aren't governed.
+        """
+        return self.governor.Stats() if self.governor is not None else None
+
+    def GetMotionGateStats(self):
+        """
+        API for retrieving how many frames the motion gate held instead of tracking.
+        :return: Dictionary (see MotionGate.Stats), None if frames aren't gated.
+        """
+        return self.per.motionGate.Stats() if self.per.motionGate is not None else None
+
+    def GetConversionStats(self):
+        """
+        API for retrieving how many RGBA buffers were allocated and frames converted for the object detection network.
+        :return: Dictionary (see RGBAPool.Stats).
+        """
+        return ImageSource.rgbaPool.Stats()
+
+    def GetServoStats(self):
+        """
+        API for retrieving the servo commands sent, coalesced and timed out, and their latency to acknowledgement.
+        :return: Dictionary (see ServoScheduler.Stats), None without servos.
+        """
+        return self.mot.GetServoStats()
+
     def SHUTDOWN(self):
         """
         API for signaling entire system to shut down (including all threads for CSM modules).
         """
         self.SimulateReceiveBT("Terminate")
 
+    def videoPath(self):
+        return "../testData/video%d.mp4" % self.currVideo
+
     def compileFrames(self):
-        self.sto.Compile("../testData/video%d.mp4" % self.currVideo, 30)
+        self.sto.Compile()
         self.stoThread.join()
 
         self.currVideo += 1
 
     def restartNewVideoStorage(self):
-        self.sto = StorageMan()
-        self.stoThread = threading.Thread(target=(self.sto.launch))
+        self.sto = StorageMan(self.bus, self.videoPath())
+        self.stoThread = threading.Thread(target=(self.sto.Launch))
         self.stoThread.start()
 
+    def isBoundingBoxMsg(self, msg):
+        return isinstance(msg, BoundingBox) or (isinstance(msg, str) and BBOX_MSG.fullmatch(msg) is not None)
+
     def parseMsgForBoundingBox(self, msg):
         a = msg.split(";")
         l,t,r,b = int(a[0]), int(a[1]), int(a[2]), int(a[3])
@@ -89,18 +186,26 @@ class SystemMan():
 
         while self.running:
 
-            if not self.comQ.empty():
-                # Pull and process message from CommsMan
-                msg = self.comQ.get()
+            # While idle, sleep until CommsMan forwards a message. While filming, only poll
+            # so that tracking keeps running at full rate.
+            _, msg = self.bus.Receive([TO_SYSTEM], timeout=0 if self.inFrame else None)
 
+            if msg is not None:
+                # Process message from CommsMan
                 print("Main         : received message: %s" % msg)
-
-                # TODO(@Ike): Gracefully handle unknown/invalid messages without crashing
+                if self.recorder is not None:
+                    self.recorder.Record(MESSAGE, msg)
 
                 # Shut down the system
                 if (msg == "Terminate"):
                     break
 
+                # Report pipeline latencies to the remote interface
+                elif (msg == "Status"):
+                    self.SendMessageToRemote(PROFILER.StatusMessage())
+                    if self.governor is not None:
+                        self.SendMessageToRemote(self.governor.StatusMessage())
+
                 # Stop filming current target and compile footage
                 elif (msg == "Finish"):
                     if self.inFrame:
@@ -120,14 +225,18 @@ class SystemMan():
                     # they can select a target.
                     # Note: For info on the detections list returned from detectObjects, see jetson.inference.detectNet.Detection
                     # from here https://rawgit.com/dusty-nv/jetson-inference/python/docs/html/python/jetson.inference.html#detectNet
-                    frame, width, height = self.cam.Capture()
+                    frame, width, height, captureTime, _ = self.cam.Capture()
 
-                    # Transform image into RGBA space and place into a cuda container since object detection model expects it.
-                    cudaImg = ImageSource.rgb2crgba(frame)
-                    detections, _ = self.per.DetectObjects(cudaImg, width, height)
+                    # Transform image into the detector's input format (RGBA cuda container for the Jetson backend),
+                    # at the camera's full resolution when detecting in tiles.
+                    detections, _ = self.per.DetectObjects(self.per.PrepareFrame(self.cam.HighResFrame()), width, height)
+                    if self.recorder is not None:
+                        self.recorder.RecordFrame(frame, captureTime)
+                        self.recorder.Record(DETECTIONS, detections)
 
-                    # TODO(@Ike - once iOS working): Send {detections, frame, width, height} to Remote Interface
-                    pass
+                    # Send the frame and detections to the remote interface for the user to pick a target.
+                    self.com.SendPreview(frame, keyframe=True)
+                    self.com.SendDetections(detections)
 
                     # Since the remote interface isn't set up yet, this part simulates choosing one of the bounding boxes returned
                     # from object detection (the classID is set manually here, assuming that the target is a human)
@@ -138,62 +247,101 @@ class SystemMan():
                     self.SimulateReceiveBT(receivedSimStr)
 
                 # Specific target selected, msg contains information about selected target
-                else:
+                elif self.isBoundingBoxMsg(msg):
                     self.inFrame = True
 
                     # Parse message from remote interface into initial, user-selected bounding box
-                    initialBbox = self.parseMsgForBoundingBox(msg)
+                    # (the binary protocol already delivers it as one).
+                    initialBbox = msg if isinstance(msg, BoundingBox) else self.parseMsgForBoundingBox(msg)
 
                     # Now that we have a bounding box returned from the "remote interface", we can initialize the
                     # tracker using said bounding box.
                     # Note: Here, we assume that the target hasn't moved from its original location since we are using that same
                     # bounding box.
-                    frame, width, height = self.cam.Capture()
+                    frame, width, height, captureTime, _ = self.cam.Capture()
                     self.per.InitTracker(frame, initialBbox)
+                    if self.recorder is not None:
+                        self.recorder.RecordFrame(frame, captureTime)
 
-                    self.framesSinceReset = 0
+                # Unknown command or garbled target, the state is left as it is.
+                else:
+                    print("Main         : Ignoring invalid message: %s" % (msg,))
 
             # Main Tracking Code: Target already selected - iterate & adjust motors
             elif self.inFrame:
                 # Request frame from CameraMan
-                frame, frame_width, frame_height = self.cam.Capture()
-
-                if self.framesSinceReset == self.per.RESET_TRACKER_FREQ:
-                    # Reset tracker every n frames using object detection since it accumulates error over time
-                    # Note: There can only be one human present per frame in this case
-                    self.per.ResetTracker(frame, width, height, classID=1)
-                    self.framesSinceReset = 0
+                frame, frame_width, frame_height, captureTime, droppedFrames = self.cam.Capture()
+                if self.recorder is not None:
+                    self.recorder.RecordFrame(frame, captureTime)
+
+                # Decide how much work the frame gets given how late it already is.
+                mode = self.governor.Decide(captureTime) if self.governor is not None else Mode.TRACK
+
+                # Nothing moves around the target: its box is kept, and resets wait, until something does.
+                if mode == Mode.TRACK and self.per.TargetStatic(frame):
+                    mode = Mode.HOLD
+                    if self.governor is not None:
+                        self.governor.Downgrade(mode)
+
+                if mode == Mode.HOLD:
+                    success, opticalFlow, newBbox = self.per.HoldObjectInNewFrame(frame)
+                elif mode == Mode.TRACK:
+                    # Track previously defined object in latest frame.
+                    success, opticalFlow, newBbox = self.per.TrackObjectInNewFrame(frame)
+
+                    if success and self.per.ResetDue():
+                        # Reset tracker using object detection since it accumulates error over time (more often when
+                        # tracking quality drops). Detection runs in the background and is merged into the tracker a few
+                        # frames later. Requested after tracking so the snapshot and the tracker's bbox match.
+                        self.per.RequestReset(frame, frame_width, frame_height, classID=1,
+                                              detectionFrame=self.cam.HighResFrame())
+                else:
+                    # Behind schedule: extrapolate the target's box so motors and footage keep their cadence.
+                    success, opticalFlow, newBbox = self.per.PredictObjectInNewFrame()
 
-                # Track previously defined object in latest frame.
-                success, opticalFlow, newBbox = self.per.TrackObjectInNewFrame(frame)
-                self.framesSinceReset += 1
+                # Stream the raw frame to StorageMan's encoder (copied, since the capture thread reuses its slots).
+                self.sto.AppendFrame(frame, frame_width, frame_height)
 
                 if success:
-                    # We can use the opticalFlow here (x, y) and send it to the motors.
-                    # For now, we draw the latest bbox and print out the optical flow.
-                    cv2.rectangle(frame, newBbox.topLeft, newBbox.bottomRight, (0, 0, 255), 2)
-                    print(opticalFlow)
+                    # Steer the motors towards where the target will be once the command takes effect.
+                    deltaTilt, deltaTurn = self.mot.ProcessOpticalFlowCommand(opticalFlow, newBbox, captureTime)
+                    PROFILER.EndTrace("glass_to_motor")
                 else:
                     # There was a tracking error, we need to handle it by resetting the tracker using
-                    # object detection.
-                    self.per.ResetTracker(frame, width, height, classID=1)
+                    # object detection (no-op if a background reset is already in progress).
+                    self.per.RequestReset(frame, frame_width, frame_height, classID=1,
+                                          detectionFrame=self.cam.HighResFrame())
+                    deltaTilt, deltaTurn = 0, 0
 
-                # TODO(@Ike): Send frame data to StorageMan (@Diego should we leave storage for post-demo2? I say ay)
-                # self.sto.appendFrame(frame, frame_width, frame_height)
+                self.framesTracked += 1
+                if self.recorder is not None:
+                    self.recorder.Record(TRACK, Telemetry(self.framesTracked, newBbox, deltaTilt, deltaTurn,
+                                                          self.per.trackingQuality, success))
 
-                # For testing purposes, display the results on a window.
-                cv2.imshow("Tracking Result", frame)
+                if mode == Mode.SKIP:
+                    self.governor.Finish(captureTime)
+                    continue
 
-                # Processor yield time (in ms) to allow for multitasking.
-                keyCode = cv2.waitKey(1)
+                # Keep the remote interface up to date (coalesced by CommsMan to what the link can carry).
+                self.com.SendTelemetry(self.framesTracked, newBbox, deltaTilt, deltaTurn, self.per.trackingQuality, success)
+                self.com.SendPreview(frame)
 
-                # Stop the program on the ESC key
-                if keyCode & 0xFF == 27:
-                    break
+                # Hand the results to the preview (ESC in its window comes back as a "Terminate" message).
+                if self.pre is not None:
+                    self.pre.Offer(frame, newBbox, success)
+
+                if self.governor is not None:
+                    self.governor.Finish(captureTime)
 
         # Destroy/deallocate resources
         self.cam.Release()
-        cv2.destroyAllWindows()
+        self.per.Release()
+        self.mot.Release()
+        if self.recorder is not None:
+            self.recorder.Close()
+        if self.pre is not None:
+            self.pre.Stop()
+            self.preThread.join()
 
         # Terminate CommsMan & rejoin thread.
         if (self.com.TerminateCommsMan() == -1):
@@ -205,7 +353,7 @@ class SystemMan():
 
 if __name__ == '__main__':
     # Test SystemMan interactions
-    system = SystemMan()
+    system = SystemMan(preview=True)
     sysThread = threading.Thread(target=system.Launch)
     sysThread.start()
 
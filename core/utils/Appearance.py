@@ -0,0 +1,129 @@
+import cv2
+import numpy as np
+
+
+class AppearanceModel:
+    """
+    Compact appearance signature of the tracked target (a hue-saturation histogram of its bbox,
+    weighted towards the bbox's center), used to tell it apart from other objects of the same
+    class when the tracker has to be reset.
+    Boxes are sampled on a fixed grid of patchSize points whatever their size, so building a
+    signature costs the same for any target, and scoring several candidate boxes is done in one
+    pass over all of them. The signature is refreshed while tracking is confident, at most every
+    interval frames, blending in new observations so it follows gradual changes (lighting, pose).
+    Observations that don't look like the signature are not blended in, and tell that the tracker
+    probably latched onto something else (e.g. someone walking in front of the target).
+    args:
+    - bins: (hue, saturation) histogram bins.
+    - patchSize: (width, height) grid each box is sampled on.
+    - decay: Weight of a new observation when refreshing the signature.
+    - minQuality: Tracking quality (see ResetScheduler.TrackingQuality) needed to refresh the signature.
+    - interval: Min frames between two refreshes.
+    - minSimilarity: Similarity to the signature under which an observation is considered to be of something else.
+    """
+
+    def __init__(self, bins=(16, 8), patchSize=(24, 48), decay=0.1, minQuality=0.6, interval=5, minSimilarity=0.5):
+        self.hueBins, self.satBins = bins
+        self.numBins = self.hueBins * self.satBins
+        self.patchSize = patchSize
+        self.decay = decay
+        self.minQuality = minQuality
+        self.interval = interval
+        self.minSimilarity = minSimilarity
+
+        # Pixels near the bbox's edges are mostly background, they count for less.
+        width, height = patchSize
+        u = (np.arange(width) + 0.5) / width * 2 - 1
+        v = (np.arange(height) + 0.5) / height * 2 - 1
+        self.weights = np.clip(1 - (u[None, :] ** 2 + v[:, None] ** 2), 0.05, None).astype(np.float32).ravel()
+
+        self.signature = None
+        self.framesSinceUpdate = 0
+        self.mismatched = False
+
+        # Statistics
+        self.updates = 0
+        self.mismatches = 0
+
+
+    def Reset(self, frame, bbox):
+        """
+        Starts a new signature from the target's bbox (e.g. when the user selects a target).
+        """
+        self.signature = self.histograms(frame, [bbox.topLeft + bbox.bottomRight])[0]
+        self.framesSinceUpdate = 0
+        self.mismatched = False
+        self.updates += 1
+
+
+    def Update(self, frame, bbox, quality):
+        """
+        Compares the tracked bbox with the signature, at most every interval frames (every frame
+        after a mismatch, until the target is found again), and blends it into the signature if
+        tracking is confident and it looks like the target.
+        :param frame: Frame the target was tracked in.
+        :param bbox: Target's BoundingBox in that frame.
+        :param quality: Tracking quality of that frame.
+        :return: Similarity of the bbox to the signature, None if it wasn't checked on this frame.
+        """
+        self.framesSinceUpdate += 1
+        if self.signature is None or (self.framesSinceUpdate < self.interval and not self.mismatched):
+            return None
+
+        observed = self.histograms(frame, [bbox.topLeft + bbox.bottomRight])[0]
+        similarity = float(np.sqrt(observed * self.signature).sum())
+        self.framesSinceUpdate = 0
+
+        self.mismatched = similarity < self.minSimilarity
+        if self.mismatched:
+            self.mismatches += 1
+        elif quality >= self.minQuality:
+            # Replaced rather than updated in place, a reset worker may be reading it.
+            self.signature = (1 - self.decay) * self.signature + self.decay * observed
+            self.updates += 1
+
+        return similarity
+
+
+    def Similarity(self, frame, boxes):
+        """
+        Scores how much every box looks like the target.
+        :param frame: Frame the boxes are in.
+        :param boxes: (N, 4) array of (left, top, right, bottom) boxes.
+        :return: Array of N similarities (Bhattacharyya coefficient, 0 to 1), None if there is no signature yet.
+        """
+        signature = self.signature
+        if signature is None:
+            return None
+
+        return np.sqrt(self.histograms(frame, boxes) * signature).sum(axis=1)
+
+
+    def histograms(self, frame, boxes):
+        """
+        Internal function computing the normalized weighted histograms of a set of boxes.
+        :return: (N, numBins) array.
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        numBoxes = len(boxes)
+        width, height = self.patchSize
+        frameH, frameW = frame.shape[:2]
+
+        # Sample every box on the same grid at once (nearest pixel, enough for a histogram).
+        u = (np.arange(width, dtype=np.float32) + 0.5) / width
+        v = (np.arange(height, dtype=np.float32) + 0.5) / height
+        xs = boxes[:, 0:1] + u[None, :] * (boxes[:, 2:3] - boxes[:, 0:1])
+        ys = boxes[:, 1:2] + v[None, :] * (boxes[:, 3:4] - boxes[:, 1:2])
+        xs = np.clip(xs, 0, frameW - 1).astype(np.intp)
+        ys = np.clip(ys, 0, frameH - 1).astype(np.intp)
+        patches = frame[ys[:, :, None], xs[:, None, :], :3]
+
+        hsv = cv2.cvtColor(patches.reshape(numBoxes * height, width, 3), cv2.COLOR_BGR2HSV)
+        hue = hsv[..., 0].astype(np.intp) * self.hueBins // 180
+        sat = hsv[..., 1].astype(np.intp) * self.satBins // 256
+        bins = (hue * self.satBins + sat).reshape(numBoxes, -1) + np.arange(numBoxes)[:, None] * self.numBins
+
+        hists = np.bincount(bins.ravel(), weights=np.tile(self.weights, numBoxes),
+                            minlength=numBoxes * self.numBins).reshape(numBoxes, self.numBins)
+
+        return hists / np.maximum(hists.sum(axis=1, keepdims=True), 1e-6)
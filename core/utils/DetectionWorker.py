@@ -0,0 +1,130 @@
+import threading
+
+
+class DetectionWorker:
+    """
+    Background worker that runs object detection on a snapshot frame off of the
+    main tracking loop. Only one request can be in flight at a time: the caller
+    submits a snapshot, keeps tracking at full rate and polls for the result
+    once it is ready. Requests made obsolete (e.g. by a new target) can be
+    cancelled, their results are then never handed out. Since requests only
+    come from the caller, a caller that waited for the worker (see Wait) has
+    it idle until its next request, e.g. to use what detectFn uses itself.
+    args:
+    - detectFn: Callable run in the worker thread with the submitted arguments.
+    """
+
+    def __init__(self, detectFn):
+        self.detectFn = detectFn
+
+        self.cond = threading.Condition()
+        self.request = None
+        self.result = None
+        self.busy = False
+        self.running = True
+
+        # Incremented by Cancel, results of requests submitted before it are dropped.
+        self.generation = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def Submit(self, *args):
+        """
+        Hands a new detection request to the worker without blocking.
+        :param args: Arguments forwarded to detectFn (the snapshot frame and its metadata).
+        :return: True if the request was accepted, False if one is already in flight.
+        """
+        with self.cond:
+            if not self.running or self.busy:
+                return False
+
+            self.busy = True
+            self.request = (self.generation, args)
+            self.cond.notify_all()
+
+        return True
+
+
+    def Poll(self):
+        """
+        Retrieves the result of the last finished request, if any.
+        :return: Whatever detectFn returned, or None if no new result is available.
+        """
+        with self.cond:
+            result = self.result
+            self.result = None
+
+        return result
+
+
+    def Cancel(self):
+        """
+        Drops the pending request and result, if any. A request already being processed runs to completion
+        (the worker stays busy until then) but its result is discarded.
+        """
+        with self.cond:
+            self.generation += 1
+            self.result = None
+            if self.request is not None:
+                self.request = None
+                self.busy = False
+                self.cond.notify_all()
+
+
+    def Wait(self):
+        """
+        Blocks until the request in flight, if any, has been processed. No-op when called from detectFn itself.
+        """
+        if threading.current_thread() is self.thread:
+            return
+
+        with self.cond:
+            while self.running and self.busy:
+                self.cond.wait()
+
+
+    def IsBusy(self):
+        """
+        :return: True while a request is queued or being processed.
+        """
+        with self.cond:
+            return self.busy
+
+
+    def Stop(self):
+        """
+        Signals the worker thread to terminate and waits for it to finish.
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+        self.thread.join()
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and self.request is None:
+                    self.cond.wait()
+
+                if not self.running:
+                    return
+
+                generation, args = self.request
+                self.request = None
+
+            # Detection runs outside of the lock so Poll and Submit never wait on it.
+            try:
+                result = self.detectFn(*args)
+            except Exception as e:
+                print("DetectWorker : Detection failed: %s" % e)
+                result = None
+
+            with self.cond:
+                if generation == self.generation:
+                    self.result = result
+                self.busy = False
+                self.cond.notify_all()
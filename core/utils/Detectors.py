@@ -0,0 +1,159 @@
+try:
+    import jetson.inference
+except ImportError:
+    # Not running on a Jetson, only the CPU backends are available.
+    jetson = None
+
+import cv2
+import numpy as np
+
+from utils.ImageSources import ImageSource
+from utils.PerceptionUtils import Detections
+
+
+class Detector:
+    """
+    Base class definition/interface for an object detection backend.
+    All backends return Detections (see PerceptionUtils) in the coordinates of the image
+    passed in, with class IDs from the COCO label map used by ssd-mobilenet-v2 (e.g. 1 is
+    a person), so callers can't tell which one is running.
+    """
+
+    def Prepare(self, frame):
+        """
+        Transforms a frame from an image source into the input the backend expects.
+        args:
+            - frame: Frame in BGR (or BGRx) space as returned by an ImageSource.
+        returns: Backend specific image to pass to Detect.
+        """
+        raise NotImplementedError
+
+
+    def Detect(self, image, width, height):
+        """
+        Detects objects in a single prepared image.
+        args:
+            - image: Image returned by Prepare.
+            - width, height: Dimensions of the image.
+        returns: Detections found in the image.
+        """
+        raise NotImplementedError
+
+
+    def DetectBatch(self, frames):
+        """
+        Detects objects in several frames. Backends that can run a batch through the
+        network in a single call override this, the default runs frames one by one.
+        args:
+            - frames: List of frames in BGR (or BGRx) space.
+        returns: List with the Detections of each frame.
+        """
+        results = []
+
+        for frame in frames:
+            height, width = frame.shape[:2]
+            results.append(self.Detect(self.Prepare(frame), width, height))
+
+        return results
+
+
+class JetsonDetector(Detector):
+    """
+    Detection backend running jetson.inference.detectNet on the Jetson's GPU.
+    args:
+    - network: Pre-trained network to use for object detection (ssd-mobilenet-v2 by default).
+    - threshold: Minimum confidence threshold to qualify as a detected object.
+    """
+
+    def __init__(self, network='ssd-mobilenet-v2', threshold=0.5):
+        if jetson is None:
+            raise ImportError('jetson.inference is required for the JetsonDetector backend')
+
+        self.net = jetson.inference.detectNet(network=network, threshold=threshold)
+
+
+    def Prepare(self, frame):
+        # Network expects an RGBA image inside a cuda memory capsule.
+        return ImageSource.rgb2crgba(frame)
+
+
+    def Detect(self, image, width, height):
+        detections = self.net.Detect(image, width, height)
+
+        return Detections.FromRecords(detections)
+
+
+class DnnDetector(Detector):
+    """
+    CPU detection backend running an SSD-MobileNet-style model through OpenCV's DNN module
+    (e.g. the TensorFlow ssd_mobilenet_v2_coco graph, or an ONNX export of it). The model
+    must end in an SSD DetectionOutput layer, producing rows of
+    [batchId, classId, confidence, left, top, right, bottom] with normalized coordinates.
+    args:
+    - model: Path to the model weights (.pb, .onnx, ...).
+    - config: Path to the model config (.pbtxt), if the format needs one.
+    - threshold: Minimum confidence threshold to qualify as a detected object.
+    - inputSize: (width, height) the network expects.
+    - scale, mean, swapRB: Input normalization (see cv2.dnn.blobFromImage).
+    """
+
+    def __init__(self, model, config=None, threshold=0.5, inputSize=(300, 300),
+                 scale=1.0 / 127.5, mean=(127.5, 127.5, 127.5), swapRB=True):
+        self.net = cv2.dnn.readNet(model, config) if config is not None else cv2.dnn.readNet(model)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+        self.threshold = threshold
+        self.inputSize = inputSize
+        self.scale = scale
+        self.mean = mean
+        self.swapRB = swapRB
+
+        # Reused buffer for dropping the alpha channel of BGRx frames.
+        self.bgrBuffer = None
+
+
+    def Prepare(self, frame):
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            if self.bgrBuffer is None or self.bgrBuffer.shape[:2] != frame.shape[:2]:
+                self.bgrBuffer = np.empty(frame.shape[:2] + (3,), dtype=frame.dtype)
+            return cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR, dst=self.bgrBuffer)
+
+        return frame
+
+
+    def Detect(self, image, width, height):
+        blob = cv2.dnn.blobFromImage(image, self.scale, self.inputSize, self.mean, swapRB=self.swapRB)
+
+        return self.forward(blob, [(width, height)])[0]
+
+
+    def DetectBatch(self, frames):
+        # Frames can be different sizes since they all get resized to the network's input.
+        # (Not using Prepare here, since it reuses a single buffer for BGRx frames.)
+        images = [cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR) if frame.ndim == 3 and frame.shape[2] == 4 else frame
+                  for frame in frames]
+        sizes = [(image.shape[1], image.shape[0]) for image in images]
+        blob = cv2.dnn.blobFromImages(images, self.scale, self.inputSize, self.mean, swapRB=self.swapRB)
+
+        return self.forward(blob, sizes)
+
+
+    def forward(self, blob, sizes):
+        """
+        Internal function that runs a blob through the network and splits the output per image.
+        :param blob: Network input holding one image per entry of sizes.
+        :param sizes: (width, height) of each image, to scale normalized coordinates back.
+        :return: List with the Detections of each image.
+        """
+        self.net.setInput(blob)
+        output = self.net.forward().reshape(-1, 7)
+        output = output[output[:, 2] >= self.threshold]
+
+        results = []
+        for batchId, (width, height) in enumerate(sizes):
+            rows = output[output[:, 0] == batchId]
+            boxes = rows[:, 3:7] * np.array([width, height, width, height], dtype=np.float32)
+            results.append(Detections(boxes, rows[:, 2], rows[:, 1]))
+
+        return results
@@ -12,3 +12,16 @@ class BadState(FilmingError):
     def __init__(self, current, expects):
         self.current = current
         self.expects = expects
+
+class BusClosed(Exception):
+    """Exception raised when receiving from message bus channels that have all been closed.
+
+    Attributes:
+        channels -- names of the closed channels
+    """
+    def __init__(self, channels):
+        self.channels = channels
+
+class ProtocolError(Exception):
+    """Exception raised for malformed frames or messages on the remote interface link (see WireProtocol)."""
+    pass
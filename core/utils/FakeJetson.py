@@ -0,0 +1,120 @@
+# Stand-in jetson.utils and jetson.inference modules, so that the perception and system
+# code can run (and be benchmarked) on a plain Linux box.
+# Call Install() before importing any module that imports jetson.
+import importlib
+import sys
+import time
+import types
+
+import cv2
+import numpy as np
+
+
+class FakeDetection:
+    """
+    Mirrors the fields of jetson.inference.detectNet.Detection.
+    """
+
+    def __init__(self, classID, confidence, left, top, right, bottom):
+        self.ClassID = classID
+        self.Confidence = confidence
+        self.Left = left
+        self.Top = top
+        self.Right = right
+        self.Bottom = bottom
+
+
+# Hue (OpenCV's 0-180 range) to one of 9 classes (1-9) of 40 degrees, red straddling 0.
+HUE_CLASSES = np.array([(h + 10) // 20 % 9 + 1 for h in range(256)], dtype=np.uint8)
+
+
+class FakeDetectNet:
+    """
+    Stand-in for jetson.inference.detectNet. Rather than running a network, it finds the
+    colored objects drawn by SyntheticVideo (saturated regions on a gray background, told
+    apart by their hue so touching objects stay separate) and reports each of them as a
+    person (class 1). An optional delay emulates the cost of a real detector.
+    """
+
+    # Seconds each call to Detect takes (set by the benchmark to emulate the Jetson's detector).
+    DETECT_SECONDS = 0.0
+
+    # Resolution images are searched at, whatever their size, like a network resizes them to its input
+    # (so objects only a few dozen pixels tall in a large image are missed, as they would be).
+    INPUT_SIZE = (640, 360)
+
+    # Smallest region (pixels) and side (pixels) reported at INPUT_SIZE, smaller ones are noise, slivers where
+    # objects' colors blend, objects cut off by the frame's edge, or too small for a network to find (a person
+    # under ~40 pixels wide in a 720p frame).
+    MIN_AREA = 16
+    MIN_SIDE = 20
+
+    def __init__(self, network='ssd-mobilenet-v2', threshold=0.5, argv=None):
+        self.threshold = threshold
+
+    def Detect(self, image, width=0, height=0, overlay=None):
+        start = time.monotonic()
+
+        # Image is RGBA (see ImageSource.rgb2crgba), objects are the only saturated areas.
+        inputW, inputH = self.INPUT_SIZE
+        scaleX, scaleY = image.shape[1] / inputW, image.shape[0] / inputH
+        small = cv2.resize(image, self.INPUT_SIZE, interpolation=cv2.INTER_NEAREST)
+        hue, saturation, _ = cv2.split(cv2.cvtColor(small[..., :3], cv2.COLOR_RGB2HSV))
+        _, saturated = cv2.threshold(saturation, 80, 255, cv2.THRESH_BINARY)
+        hues = cv2.bitwise_and(cv2.LUT(hue, HUE_CLASSES), saturated)
+
+        detections = []
+        counts = cv2.calcHist([hues], [0], None, [256], [0, 256]).ravel()
+        for hueClass in np.flatnonzero(counts[1:] >= self.MIN_AREA) + 1:
+            _, _, stats, _ = cv2.connectedComponentsWithStats(cv2.compare(hues, int(hueClass), cv2.CMP_EQ), connectivity=4)
+            for left, top, width, height, area in stats[1:]:
+                if area >= self.MIN_AREA and min(width, height) >= self.MIN_SIDE:
+                    detections.append(FakeDetection(1, 0.9, scaleX * left, scaleY * top, scaleX * (left + width),
+                                                     scaleY * (top + height)))
+
+        remaining = self.DETECT_SECONDS - (time.monotonic() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+
+        return detections
+
+
+def cudaAllocMapped(width=0, height=0, format='rgba8'):
+    # "Mapped memory" is just a regular array here, which cudaToNumpy returns as is.
+    return np.empty((height, width, 4), dtype=np.uint8)
+
+
+def cudaToNumpy(image, *args):
+    return image
+
+
+def cudaFromNumpy(array):
+    return np.ascontiguousarray(array)
+
+
+def Install():
+    """
+    Registers the stand-in modules as jetson, jetson.utils and jetson.inference,
+    unless the real ones are importable.
+    """
+    try:
+        importlib.import_module('jetson.inference')
+        importlib.import_module('jetson.utils')
+        return
+    except ImportError:
+        pass
+
+    package = types.ModuleType('jetson')
+    utils = types.ModuleType('jetson.utils')
+    inference = types.ModuleType('jetson.inference')
+
+    utils.cudaAllocMapped = cudaAllocMapped
+    utils.cudaToNumpy = cudaToNumpy
+    utils.cudaFromNumpy = cudaFromNumpy
+    inference.detectNet = FakeDetectNet
+
+    package.utils = utils
+    package.inference = inference
+    sys.modules['jetson'] = package
+    sys.modules['jetson.utils'] = utils
+    sys.modules['jetson.inference'] = inference
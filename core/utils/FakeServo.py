@@ -0,0 +1,131 @@
+import os
+import select
+import threading
+import time
+import tty
+
+from utils.ServoLink import PacketReader, EncodeAck, COMMAND_PACKET, COMMAND_SYNC, ANGLE_SCALE, ACK_OK, ACK_CLAMPED
+
+# Stand-in for the pan/tilt servo controller, on a pseudo-terminal so that MotorMan's serial
+# path can run on any Linux machine: open FakeServoController(...).path with SerialLink like
+# the real controller's UART. It speaks the controller's protocol (see ServoLink), emulates
+# the line's speed and the controller's processing time, and moves two virtual servos towards
+# their targets at a limited speed.
+
+
+class FakeServoController:
+    """
+    Emulated servo controller, answering commands on a pseudo-terminal from its own thread.
+    args:
+    - baudrate: Line speed to emulate (bits per second).
+    - processingDelay: Seconds the controller takes to handle a command before acknowledging it.
+    - slewRate: Degrees per second the servos move at.
+    - panRange, tiltRange: (min, max) angles the servos can reach.
+    - dropEvery: Leave every dropEvery-th command unacknowledged, as if it was lost on the line (0 never does).
+    """
+
+    def __init__(self, baudrate=115200, processingDelay=0.002, slewRate=300.0, panRange=(-90.0, 90.0),
+                 tiltRange=(-45.0, 45.0), dropEvery=0):
+        self.baudrate = baudrate
+        self.processingDelay = processingDelay
+        self.slewRate = slewRate
+        self.ranges = (panRange, tiltRange)
+        self.dropEvery = dropEvery
+
+        # The slave side is what the controller's user opens, it's kept open here too so that the
+        # master side doesn't hang up between two users.
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+
+        self.reader = PacketReader(COMMAND_PACKET, COMMAND_SYNC)
+        self.lock = threading.Lock()
+        self.targets = [0.0, 0.0]
+        self.positions = [0.0, 0.0]
+        self.lastMove = time.monotonic()
+        self.running = True
+
+        # Statistics
+        self.commands = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def Position(self):
+        """
+        :return: Current (pan, tilt) angles of the virtual servos (degrees).
+        """
+        with self.lock:
+            self.move(time.monotonic())
+            return tuple(self.positions)
+
+
+    def Stop(self):
+        """
+        Stops answering and closes the pseudo-terminal.
+        """
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+    def Stats(self):
+        """
+        :return: Dictionary with commands received and dropped, bytes skipped and the servos' position.
+        """
+        pan, tilt = self.Position()
+        return {
+            "commands": self.commands,
+            "dropped": self.dropped,
+            "skippedBytes": self.reader.skippedBytes,
+            "position": (round(pan, 3), round(tilt, 3)),
+        }
+
+
+    def run(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+
+            try:
+                data = os.read(self.master, 256)
+            except OSError:
+                continue
+
+            # The bytes took this long to come through the line.
+            time.sleep(len(data) * 10 / self.baudrate)
+
+            for seq, pan, tilt in self.reader.Feed(data):
+                self.commands += 1
+                if self.dropEvery and self.commands % self.dropEvery == 0:
+                    self.dropped += 1
+                    continue
+
+                time.sleep(self.processingDelay)
+                status = ACK_OK
+                with self.lock:
+                    self.move(time.monotonic())
+                    for axis, angle in enumerate((pan / ANGLE_SCALE, tilt / ANGLE_SCALE)):
+                        low, high = self.ranges[axis]
+                        if not low <= angle <= high:
+                            status = ACK_CLAMPED
+                        self.targets[axis] = min(max(angle, low), high)
+
+                ack = EncodeAck(seq, status)
+                time.sleep(len(ack) * 10 / self.baudrate)
+                os.write(self.master, ack)
+
+
+    def move(self, now):
+        """
+        Internal function moving the servos towards their targets for the time elapsed since the last move.
+        """
+        step = self.slewRate * (now - self.lastMove)
+        self.lastMove = now
+        for axis in range(2):
+            delta = self.targets[axis] - self.positions[axis]
+            self.positions[axis] += min(max(delta, -step), step)
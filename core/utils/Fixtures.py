@@ -0,0 +1,173 @@
+import cv2
+import numpy as np
+
+from utils.ImageSources import ImageSource
+
+# Fixtures for exercising the pipeline without a camera (see Benchmark): image sources with known
+# ground truth, meant to be paired with the stand-in detector (see FakeJetson).
+
+
+class SyntheticVideo(ImageSource):
+    """
+    Defines an image source generating a synthetic sequence with known ground truth:
+    a red target moving along a smooth path over a static grayscale noise background.
+
+    :param numFrames: Length of the sequence.
+    :param res: (width, height) of the frames.
+    :param targetSize: (width, height) of the target.
+    :param speed: Scales how fast the target moves along its path.
+    :param fps: Paces GetFrame like a live camera (unpaced by default).
+    :param pan: Amplitude (pixels) of a simulated camera pan/tilt, which moves the whole scene in the
+                frame independently of the target (no camera motion by default).
+    :param distractors: Number of other, differently colored objects of the target's size crossing its path
+                        in front of it (none by default).
+    :param pauses: Fraction of the time the target stands still, in stretches of a few seconds (like someone
+                   being interviewed), moving the rest of the time (always moving by default).
+    :param noise: Standard deviation of the sensor noise added to every frame (none by default).
+    :param colorFormat: 'BGR' (3 channel) frames, or 'BGRx' (4 channel) frames like the CSI camera delivers to
+                        CameraMan.
+    """
+
+    # Colors (BGR) of the distractors, cycled through. The target is red.
+    DISTRACTOR_COLORS = [(0, 130, 0), (140, 60, 0), (0, 110, 140), (120, 0, 120)]
+
+    # Frames of a cycle of motion and stillness (see pauses).
+    PAUSE_PERIOD = 300
+
+    # Number of precomputed noise patterns, cycled through (see noise).
+    NOISE_PATTERNS = 8
+
+    def __init__(self, numFrames=600, res=(1280, 720), targetSize=(120, 240), speed=1.0, fps=None, seed=0, pan=0.0,
+                 distractors=0, pauses=0.0, noise=0.0, colorFormat='BGR'):
+        self.numFrames = numFrames
+        self.width, self.height = res
+        self.targetW, self.targetH = targetSize
+        self.speed = speed
+        self.fps = fps
+        self.index = 0
+        self.movingFrames = int(round(self.PAUSE_PERIOD * (1 - min(max(pauses, 0.0), 1.0))))
+        channels = 4 if colorFormat == 'BGRx' else 3
+
+        # Camera motion amplitude per axis, limited so the target can always stay in the frame.
+        self.panX = min(pan, (self.width - self.targetW) / 2)
+        self.panY = min(pan * 0.5, (self.height - self.targetH) / 2)
+
+        # The background extends past the frame by the pan amplitude, the camera looks at a window of it.
+        self.margin = int(np.ceil(pan)) + 1 if pan > 0 else 0
+        rng = np.random.default_rng(seed)
+        worldW, worldH = self.width + 2 * self.margin, self.height + 2 * self.margin
+        gray = rng.integers(0, 256, (worldH // 8, worldW // 8), dtype=np.uint8)
+        gray = cv2.resize(gray, (worldW, worldH), interpolation=cv2.INTER_LINEAR)
+        self.background = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGRA if channels == 4 else cv2.COLOR_GRAY2BGR)
+
+        # Red target with a brighter, sharp-edged cross on it so the tracker has something to lock on to
+        # (fine random textures give MOSSE a weak correlation peak and make it drop the target).
+        ys, xs = np.mgrid[0:self.targetH, 0:self.targetW]
+        cross = (np.abs(xs - self.targetW * 0.4) < self.targetW * 0.08) | (np.abs(ys - self.targetH * 0.35) < self.targetH * 0.05)
+        self.target = np.zeros((self.targetH, self.targetW, 3), dtype=np.uint8)
+        self.target[..., 2] = np.where(cross, 255, 130)
+        self.target[..., 1] = np.where(cross, 59, 0)
+        if channels == 4:
+            self.target = cv2.cvtColor(self.target, cv2.COLOR_BGR2BGRA)
+
+        # Distractors share the target's shape, with their own color and path.
+        self.distractors = []
+        for i in range(distractors):
+            color = np.array(self.DISTRACTOR_COLORS[i % len(self.DISTRACTOR_COLORS)], dtype=np.float32)
+            bright = color * 255 / color.max()
+            distractor = np.where(cross[..., None], bright, color).astype(np.uint8)
+            if channels == 4:
+                distractor = cv2.cvtColor(distractor, cv2.COLOR_BGR2BGRA)
+            self.distractors.append((distractor, rng.uniform(0.5, 1.5), rng.uniform(0, 2 * np.pi)))
+
+        # Noise is added and subtracted as two saturating unsigned patterns, which is much cheaper per frame
+        # than drawing new noise.
+        self.noise = []
+        if noise > 0:
+            for _ in range(self.NOISE_PATTERNS):
+                pattern = rng.normal(0, noise, (self.height, self.width, channels))
+                self.noise.append((np.clip(pattern, 0, 255).astype(np.uint8), np.clip(-pattern, 0, 255).astype(np.uint8)))
+
+        self.frame = np.empty((self.height, self.width, channels), dtype=np.uint8)
+
+
+    def GroundTruth(self, index):
+        """
+        :param index: Frame index.
+        :return: (left, top, right, bottom) box of the target in that frame.
+        """
+        t = self.pathTime(index)
+        marginX = (self.width - self.targetW) / 2
+        marginY = (self.height - self.targetH) / 2
+        # With camera motion the path is narrowed so the target stays in the frame.
+        rangeX = marginX - self.panX
+        rangeY = marginY - self.panY
+        cameraX, cameraY = self.cameraOffset(index)
+        left = int(marginX + rangeX * 0.9 * np.sin(0.7 * t) - cameraX)
+        top = int(marginY + rangeY * 0.8 * np.sin(1.1 * t + 0.5) - cameraY)
+
+        return left, top, left + self.targetW, top + self.targetH
+
+
+    def GetFrame(self):
+        frame = self.ReadInto(self.frame)
+        return frame, self.width, self.height
+
+
+    def ReadInto(self, buffer):
+        if self.index >= self.numFrames:
+            raise Exception('End of synthetic video')
+
+        if self.fps is not None:
+            self.pace(self.fps)
+
+        cameraX, cameraY = self.cameraOffset(self.index)
+        x, y = self.margin + cameraX, self.margin + cameraY
+        np.copyto(buffer, self.background[y:y + self.height, x:x + self.width])
+        left, top, right, bottom = self.GroundTruth(self.index)
+        buffer[top:bottom, left:right] = self.target
+
+        for i, (distractor, frequency, phase) in enumerate(self.distractors):
+            left, top = self.distractorPosition(self.index, frequency, phase)
+            buffer[top:top + self.targetH, left:left + self.targetW] = distractor
+
+        if self.noise:
+            positive, negative = self.noise[self.index % self.NOISE_PATTERNS]
+            cv2.add(buffer, positive, dst=buffer)
+            cv2.subtract(buffer, negative, dst=buffer)
+
+        self.index += 1
+        return buffer
+
+
+    def pathTime(self, index):
+        """
+        Internal function returning how far along its path (seconds of motion) the target is, the time it
+        spent standing still taken out.
+        """
+        cycles, phase = divmod(index, self.PAUSE_PERIOD)
+        return (cycles * self.movingFrames + min(phase, self.movingFrames)) * self.speed / 60.0
+
+
+    def distractorPosition(self, index, frequency, phase):
+        """
+        Internal function returning a distractor's top left corner: it sweeps back and forth across the frame
+        at roughly the target's height, so that it keeps crossing the target's path.
+        """
+        t = index * self.speed / 60.0
+        targetTop = self.GroundTruth(index)[1]
+        left = (self.width - self.targetW) / 2 * (1 + 0.95 * np.sin(frequency * t + phase))
+        top = targetTop + self.targetH * 0.3 * np.sin(0.5 * frequency * t + 2 * phase)
+        return int(left), int(min(max(top, 0), self.height - self.targetH))
+
+
+    def cameraOffset(self, index):
+        """
+        Internal function returning where the simulated camera points, as an offset (pixels) into the scene.
+        """
+        t = index * self.speed / 60.0
+        return int(round(self.panX * np.sin(2.3 * t))), int(round(self.panY * np.sin(1.9 * t + 1.0)))
+
+
+    def Close(self):
+        pass
@@ -0,0 +1,142 @@
+import json
+import time
+
+from utils.Profiler import Histogram
+
+
+class Mode:
+    """
+    How much work a frame gets (see FrameGovernor).
+    - TRACK: Full tracker update.
+    - PREDICT: The box is extrapolated from the target's motion instead of tracked, everything else
+      (motors, storage, remote interface, preview) runs as usual.
+    - SKIP: The frame is already late, only what keeps a steady cadence is done: the motors are
+      steered towards the extrapolated box and the frame is stored.
+    - HOLD: Nothing moves around the target, its box is kept without running the tracker (decided by
+      the motion gate rather than the governor, see PerceptionMan.TargetStatic).
+    """
+    TRACK = "track"
+    PREDICT = "predict"
+    SKIP = "skip"
+    HOLD = "hold"
+
+
+class FrameGovernor:
+    """
+    Keeps the tracking loop on a per-frame latency budget, measured from the frame's capture.
+    Before each frame it picks the most work that still fits in what is left of the budget,
+    based on running estimates of what each mode costs, so the loop sheds work when it falls
+    behind instead of processing every frame late. The tracker is still run at least every
+    maxPredictedFrames frames so the extrapolated boxes don't drift away from the target.
+    args:
+    - budget: Seconds from capture to the end of a frame's processing.
+    - maxPredictedFrames: Max consecutive frames handled without a tracker update.
+    """
+
+    # Smoothing factor of the per-mode cost estimates.
+    COST_ALPHA = 0.2
+
+    def __init__(self, budget=1 / 30, maxPredictedFrames=3):
+        self.budget = budget
+        self.maxPredictedFrames = maxPredictedFrames
+
+        # Estimated processing time of a frame per mode (learnt from the frames processed so far).
+        self.costs = {Mode.TRACK: 0.0, Mode.PREDICT: 0.0, Mode.SKIP: 0.0, Mode.HOLD: 0.0}
+        self.framesSinceTracked = 0
+        self.mode = None
+        self.decideTime = None
+
+        # Statistics
+        self.counts = {Mode.TRACK: 0, Mode.PREDICT: 0, Mode.SKIP: 0, Mode.HOLD: 0}
+        self.forcedTracks = 0
+        self.deadlineMisses = 0
+        self.latency = Histogram()
+
+
+    def Decide(self, captureTime, now=None):
+        """
+        Picks how to process a frame.
+        :param captureTime: Time (time.monotonic) the frame was captured.
+        :return: Mode.TRACK, Mode.PREDICT or Mode.SKIP. Must be followed by a call to Finish once the frame is done.
+        """
+        now = time.monotonic() if now is None else now
+        remaining = self.budget - (now - captureTime)
+
+        if remaining >= self.costs[Mode.TRACK]:
+            mode = Mode.TRACK
+        elif self.framesSinceTracked >= self.maxPredictedFrames:
+            mode = Mode.TRACK
+            self.forcedTracks += 1
+        elif remaining >= self.costs[Mode.PREDICT]:
+            mode = Mode.PREDICT
+        else:
+            mode = Mode.SKIP
+
+        self.framesSinceTracked = 0 if mode == Mode.TRACK else self.framesSinceTracked + 1
+        self.mode = mode
+        self.decideTime = now
+
+        return mode
+
+
+    def Downgrade(self, mode):
+        """
+        Switches the frame the last decision was made for to a cheaper mode picked elsewhere (Mode.HOLD), so
+        its cost isn't taken for the cost of the mode it was decided for.
+        :param mode: Mode the frame is actually processed in.
+        """
+        if mode == Mode.HOLD:
+            # The held box doesn't drift like an extrapolated one does.
+            self.framesSinceTracked = 0
+        self.mode = mode
+
+
+    def Finish(self, captureTime, now=None):
+        """
+        Records the outcome of the frame the last decision was made for.
+        :param captureTime: Time (time.monotonic) the frame was captured.
+        :return: True if the frame was processed within the budget.
+        """
+        now = time.monotonic() if now is None else now
+
+        cost = self.costs[self.mode]
+        self.costs[self.mode] = cost + self.COST_ALPHA * ((now - self.decideTime) - cost)
+        self.counts[self.mode] += 1
+
+        latency = now - captureTime
+        self.latency.Record(latency)
+        if latency > self.budget:
+            self.deadlineMisses += 1
+            return False
+
+        return True
+
+
+    def Stats(self):
+        """
+        :return: Dictionary with frame counts per mode, skip/predict/deadline miss ratios, cost estimates and
+                 capture to processed latency (ms).
+        """
+        frames = max(sum(self.counts.values()), 1)
+        return {
+            "budgetMs": round(self.budget * 1000, 3),
+            "frames": sum(self.counts.values()),
+            "tracked": self.counts[Mode.TRACK],
+            "predicted": self.counts[Mode.PREDICT],
+            "skipped": self.counts[Mode.SKIP],
+            "held": self.counts[Mode.HOLD],
+            "forcedTracks": self.forcedTracks,
+            "deadlineMisses": self.deadlineMisses,
+            "predictRatio": round(self.counts[Mode.PREDICT] / frames, 4),
+            "skipRatio": round(self.counts[Mode.SKIP] / frames, 4),
+            "missRatio": round(self.deadlineMisses / frames, 4),
+            "costMs": {mode: round(cost * 1000, 3) for mode, cost in self.costs.items()},
+            "latency": self.latency.Snapshot(),
+        }
+
+
+    def StatusMessage(self):
+        """
+        :return: "Governor;" followed by the statistics as compact JSON, for the remote interface.
+        """
+        return "Governor;" + json.dumps(self.Stats(), sort_keys=True, separators=(",", ":"))
@@ -1,6 +1,15 @@
-import jetson.utils
+try:
+    import jetson.utils
+except ImportError:
+    # Not running on a Jetson, cuda conversions (rgb2crgba) are unavailable.
+    jetson = None
 
 import cv2
+import numpy as np
+import threading
+import time
+
+from utils.SessionRecorder import SessionReader
 
 class ImageSource:
     """
@@ -16,6 +25,23 @@ class ImageSource:
         raise NotImplementedError
 
 
+    def ReadInto(self, buffer):
+        """
+        Reads the next frame into a preallocated buffer when the source supports it.
+        Sources that can't decode in place fall back to copying the result of GetFrame.
+        args:
+            - buffer: Preallocated array with the shape and dtype of the source's frames.
+        returns: The array holding the frame (buffer itself unless the frame shape changed).
+        """
+        frame, _, _ = self.GetFrame()
+
+        if frame.shape != buffer.shape or frame.dtype != buffer.dtype:
+            return frame.copy()
+
+        np.copyto(buffer, frame)
+        return buffer
+
+
     def Close(self):
         """
         Closes/deallocates an image source, if necessary.
@@ -25,26 +51,108 @@ class ImageSource:
         raise NotImplementedError
 
 
+    def pace(self, fps):
+        """
+        Helper for sources that replay stored frames: sleeps until the next frame
+        is due so that frames are produced at the given rate rather than as fast as possible.
+        """
+        now = time.monotonic()
+        nextFrameTime = getattr(self, 'nextFrameTime', now)
+
+        if nextFrameTime > now:
+            time.sleep(nextFrameTime - now)
+        else:
+            # Fell behind (or first frame), don't try to catch up with a burst of frames.
+            nextFrameTime = now
+
+        self.nextFrameTime = nextFrameTime + 1.0 / fps
+
+
     @staticmethod
     def rgb2crgba(rgb_frame):
         """
         Helper method that transforms a standard RGB frame to a frame with an alpha channel
         and inside of a cuda memory capsule to pass into the object detection network.
+        The conversion writes into a reused, preallocated mapped buffer (see RGBAPool),
+        so no memory is allocated per frame and the frame is only converted once.
+        Note: The returned capsule is recycled after RGBAPool.NUM_BUFFERS more conversions.
         args:
-            - rgb_frame: Standard frame in RGB color space.
+            - rgb_frame: Standard frame in BGR (3 channel) or BGRx (4 channel) color space.
         returns: Frame in RGBA space and inside a cuda memory capsule.
         """
+        return ImageSource.rgbaPool.Convert(rgb_frame)
+
+
+class RGBAPool:
+    """
+    Pool of preallocated RGBA frames in mapped memory (shared by the CPU and GPU),
+    used as destination buffers when converting frames for the object detection network.
+    Buffers are allocated once per frame size and handed out round-robin.
+    Allocation and conversion counters are kept so that the absence of per-frame
+    allocations (and of extra conversions) can be checked at runtime.
+    """
+
+    # Number of buffers per frame size; a buffer is reused after this many conversions.
+    NUM_BUFFERS = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.nextBuffer = {}
+
+        self.allocations = 0
+        self.conversions = 0
+
+
+    def Convert(self, frame):
+        """
+        Converts a BGR or BGRx frame into the next RGBA buffer of the pool.
+        :param frame: Frame as returned by an ImageSource.
+        :return: RGBA frame inside a cuda memory capsule.
+        """
+        height, width = frame.shape[:2]
+        cudaFrame, rgbaView = self.acquire(width, height)
 
-        # Add alpha channel (opacity) to image since network expects RGBA image.
-        rgbaFrame = cv2.cvtColor(rgb_frame, cv2.COLOR_BGR2RGBA)
+        # A single color conversion straight into mapped memory, no intermediate copies.
+        code = cv2.COLOR_BGRA2RGBA if frame.ndim == 3 and frame.shape[2] == 4 else cv2.COLOR_BGR2RGBA
+        cv2.cvtColor(frame, code, dst=rgbaView)
 
-        # Convert image to cuda memory capsule (pycapsule) object to pass
-        # memory efficiently (expected by network detect method).
-        cudaFrame = jetson.utils.cudaFromNumpy(rgbaFrame)
+        with self.lock:
+            self.conversions += 1
 
         return cudaFrame
 
 
+    def Stats(self):
+        """
+        :return: Dictionary with the number of buffer allocations and color conversions so far.
+        """
+        with self.lock:
+            return {"allocations": self.allocations, "conversions": self.conversions}
+
+
+    def acquire(self, width, height):
+        with self.lock:
+            key = (width, height)
+
+            if key not in self.buffers:
+                self.buffers[key] = []
+                self.nextBuffer[key] = 0
+                for _ in range(self.NUM_BUFFERS):
+                    cudaFrame = jetson.utils.cudaAllocMapped(width=width, height=height, format='rgba8')
+                    # Numpy view onto the same mapped memory, so OpenCV can write into it directly.
+                    self.buffers[key].append((cudaFrame, jetson.utils.cudaToNumpy(cudaFrame)))
+                    self.allocations += 1
+
+            index = self.nextBuffer[key]
+            self.nextBuffer[key] = (index + 1) % self.NUM_BUFFERS
+
+            return self.buffers[key][index]
+
+
+ImageSource.rgbaPool = RGBAPool()
+
+
 class CSICamera(ImageSource):
     """
     Defines an image source from the Jetson Nano's MIPI CSI camera.
@@ -58,17 +166,27 @@ class CSICamera(ImageSource):
         [2] 1920 x 1080; 30 fps
         [3] 1280 x 720; 60 fps
         [4] 1280 x 720; 120 fps
+    :param color_format: Format frames are delivered in. 'BGR' (default) adds a CPU videoconvert
+        step to the pipeline. 'BGRx' hands over nvvidconv's output as is, so the only color
+        conversion left is the one into RGBA for detection (tracking and detection both accept
+        4 channel frames).
     """
 
-    def __init__(self, sensor_id=0, sensor_mode=3, flip_method=2, display_width=1280, display_height=720):
+    def __init__(self, sensor_id=0, sensor_mode=3, flip_method=2, display_width=1280, display_height=720,
+                 color_format='BGR'):
         gstreamerPipeline = "nvarguscamerasrc sensor_id=%d sensor_mode=%d ! "\
                              "video/x-raw(memory:NVMM) ! "\
                              "nvvidconv flip-method=%d ! "\
-                             "video/x-raw, width=(int)%d, height=(int)%d, format=(string)BGRx ! "\
-                             "videoconvert ! "\
-                             "video/x-raw, format=(string)BGR ! appsink" \
+                             "video/x-raw, width=(int)%d, height=(int)%d, format=(string)BGRx ! " \
                              % (sensor_id, sensor_mode, flip_method, display_width, display_height)
 
+        if color_format == 'BGR':
+            gstreamerPipeline += "videoconvert ! video/x-raw, format=(string)BGR ! appsink"
+        elif color_format == 'BGRx':
+            gstreamerPipeline += "appsink"
+        else:
+            raise ValueError('Unsupported color format: %s' % color_format)
+
         self.camera = cv2.VideoCapture(gstreamerPipeline, cv2.CAP_GSTREAMER)
 
     def GetFrame(self):
@@ -82,6 +200,16 @@ class CSICamera(ImageSource):
         return frame, width, height
 
 
+    def ReadInto(self, buffer):
+        # Decode straight into the buffer (OpenCV reuses it when shape and type match).
+        success, frame = self.camera.read(buffer)
+
+        if not success:
+            raise Exception('Could not read from camera')
+
+        return frame
+
+
     def Close(self):
         self.camera.release()
 
@@ -89,13 +217,20 @@ class CSICamera(ImageSource):
 class LocalVideo(ImageSource):
     """
     Defines an image source from a locally stored video.
+    If realtime is set, frames are produced at the video's native frame rate
+    (like a live camera would) rather than as fast as they can be decoded.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, realtime=False):
         self.video = cv2.VideoCapture(path)
+        self.realtime = realtime
+        self.fps = self.video.get(cv2.CAP_PROP_FPS) or 30
 
 
     def GetFrame(self):
+        if self.realtime:
+            self.pace(self.fps)
+
         success, frame = self.video.read()
 
         if not success:
@@ -106,6 +241,30 @@ class LocalVideo(ImageSource):
         return frame, width, height
 
 
+    def ReadInto(self, buffer):
+        if self.realtime:
+            self.pace(self.fps)
+
+        success, frame = self.video.read(buffer)
+
+        if not success:
+            raise Exception('Could not read local video')
+
+        return frame
+
+
+    def __len__(self):
+        # From the container's metadata, some formats only give an estimate.
+        return int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+
+    def Seek(self, index):
+        """
+        :param index: Frame the next GetFrame/ReadInto call returns.
+        """
+        self.video.set(cv2.CAP_PROP_POS_FRAMES, index)
+
+
     def Close(self):
         self.video.release()
 
@@ -114,9 +273,11 @@ class LocalImage(ImageSource):
     """
     Defines an image source from a locally stored still image.
     Res argument in constructor resizes image to specified resolution (or 720p by default).
+    Fps argument paces GetFrame like a live camera (unpaced by default).
     """
 
-    def __init__(self, path, res=(1280, 720)):
+    def __init__(self, path, res=(1280, 720), fps=None):
+        self.fps = fps
         self.img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
 
         if self.img is None:
@@ -127,6 +288,9 @@ class LocalImage(ImageSource):
 
 
     def GetFrame(self):
+        if self.fps is not None:
+            self.pace(self.fps)
+
         height, width = self.img.shape[:2]
 
         return self.img, width, height
@@ -136,3 +300,199 @@ class LocalImage(ImageSource):
         # No deallocation necessary
         pass
 
+
+class ThreadedCapture(ImageSource):
+    """
+    Wraps another image source and reads from it in a dedicated thread, so that
+    sensor readout and conversion never happen inline in the tracking loop.
+    Frames are decoded into a small ring of preallocated slots (triple buffering by
+    default): the capture thread never writes into the newest slot nor the slot
+    currently handed out to the consumer, so Capture() returns frames without copying.
+    Note: A frame returned by Capture() is only valid until the next call to Capture().
+
+    :param source: Underlying ImageSource (CSICamera, LocalVideo, LocalImage...).
+    :param numSlots: Number of preallocated frame slots (at least 3).
+    """
+
+    def __init__(self, source, numSlots=3):
+        self.source = source
+
+        # Read the first frame synchronously to learn the frame shape and preallocate the ring.
+        frame, self.width, self.height = source.GetFrame()
+        self.slots = [np.empty_like(frame) for _ in range(max(numSlots, 3))]
+        np.copyto(self.slots[0], frame)
+
+        self.seqs = [0] * len(self.slots)
+        self.timestamps = [0.0] * len(self.slots)
+        self.seqs[0] = 1
+        self.timestamps[0] = time.monotonic()
+
+        self.latest = 0             # Slot holding the newest frame
+        self.leased = None          # Slot currently handed out to the consumer
+        self.lastConsumedSeq = 0
+        self.droppedFrames = 0
+        self.error = None
+
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def Capture(self, fresh=True, timeout=None):
+        """
+        Returns the newest captured frame.
+        :param fresh: If True, waits until a frame newer than the last one returned is available.
+        :param timeout: Max seconds to wait for a fresh frame (None waits forever).
+        :return: frame, width, height, capture timestamp (time.monotonic), total dropped frames
+        """
+        with self.cond:
+            if fresh:
+                self.cond.wait_for(lambda: self.seqs[self.latest] > self.lastConsumedSeq
+                                           or self.error is not None, timeout)
+
+            seq = self.seqs[self.latest]
+            if seq <= self.lastConsumedSeq and self.error is not None:
+                raise self.error
+
+            # Every frame captured in between calls was never seen by the consumer.
+            if seq > self.lastConsumedSeq + 1:
+                self.droppedFrames += seq - self.lastConsumedSeq - 1
+
+            self.lastConsumedSeq = seq
+            self.leased = self.latest
+
+            return self.slots[self.leased], self.width, self.height, self.timestamps[self.leased], self.droppedFrames
+
+
+    def GetFrame(self):
+        frame, width, height, _, _ = self.Capture()
+
+        return frame, width, height
+
+
+    def Close(self):
+        with self.cond:
+            self.running = False
+        self.thread.join()
+        self.source.Close()
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.running:
+                    return
+
+                # Pick a slot that is neither the newest frame nor the one the consumer holds.
+                slot = next(i for i in range(len(self.slots)) if i != self.latest and i != self.leased)
+
+            try:
+                frame = self.source.ReadInto(self.slots[slot])
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+
+            timestamp = time.monotonic()
+
+            with self.cond:
+                self.slots[slot] = frame
+                self.height, self.width = frame.shape[:2]
+                self.seqs[slot] = self.seqs[self.latest] + 1
+                self.timestamps[slot] = timestamp
+                self.latest = slot
+                self.cond.notify_all()
+
+
+class ReplaySource(ImageSource):
+    """
+    Defines an image source replaying a session recorded by SessionRecorder, frame for frame.
+    Frames are handed out straight from the memory-mapped session file (read-only, no copy or
+    decoding), along with what the system received and computed at the time (see Records), so
+    a session can be replayed deterministically to compare tracker changes against it.
+    If realtime is set, frames are produced with the recorded time between them.
+
+    :param path: Session file.
+    :param realtime: Paces frames like they were captured (unpaced by default).
+    :param start: First frame to replay.
+    """
+
+    def __init__(self, path, realtime=False, start=0):
+        self.session = SessionReader(path)
+        self.realtime = realtime
+        self.index = start
+        self.nextFrameTime = None
+        self.height, self.width = self.session.frameShape[:2]
+
+        duration = self.session.CaptureTime(len(self.session) - 1) - self.session.CaptureTime(0) if len(self.session) > 1 else 0
+        self.fps = (len(self.session) - 1) / duration if duration > 0 else 30
+
+
+    def __len__(self):
+        return len(self.session)
+
+
+    def Seek(self, index):
+        """
+        :param index: Frame the next GetFrame/ReadInto returns.
+        """
+        self.index = index
+        self.nextFrameTime = None
+
+
+    def CaptureTime(self, index):
+        """
+        :return: Time (time.monotonic on the recording system) frame index was captured.
+        """
+        return self.session.CaptureTime(index)
+
+
+    def Records(self, index, kind=None):
+        """
+        :return: List of (kind, timestamp, message) recorded along with frame index (see SessionReader.Records).
+        """
+        return self.session.Records(index, kind)
+
+
+    def GetFrame(self):
+        frame = self.next()
+        return frame, self.width, self.height
+
+
+    def ReadInto(self, buffer):
+        frame = self.next()
+
+        if frame.shape != buffer.shape:
+            return frame.copy()
+
+        np.copyto(buffer, frame)
+        return buffer
+
+
+    def next(self):
+        """
+        Internal function returning a view of the next frame, after waiting for its turn if replaying in realtime.
+        """
+        if self.index >= len(self.session):
+            raise Exception('End of session')
+
+        if self.realtime:
+            now = time.monotonic()
+            if self.nextFrameTime is not None:
+                self.nextFrameTime += max(self.session.CaptureTime(self.index) - self.session.CaptureTime(self.index - 1), 0)
+
+            if self.nextFrameTime is not None and self.nextFrameTime > now:
+                time.sleep(self.nextFrameTime - now)
+            else:
+                # First frame, or fell behind: don't try to catch up with a burst of frames.
+                self.nextFrameTime = now
+
+        frame = self.session.Frame(self.index)
+        self.index += 1
+        return frame
+
+
+    def Close(self):
+        self.session.Close()
@@ -0,0 +1,199 @@
+import collections
+import threading
+import time
+
+from utils.Exceptions import BusClosed
+
+# Channel names shared between the managers.
+TO_SYSTEM = "toSystem"          # CommsMan --> SystemMan
+TO_REMOTE = "toRemote"          # SystemMan --> CommsMan
+BLUETOOTH_IN = "bluetoothIn"    # (Simulated) Bluetooth --> CommsMan
+STORAGE_FRAMES = "storageFrames"    # SystemMan --> StorageMan
+STORAGE_COMPILE = "storageCompile"  # SystemMan --> StorageMan
+PREVIEW_FRAMES = "previewFrames"    # SystemMan --> PreviewMan
+REMOTE_PREVIEW = "remotePreview"    # SystemMan --> CommsMan (preview encoder)
+ENCODED_PREVIEW = "encodedPreview"  # CommsMan (preview encoder) --> CommsMan (link)
+
+
+class Policy:
+    """
+    Backpressure policies for a full channel.
+    - BLOCK: Publisher waits until there is room (or the timeout expires).
+    - DROP_OLDEST: Oldest queued message is discarded to make room.
+    - COALESCE_LATEST: Queue holds a single message which is replaced by newer ones.
+    """
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    COALESCE_LATEST = "coalesce_latest"
+
+
+class Channel:
+    """
+    A single named queue on the bus along with its statistics.
+    Only accessed while holding the bus lock.
+    """
+
+    def __init__(self, name, maxsize, policy):
+        self.name = name
+        self.maxsize = 1 if policy == Policy.COALESCE_LATEST else maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.closed = False
+
+        # Statistics
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.maxDepth = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def Full(self):
+        return len(self.items) >= self.maxsize
+
+    def Stats(self):
+        return {
+            "policy": self.policy,
+            "depth": len(self.items),
+            "maxDepth": self.maxDepth,
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+            "avgWait": self.totalWait / self.received if self.received else 0.0,
+            "maxWait": self.maxWait,
+            "closed": self.closed,
+        }
+
+
+class MessageBus:
+    """
+    Blocking message bus shared between the managers. Receivers sleep until a
+    message arrives on one of the channels they listen to, or until those channels
+    are closed, instead of spinning on queue.empty().
+    Wait time statistics measure how long messages sat in a channel before being received.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.channels = {}
+
+
+    def CreateChannel(self, name, maxsize=1, policy=Policy.BLOCK):
+        """
+        Creates a channel if it does not exist yet.
+        :param name: Channel name (see constants at the top of this module).
+        :param maxsize: Maximum number of queued messages (ignored for COALESCE_LATEST).
+        :param policy: What to do when publishing to a full channel (see Policy).
+        """
+        with self.cond:
+            if name not in self.channels:
+                self.channels[name] = Channel(name, maxsize, policy)
+
+
+    def Publish(self, name, message, timeout=None):
+        """
+        Publishes a message on a channel, applying the channel's backpressure policy.
+        :param name: Channel name.
+        :param message: Any object.
+        :param timeout: Max seconds to wait for room on a BLOCK channel (None waits forever).
+        :return: True if the message was queued, False if it timed out or the channel is closed.
+        """
+        with self.cond:
+            channel = self.channels[name]
+
+            if channel.closed:
+                return False
+
+            if channel.Full():
+                if channel.policy == Policy.BLOCK:
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                    while channel.Full() and not channel.closed:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            return False
+                        self.cond.wait(remaining)
+
+                    if channel.closed:
+                        return False
+                else:
+                    # DROP_OLDEST and COALESCE_LATEST both discard the oldest pending message.
+                    channel.items.popleft()
+                    channel.dropped += 1
+
+            channel.items.append((time.monotonic(), message))
+            channel.published += 1
+            channel.maxDepth = max(channel.maxDepth, len(channel.items))
+            self.cond.notify_all()
+
+        return True
+
+
+    def Receive(self, names, timeout=None):
+        """
+        Waits for a message on any of the given channels (checked in the order given).
+        :param names: List of channel names to listen to.
+        :param timeout: Max seconds to wait (None waits forever, 0 polls).
+        :return: (channel name, message), or (None, None) on timeout.
+        :raises BusClosed: If all of the given channels are closed and drained.
+        """
+        with self.cond:
+            channels = [self.channels[name] for name in names]
+            deadline = None if timeout is None else time.monotonic() + timeout
+
+            while True:
+                for channel in channels:
+                    if channel.items:
+                        enqueued, message = channel.items.popleft()
+                        wait = time.monotonic() - enqueued
+
+                        channel.received += 1
+                        channel.totalWait += wait
+                        channel.maxWait = max(channel.maxWait, wait)
+
+                        # Wake up publishers blocked on a full channel.
+                        self.cond.notify_all()
+                        return channel.name, message
+
+                if all(channel.closed for channel in channels):
+                    raise BusClosed(names)
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None, None
+
+                self.cond.wait(remaining)
+
+
+    def Close(self, name):
+        """
+        Closes a channel. Pending messages can still be received, new ones are rejected
+        and receivers waiting only on closed channels are woken up.
+        :return: 0 if the channel was closed, -1 if it was already closed.
+        """
+        with self.cond:
+            channel = self.channels[name]
+            if channel.closed:
+                return -1
+
+            channel.closed = True
+            self.cond.notify_all()
+
+        return 0
+
+
+    def Shutdown(self):
+        """
+        Closes every channel on the bus.
+        """
+        with self.cond:
+            for channel in self.channels.values():
+                channel.closed = True
+            self.cond.notify_all()
+
+
+    def Stats(self):
+        """
+        :return: Dictionary mapping channel names to their depth and wait-time statistics.
+        """
+        with self.cond:
+            return {name: channel.Stats() for name, channel in self.channels.items()}
@@ -0,0 +1,127 @@
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    Tells when nothing moves around the target, so the tracker can be spared while it stands still
+    (interviews, talks). The region around the target's box is shrunk to a tiny grayscale thumbnail,
+    which costs a fraction of a tracker update, and compared with its thumbnail in the last frame the
+    tracker ran on. Once it has stayed static for a few tracked frames, frames are held (the box stays
+    where it is) until the thumbnail changes, which wakes the tracker on that same frame. Comparing with
+    the last tracked frame rather than the previous one also catches motion too slow to show between
+    two frames. The tracker still runs every maxHeldFrames frames while the scene stays static.
+    args:
+    - thumbSize: (width, height) of the thumbnails.
+    - expansion: Factor by which the target's box is grown to get the region watched for motion.
+    - pixelThreshold: Gray level difference for a thumbnail pixel to count as changed (above sensor noise).
+    - motionFraction: Fraction of changed thumbnail pixels above which the region is moving.
+    - settleFrames: Consecutive static tracked frames before frames start being held.
+    - maxHeldFrames: Max consecutive held frames.
+    """
+
+    def __init__(self, thumbSize=(32, 32), expansion=1.5, pixelThreshold=12, motionFraction=0.01, settleFrames=5,
+                 maxHeldFrames=30):
+        self.thumbSize = thumbSize
+        self.expansion = expansion
+        self.pixelThreshold = pixelThreshold
+        self.motionFraction = motionFraction
+        self.settleFrames = settleFrames
+        self.maxHeldFrames = maxHeldFrames
+
+        # Watched region (left, top, right, bottom) and its thumbnail in the last tracked frame.
+        self.region = None
+        self.reference = None
+        self.thumbnail = None
+        self.staticFrames = 0
+        self.heldFrames = 0
+
+        # Statistics
+        self.checks = 0
+        self.held = 0
+        self.wakes = 0
+        self.refreshes = 0
+
+
+    def Rebase(self, frame, bbox):
+        """
+        Takes the frame the tracker just ran on as the new reference, around the box it found.
+        :param frame: Tracked frame.
+        :param bbox: Target's BoundingBox in that frame.
+        """
+        height, width = frame.shape[:2]
+        (x1, y1), (x2, y2) = bbox.topLeft, bbox.bottomRight
+        halfW, halfH = (x2 - x1) * self.expansion / 2, (y2 - y1) * self.expansion / 2
+        left, top = max(int(bbox.center[0] - halfW), 0), max(int(bbox.center[1] - halfH), 0)
+        right, bottom = min(int(bbox.center[0] + halfW), width), min(int(bbox.center[1] + halfH), height)
+
+        # Target (mostly) out of the frame: nothing to watch, every frame is tracked.
+        if right - left < 2 or bottom - top < 2:
+            self.region = None
+            self.reference = None
+            return
+
+        self.region = (left, top, right, bottom)
+        self.reference = self.shrink(frame, self.reference)
+
+
+    def Check(self, frame, moved=False):
+        """
+        Compares the watched region of a new frame with the reference.
+        :param frame: New frame.
+        :param moved: Whether something else tells that the image moved (e.g. the camera's own motion).
+        :return: True if the frame can be held, False if the tracker should run on it.
+        """
+        if self.reference is None:
+            return False
+
+        self.checks += 1
+        if not moved:
+            self.thumbnail = self.shrink(frame, self.thumbnail)
+            changed = cv2.absdiff(self.thumbnail, self.reference) > self.pixelThreshold
+            moved = np.count_nonzero(changed) > self.motionFraction * changed.size
+
+        if moved:
+            if self.heldFrames > 0:
+                self.wakes += 1
+            self.staticFrames = 0
+            self.heldFrames = 0
+            return False
+
+        self.staticFrames += 1
+        if self.staticFrames <= self.settleFrames:
+            return False
+
+        if self.heldFrames >= self.maxHeldFrames:
+            self.heldFrames = 0
+            self.refreshes += 1
+            return False
+
+        self.heldFrames += 1
+        self.held += 1
+        return True
+
+
+    def Stats(self):
+        """
+        :return: Dictionary with the number of frames checked and held, wakes and refreshes.
+        """
+        return {
+            "checks": self.checks,
+            "held": self.held,
+            "heldRatio": round(self.held / max(self.checks, 1), 4),
+            "wakes": self.wakes,
+            "refreshes": self.refreshes,
+        }
+
+
+    def shrink(self, frame, out):
+        """
+        Internal function computing the grayscale thumbnail of the watched region (area averaged, which also
+        averages out most of the sensor's noise).
+        :param out: Thumbnail buffer to reuse, if any.
+        """
+        left, top, right, bottom = self.region
+        small = cv2.resize(frame[top:bottom, left:right], self.thumbSize, interpolation=cv2.INTER_AREA)
+
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=out)
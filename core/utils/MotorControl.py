@@ -0,0 +1,236 @@
+import collections
+import math
+
+import numpy as np
+
+
+class ConstantVelocityKalman:
+    """
+    Kalman filter tracking a 2D position under a constant velocity model.
+    State is [x, y, vx, vy] so both axes are updated with a single set of matrix
+    operations, at a fixed cost per call.
+    args:
+    - processNoise: Variance of the (unmodeled) acceleration.
+    - measurementNoise: Variance of position measurements.
+    """
+
+    def __init__(self, processNoise=50.0, measurementNoise=0.05):
+        self.processNoise = processNoise
+        self.H = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], dtype=np.float64)
+        self.R = np.eye(2) * measurementNoise
+        self.x = None
+        self.P = np.eye(4) * 1e3
+
+
+    def Predict(self, dt):
+        """
+        Advances the filter's state by dt seconds.
+        """
+        if self.x is None:
+            return
+
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+
+        # Discrete white noise acceleration model.
+        q = self.processNoise
+        G = np.array([[dt * dt / 2, 0], [0, dt * dt / 2], [dt, 0], [0, dt]])
+
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + q * (G @ G.T)
+
+
+    def Update(self, z):
+        """
+        Folds a new position measurement (x, y) into the state.
+        """
+        z = np.asarray(z, dtype=np.float64)
+
+        if self.x is None:
+            self.x = np.array([z[0], z[1], 0.0, 0.0])
+            return
+
+        y = z - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+
+        self.x = self.x + K @ y
+        self.P = (np.eye(4) - K @ self.H) @ self.P
+
+
+    def PredictAhead(self, dt):
+        """
+        :return: (x, y) position the target will be at in dt seconds, without changing the state.
+        """
+        return self.x[:2] + self.x[2:] * dt
+
+
+class PredictiveController:
+    """
+    Pan/tilt controller compensating for pipeline latency. The target's bbox center is
+    converted to an angle in the world (camera orientation at capture time plus the
+    target's angular offset in the image) and filtered with a constant velocity Kalman
+    filter, which is then extrapolated by the capture-to-command latency. The motors are
+    commanded towards that predicted angle, with a dead-band around the current
+    orientation and a rate limit. Both axes are handled as a single vector.
+    Angles are in degrees: x is pan (turn, positive right), y is tilt (positive down).
+    args:
+    - frameSize: (width, height) of the frames bboxes come from.
+    - fov: (horizontal, vertical) field of view of the camera in degrees.
+    - deadband: Angular error (degrees) under which the motors are not moved.
+    - maxRate: Maximum motor speed in degrees per second.
+    - gain: Fraction of the predicted error corrected per command.
+    """
+
+    # Number of past orientations kept to look up where the camera was at capture time.
+    HISTORY_LENGTH = 64
+
+    def __init__(self, frameSize=(1280, 720), fov=(62.2, 48.8), deadband=0.5, maxRate=90.0, gain=0.8):
+        self.center = np.array(frameSize, dtype=np.float64) / 2
+        self.degPerPixel = np.array(fov, dtype=np.float64) / np.array(frameSize, dtype=np.float64)
+        self.deadband = deadband
+        self.maxRate = maxRate
+        self.gain = gain
+
+        self.filter = ConstantVelocityKalman()
+        self.orientation = np.zeros(2)
+        self.history = collections.deque(maxlen=self.HISTORY_LENGTH)
+        self.lastTime = None
+
+
+    def Step(self, bboxCenter, captureTime, now):
+        """
+        Computes the motor deltas for a new target measurement.
+        :param bboxCenter: (x, y) center of the target's bbox in pixels.
+        :param captureTime: Time (time.monotonic) the frame the bbox comes from was captured.
+        :param now: Current time (time.monotonic), the deltas are applied from this point on.
+        :return: (deltaTurn, deltaTilt) in degrees.
+        """
+        # Where the target was in the world when the frame was captured.
+        cameraThen = self.orientationAt(captureTime)
+        measured = cameraThen + (np.asarray(bboxCenter, dtype=np.float64) - self.center) * self.degPerPixel
+
+        dt = 0.0 if self.lastTime is None else max(captureTime - self.lastTime, 0.0)
+        self.lastTime = captureTime
+        self.filter.Predict(dt)
+        self.filter.Update(measured)
+
+        # Where it will be by the time the command takes effect.
+        predicted = self.filter.PredictAhead(max(now - captureTime, 0.0))
+        error = predicted - self.orientation
+
+        delta = np.where(np.abs(error) < self.deadband, 0.0, error * self.gain)
+
+        # Rate limit based on the time elapsed since the last command.
+        if self.history:
+            elapsed = max(now - self.history[-1][0], 1e-3)
+            limit = self.maxRate * elapsed
+            delta = np.clip(delta, -limit, limit)
+
+        self.orientation = self.orientation + delta
+        self.history.append((now, self.orientation.copy()))
+
+        return float(delta[0]), float(delta[1])
+
+
+    def orientationAt(self, t):
+        """
+        Internal function that looks up the commanded orientation at a given time.
+        """
+        for commandTime, orientation in reversed(self.history):
+            if commandTime <= t:
+                return orientation
+
+        return self.history[0][1] if self.history else self.orientation
+
+
+class SimulatedPlant:
+    """
+    Simulated pan/tilt rig and moving target, to tune PredictiveController offline.
+    The target moves in world angles, the motors follow commands as a first order system,
+    and every frame reports the target's bbox center as seen by the camera, the command
+    computed from it only reaching the motors after a given pipeline latency.
+    args:
+    - frameSize, fov: Camera geometry (see PredictiveController).
+    - motorTimeConstant: Seconds for the motors to cover ~63% of a commanded move.
+    - noise: Standard deviation of the bbox center measurement noise in pixels.
+    """
+
+    def __init__(self, frameSize=(1280, 720), fov=(62.2, 48.8), motorTimeConstant=0.05, noise=2.0, seed=0):
+        self.center = np.array(frameSize, dtype=np.float64) / 2
+        self.degPerPixel = np.array(fov, dtype=np.float64) / np.array(frameSize, dtype=np.float64)
+        self.motorTimeConstant = motorTimeConstant
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+        self.camera = np.zeros(2)
+        self.commanded = np.zeros(2)
+
+
+    @staticmethod
+    def TargetAngle(t):
+        """
+        Default target trajectory (degrees): a slow sweep with a sudden change of direction.
+        """
+        pan = 20 * math.sin(0.5 * t) + (10 if t > 5 else 0)
+        tilt = 5 * math.sin(0.3 * t)
+
+        return np.array([pan, tilt])
+
+
+    def Simulate(self, controller, seconds=10.0, fps=60.0, latency=0.05, trajectory=None):
+        """
+        Runs the controller against the simulated rig.
+        :param controller: PredictiveController to evaluate.
+        :param seconds: Length of the simulation.
+        :param fps: Tracker rate.
+        :param latency: Capture-to-command latency in seconds.
+        :param trajectory: Function mapping time to target angles (TargetAngle by default).
+        :return: Dictionary with the RMS and max angular error between camera and target.
+        """
+        trajectory = trajectory or self.TargetAngle
+        dt = 1.0 / fps
+        errors = []
+
+        # Commands on their way through the pipeline, as (time they reach the motors, delta).
+        pending = collections.deque()
+
+        for i in range(int(seconds * fps)):
+            captureTime = i * dt
+            target = trajectory(captureTime)
+
+            # Camera sees the target relative to where it was pointing at capture time.
+            bboxCenter = self.center + (target - self.camera) / self.degPerPixel + self.rng.normal(0, self.noise, 2)
+
+            # Command issued once the frame went through the pipeline.
+            delta = controller.Step(bboxCenter, captureTime, captureTime + latency)
+            pending.append((captureTime + latency, np.array(delta)))
+
+            # Motors move towards the commanded orientation until the next frame, each command taking over
+            # once it arrives.
+            t = captureTime
+            while pending and pending[0][0] <= captureTime + dt:
+                arrival, delta = pending.popleft()
+                self.moveMotors(max(arrival - t, 0.0))
+                self.commanded = self.commanded + delta
+                t = max(arrival, t)
+
+            self.moveMotors(captureTime + dt - t)
+            errors.append(np.hypot(*(trajectory(captureTime + dt) - self.camera)))
+
+        errors = np.array(errors)
+        return {"rmsError": float(np.sqrt(np.mean(errors ** 2))), "maxError": float(errors.max())}
+
+
+    def moveMotors(self, seconds):
+        """
+        Internal function moving the motors towards the commanded orientation for a given time.
+        """
+        self.camera = self.commanded + (self.camera - self.commanded) * math.exp(-seconds / self.motorTimeConstant)
+
+
+if __name__ == '__main__':
+    # Offline tuning: sweep the controller's gain against the simulated rig.
+    for gain in (0.4, 0.6, 0.8, 1.0):
+        result = SimulatedPlant().Simulate(PredictiveController(gain=gain))
+        print("Gain %.1f: RMS error %.2f deg, max error %.2f deg" % (gain, result["rmsError"], result["maxError"]))
@@ -0,0 +1,192 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    # Fall back to greedy matching (see MultiTargetTracker.assign).
+    linear_sum_assignment = None
+
+from utils.PerceptionUtils import BoundingBox, IoUMatrix, CreateMOSSETracker
+
+
+class Track:
+    """
+    A single target followed by the multi-target tracker.
+    """
+
+    def __init__(self, trackId, tracker, bbox):
+        self.id = trackId
+        self.tracker = tracker
+        self.bbox = bbox
+        self.success = True
+        self.misses = 0
+
+
+class MultiTargetTracker:
+    """
+    Tracks several targets at once, each with its own MOSSE tracker and a stable ID.
+    Tracker updates are spread across a thread pool (OpenCV releases the GIL while
+    updating). Whether that beats a single thread depends on the targets' sizes and the
+    cores available, measure it with Benchmark's --multi-target mode.
+    Detections are associated to tracks globally by maximizing the total IoU (Hungarian
+    algorithm when scipy is available, greedy matching otherwise).
+    args:
+    - maxWorkers: Number of threads tracker updates are spread across (number of cores by default).
+    - minIoU: Minimum IoU for a detection to be associated with a track.
+    - maxMisses: Tracks that fail to track or go unmatched this many times in a row are dropped.
+    """
+
+    def __init__(self, maxWorkers=None, minIoU=0.3, maxMisses=5):
+        self.pool = ThreadPoolExecutor(max_workers=maxWorkers or os.cpu_count() or 4)
+        self.minIoU = minIoU
+        self.maxMisses = maxMisses
+
+        self.tracks = {}
+        self.nextId = 1
+
+
+    def AddTarget(self, frame, bbox):
+        """
+        Starts tracking a new target.
+        :param frame: Frame the target's bbox was found in.
+        :param bbox: BoundingBox around the target.
+        :return: ID of the new track.
+        """
+        track = Track(self.nextId, self.createTracker(frame, bbox), bbox)
+        self.tracks[track.id] = track
+        self.nextId += 1
+
+        return track.id
+
+
+    def RemoveTarget(self, trackId):
+        """
+        Stops tracking a target.
+        """
+        self.tracks.pop(trackId, None)
+
+
+    def Update(self, frame):
+        """
+        Tracks every target in a new frame, updating trackers in parallel.
+        :param frame: Current frame in which to look for the targets.
+        :return: Dictionary mapping track IDs to (success, BoundingBox).
+        """
+        tracks = list(self.tracks.values())
+        results = self.pool.map(lambda track: track.tracker.update(frame), tracks)
+
+        for track, (success, box) in zip(tracks, results):
+            track.success = success
+            if success:
+                track.bbox = BoundingBox(left=box[0], top=box[1], right=box[0] + box[2], bottom=box[1] + box[3])
+                track.misses = 0
+            else:
+                track.misses += 1
+
+        self.pruneTracks()
+
+        return {track.id: (track.success, track.bbox) for track in self.tracks.values()}
+
+
+    def Associate(self, frame, detections, spawn=False):
+        """
+        Associates detections with the existing tracks. Matched tracks are re-initialized on
+        their detection to correct accumulated drift, unmatched tracks count a miss.
+        :param frame: Frame the detections were found in.
+        :param detections: Detections (see PerceptionUtils), already filtered to the classes of interest.
+        :param spawn: Whether unmatched detections start new tracks.
+        :return: Dictionary mapping track IDs to the index of the detection they were matched with.
+        """
+        tracks = list(self.tracks.values())
+        matches = {}
+
+        if tracks and len(detections) > 0:
+            trackBoxes = [track.bbox.topLeft + track.bbox.bottomRight for track in tracks]
+            iou = IoUMatrix(trackBoxes, detections.boxes)
+
+            for t, d in self.assign(iou):
+                if iou[t, d] >= self.minIoU:
+                    matches[tracks[t].id] = d
+
+        for track in tracks:
+            if track.id in matches:
+                track.bbox = detections.BoundingBox(matches[track.id])
+                track.tracker = self.createTracker(frame, track.bbox)
+                track.misses = 0
+            else:
+                track.misses += 1
+
+        if spawn:
+            matched = set(matches.values())
+            for d in range(len(detections)):
+                if d not in matched:
+                    self.AddTarget(frame, detections.BoundingBox(d))
+
+        self.pruneTracks()
+
+        return matches
+
+
+    def FramingBox(self, trackIds=None):
+        """
+        Calculates a single box framing a group of targets.
+        :param trackIds: IDs of the targets to frame (all tracked targets by default).
+        :return: BoundingBox enclosing all of the targets, or None if there are none.
+        """
+        tracks = [track for track in self.tracks.values() if trackIds is None or track.id in trackIds]
+        if not tracks:
+            return None
+
+        boxes = np.array([track.bbox.topLeft + track.bbox.bottomRight for track in tracks])
+        left, top = boxes[:, :2].min(axis=0)
+        right, bottom = boxes[:, 2:].max(axis=0)
+
+        return BoundingBox(left=left, top=top, right=right, bottom=bottom)
+
+
+    def Release(self):
+        """
+        Shuts down the thread pool.
+        """
+        self.pool.shutdown()
+
+
+    def assign(self, iou):
+        """
+        Internal function that finds the track/detection pairs maximizing total IoU.
+        :param iou: (tracks, detections) IoU matrix.
+        :return: List of (track index, detection index) pairs.
+        """
+        if linear_sum_assignment is not None:
+            rows, cols = linear_sum_assignment(-iou)
+            return list(zip(rows.tolist(), cols.tolist()))
+
+        # Greedy: repeatedly take the best remaining pair.
+        pairs = []
+        iou = iou.copy()
+        for _ in range(min(iou.shape)):
+            t, d = np.unravel_index(np.argmax(iou), iou.shape)
+            if iou[t, d] <= 0:
+                break
+            pairs.append((int(t), int(d)))
+            iou[t, :] = -1
+            iou[:, d] = -1
+
+        return pairs
+
+
+    def createTracker(self, frame, bbox):
+        (x1, y1), (x2, y2) = bbox.topLeft, bbox.bottomRight
+
+        tracker = CreateMOSSETracker()
+        tracker.init(frame, (x1, y1, x2 - x1, y2 - y1))
+
+        return tracker
+
+
+    def pruneTracks(self):
+        for trackId in [track.id for track in self.tracks.values() if track.misses >= self.maxMisses]:
+            del self.tracks[trackId]
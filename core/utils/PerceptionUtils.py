@@ -1,3 +1,20 @@
+import collections
+import cv2
+import numpy as np
+
+# Compact detection record, mirroring the fields of jetson.inference.detectNet.Detection.
+Detection = collections.namedtuple('Detection', ['ClassID', 'Confidence', 'Left', 'Top', 'Right', 'Bottom'])
+
+def CreateMOSSETracker():
+    """
+    Creates a MOSSE tracker. OpenCV builds newer than the Jetson's (4.5.1+) only provide
+    it through the legacy tracking API.
+    """
+    if hasattr(cv2, 'TrackerMOSSE_create'):
+        return cv2.TrackerMOSSE_create()
+
+    return cv2.legacy.TrackerMOSSE_create()
+
 
 class BoundingBox:
     """
@@ -9,6 +26,9 @@ class BoundingBox:
         self.bottomRight = (int(right), int(bottom))
         self.center = ((left + right) / 2, (top + bottom) / 2)
 
+        # Unrounded corners, so moving the box (see Shifted) keeps its center's sub-pixel accuracy.
+        self.corners = (left, top, right, bottom)
+
 
     def VectorTo(self, otherBbox):
         """
@@ -22,3 +42,321 @@ class BoundingBox:
 
 
         return (int(x), int(y))
+
+
+    def Shifted(self, dx, dy):
+        """
+        :return: A copy of this bbox moved by (dx, dy).
+        """
+        left, top, right, bottom = self.corners
+        return BoundingBox(left=left + dx, top=top + dy, right=right + dx, bottom=bottom + dy)
+
+
+    def SearchWindow(self, expansion, minSize, frameSize):
+        """
+        Calculates a window around this bbox to search for the target in, keeping the
+        aspect ratio of minSize and staying inside of the frame.
+        :param expansion: Factor by which the bbox is grown in each dimension.
+        :param minSize: (width, height) smallest window, also defines its aspect ratio.
+        :param frameSize: (width, height) of the frame.
+        :return (left, top, right, bottom): Window in frame coordinates (ints).
+        """
+        minW, minH = minSize
+        frameW, frameH = frameSize
+        boxW = self.bottomRight[0] - self.topLeft[0]
+        boxH = self.bottomRight[1] - self.topLeft[1]
+
+        # Grow until the expanded box fits, keeping the window's aspect ratio fixed.
+        scale = max(1.0, expansion * boxW / minW, expansion * boxH / minH)
+        winW, winH = min(int(minW * scale), frameW), min(int(minH * scale), frameH)
+
+        # Center on the bbox, then shift back inside the frame if needed.
+        left = min(max(int(self.center[0] - winW / 2), 0), frameW - winW)
+        top = min(max(int(self.center[1] - winH / 2), 0), frameH - winH)
+
+        return left, top, left + winW, top + winH
+
+
+class GrayPyramid:
+    """
+    Grayscale image pyramid (each level half the size of the previous one), built into
+    buffers reused from frame to frame.
+    args:
+    - maxLevel: Deepest level that can be built (level 0 is the full resolution grayscale frame).
+    """
+
+    def __init__(self, maxLevel=3):
+        self.maxLevel = maxLevel
+        self.levels = [None] * (maxLevel + 1)
+
+
+    def Build(self, frame, level):
+        """
+        Builds the pyramid of a frame down to a given level.
+        :param frame: Frame in BGR(x) or grayscale.
+        :param level: Deepest level needed.
+        :return: Image at that level.
+        """
+        if frame.ndim == 2:
+            self.levels[0] = frame
+        else:
+            code = cv2.COLOR_BGRA2GRAY if frame.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+            self.levels[0] = cv2.cvtColor(frame, code, dst=self.buffer(0, frame.shape[:2]))
+
+        for i in range(1, level + 1):
+            prev = self.levels[i - 1]
+            shape = ((prev.shape[0] + 1) // 2, (prev.shape[1] + 1) // 2)
+            self.levels[i] = cv2.pyrDown(prev, dst=self.buffer(i, shape))
+
+        return self.levels[level]
+
+
+    def LevelFor(self, bbox, minSize):
+        """
+        Picks the coarsest level at which a bbox is still at least minSize pixels on its shorter side.
+        """
+        shortSide = min(bbox.bottomRight[0] - bbox.topLeft[0], bbox.bottomRight[1] - bbox.topLeft[1])
+        level = 0
+        while level < self.maxLevel and shortSide / 2 ** (level + 1) >= minSize:
+            level += 1
+
+        return level
+
+
+    def buffer(self, level, shape):
+        buffer = self.levels[level]
+        # Level 0 may be a caller's grayscale frame, which must not be written to.
+        if buffer is None or buffer.shape != shape or (level == 0 and not buffer.flags.owndata):
+            buffer = np.empty(shape, dtype=np.uint8)
+        return buffer
+
+
+def IoUMatrix(boxesA, boxesB):
+    """
+    Calculates the intersection over union of every pair of boxes in two sets at once.
+    :param boxesA: (N, 4) array of (left, top, right, bottom) boxes.
+    :param boxesB: (M, 4) array of (left, top, right, bottom) boxes.
+    :return: (N, M) array of IoUs.
+    """
+    a = np.asarray(boxesA, dtype=np.float32).reshape(-1, 1, 4)
+    b = np.asarray(boxesB, dtype=np.float32).reshape(1, -1, 4)
+
+    interW = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    interH = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = interW * interH
+
+    areaA = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    areaB = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+
+    return inter / np.maximum(areaA + areaB - inter, 1e-6)
+
+
+def PlanTiles(frameSize, grid, overlap):
+    """
+    Splits a frame into a grid of tiles of the same size, neighboring tiles overlapping by a fraction of it.
+    :param frameSize: (width, height) of the frame.
+    :param grid: (columns, rows) of tiles.
+    :param overlap: Fraction of a tile's width (height) shared with the next tile in its row (column).
+    :return: (N, 4) int array of (left, top, right, bottom) tiles, row by row.
+    """
+    width, height = frameSize
+    columns, rows = grid
+    tileW = min(int(np.ceil(width / (columns - (columns - 1) * overlap))), width)
+    tileH = min(int(np.ceil(height / (rows - (rows - 1) * overlap))), height)
+
+    lefts = np.linspace(0, width - tileW, columns).round().astype(int)
+    tops = np.linspace(0, height - tileH, rows).round().astype(int)
+
+    return np.array([(left, top, left + tileW, top + tileH) for top in tops for left in lefts], dtype=int)
+
+
+class Detections:
+    """
+    NumPy-backed set of detection results: an (N, 4) array of boxes (left, top, right, bottom),
+    N scores and N class IDs. All filtering and matching is vectorized over the whole set.
+    Iterating over it yields Detection records, so it can be used wherever a list of
+    detections is expected.
+    """
+
+    def __init__(self, boxes, scores, classes):
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        self.classes = np.asarray(classes, dtype=np.int32).reshape(-1)
+
+
+    @staticmethod
+    def FromRecords(records):
+        """
+        Builds a set of detections from Detection records (or anything with the same fields,
+        such as jetson.inference.detectNet.Detection).
+        """
+        if isinstance(records, Detections):
+            return records
+
+        records = list(records)
+        boxes = [(r.Left, r.Top, r.Right, r.Bottom) for r in records]
+        return Detections(boxes, [r.Confidence for r in records], [r.ClassID for r in records])
+
+
+    @staticmethod
+    def FromArray(array):
+        """
+        Builds a set of detections from an (N, 6) array of [classId, confidence, left, top, right, bottom] rows.
+        """
+        array = np.asarray(array, dtype=np.float32).reshape(-1, 6)
+        return Detections(array[:, 2:6], array[:, 1], array[:, 0])
+
+
+    def __len__(self):
+        return len(self.scores)
+
+
+    def __getitem__(self, i):
+        left, top, right, bottom = self.boxes[i].tolist()
+        return Detection(int(self.classes[i]), float(self.scores[i]), left, top, right, bottom)
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+    def BoundingBox(self, i):
+        """
+        :return: BoundingBox of the i-th detection.
+        """
+        left, top, right, bottom = self.boxes[i].tolist()
+        return BoundingBox(left=left, top=top, right=right, bottom=bottom)
+
+
+    def Filter(self, classID=None, minScore=None):
+        """
+        :return: Detections of the given class and with at least the given score.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if classID is not None:
+            mask &= self.classes == classID
+        if minScore is not None:
+            mask &= self.scores >= minScore
+
+        return Detections(self.boxes[mask], self.scores[mask], self.classes[mask])
+
+
+    def Transformed(self, scaleX, scaleY, offsetX, offsetY):
+        """
+        :return: Detections with boxes scaled and then offset (e.g. from a crop back to full-frame coordinates).
+        """
+        boxes = self.boxes * np.array([scaleX, scaleY, scaleX, scaleY], dtype=np.float32) \
+                + np.array([offsetX, offsetY, offsetX, offsetY], dtype=np.float32)
+
+        return Detections(boxes, self.scores, self.classes)
+
+
+    def NonMaxSuppression(self, threshold=0.5, groups=None):
+        """
+        Merges detections of the same object, e.g. seen by several overlapping tiles of a frame. Overlap
+        is measured as the intersection over the smaller box, since an object cut by a tile's edge yields a
+        box lying inside the one from the tile that saw all of it. Detections are kept by decreasing
+        confidence, each growing to cover the ones it suppresses (so an object split between tiles is made
+        whole again, the grown box taking in the pieces it then overlaps).
+        :param threshold: Overlap above which two detections of the same class are of the same object.
+        :param groups: Array with the group (e.g. tile) of every detection. Detections of the same group
+                       don't suppress each other, the detector already did within a group.
+        :return: Detections kept.
+        """
+        if len(self) < 2:
+            return self
+
+        boxes = self.boxes
+        groups = np.asarray(groups) if groups is not None else np.arange(len(self))
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        order = np.argsort(-self.scores, kind="stable")
+        suppressed = np.zeros(len(self), dtype=bool)
+        kept, keptBoxes = [], []
+
+        for i in order:
+            if suppressed[i]:
+                continue
+            suppressed[i] = True
+            box = boxes[i].copy()
+            merged = {groups[i]}
+
+            while True:
+                interW = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+                interH = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+                boxArea = (box[2] - box[0]) * (box[3] - box[1])
+                overlaps = interW * interH / np.maximum(np.minimum(areas, boxArea), 1e-6)
+
+                candidates = ~suppressed & (self.classes == self.classes[i]) & (overlaps >= threshold) \
+                             & ~np.isin(groups, list(merged))
+                members = order[candidates[order]]
+                if len(members) == 0:
+                    break
+
+                # At most one (the most confident) detection per group joins at a time.
+                members = members[np.unique(groups[members], return_index=True)[1]]
+                suppressed[members] = True
+                merged.update(groups[members].tolist())
+                box[:2] = np.minimum(box[:2], boxes[members, :2].min(axis=0))
+                box[2:] = np.maximum(box[2:], boxes[members, 2:].max(axis=0))
+
+            kept.append(i)
+            keptBoxes.append(box)
+
+        return Detections(keptBoxes, self.scores[kept], self.classes[kept])
+
+
+    def IoU(self, bbox):
+        """
+        :param bbox: BoundingBox to compare against.
+        :return: Array with the intersection over union of every detection with bbox.
+        """
+        return IoUMatrix(self.boxes, [bbox.topLeft + bbox.bottomRight])[:, 0]
+
+
+    def CenterDistance(self, bbox):
+        """
+        :param bbox: BoundingBox to compare against.
+        :return: Array with the distance from the center of every detection to the center of bbox.
+        """
+        centersX = (self.boxes[:, 0] + self.boxes[:, 2]) / 2
+        centersY = (self.boxes[:, 1] + self.boxes[:, 3]) / 2
+
+        return np.hypot(centersX - bbox.center[0], centersY - bbox.center[1])
+
+
+    def BestMatch(self, bbox, velocity=(0, 0), framesAhead=0, maxDistance=1.5, appearance=None, appearanceWeight=1.0,
+                  minAppearance=0.0):
+        """
+        Picks the detection that best matches a previously tracked target. Every detection
+        is scored on its overlap with the target's last bbox and with the bbox predicted
+        from the target's velocity, minus its (normalized) center distance to the prediction,
+        plus how much it looks like the target if known, with its confidence used to break ties.
+        :param bbox: Last known BoundingBox of the target.
+        :param velocity: (x, y) target motion in pixels per frame.
+        :param framesAhead: Frames elapsed since bbox, to predict where the target is now.
+        :param maxDistance: Detections further than this many bbox diagonals from the prediction are rejected.
+        :param appearance: Array with the appearance similarity (0-1) of every detection to the target (see AppearanceModel).
+        :param appearanceWeight: Weight of the appearance similarity in the score.
+        :param minAppearance: Detections less similar to the target than this are rejected.
+        :return: Index of the best matching detection, or -1 if none is plausible.
+        """
+        if len(self) == 0:
+            return -1
+
+        dx, dy = velocity[0] * framesAhead, velocity[1] * framesAhead
+        (x1, y1), (x2, y2) = bbox.topLeft, bbox.bottomRight
+        predicted = BoundingBox(left=x1 + dx, top=y1 + dy, right=x2 + dx, bottom=y2 + dy)
+
+        diagonal = max(np.hypot(x2 - x1, y2 - y1), 1.0)
+        distance = self.CenterDistance(predicted) / diagonal
+        overlap = np.maximum(self.IoU(bbox), self.IoU(predicted))
+
+        scores = overlap - 0.5 * distance + 0.1 * self.scores
+        if appearance is not None:
+            scores += appearanceWeight * appearance
+            scores[appearance < minAppearance] = -np.inf
+        scores[distance > maxDistance] = -np.inf
+
+        best = int(np.argmax(scores))
+        return best if np.isfinite(scores[best]) else -1
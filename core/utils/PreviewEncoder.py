@@ -0,0 +1,247 @@
+import cv2
+import numpy as np
+
+from utils.WireProtocol import Preview
+
+
+class PreviewEncoder:
+    """
+    Encodes frames into compact previews for the remote interface, sized to fit a byte budget
+    per preview. JPEG quality, then resolution, is lowered when a keyframe exceeds the budget
+    and raised again while keyframes come out well under it.
+    Between keyframes, only the tiles that changed since the last preview are sent: they are
+    packed side by side into a single strip image, so there is a single image header per
+    preview. Changes are measured against the previews as the remote decodes them, so that
+    slow changes and compression artifacts don't add up unnoticed: a tile is sent again once
+    it differs from what the remote shows by changeThreshold more than right after it was sent. A keyframe is sent every keyframeInterval previews, when too many tiles changed
+    to save anything, or when the resolution changes.
+    args:
+    - byteBudget: Target size of a single preview in bytes.
+    - minScale: Smallest fraction of the thumbnail resolution that adaptation can go down to.
+    - tileSize: Side of the square tiles (in preview pixels) changes are detected on.
+    - keyframeInterval: Previews between keyframes.
+    - changeThreshold: Mean absolute difference (0-255), on top of the tile's compression error, above which
+      a tile counts as changed.
+    - maxChangedFraction: Fraction of changed tiles above which a keyframe is sent instead.
+    """
+
+    MIN_QUALITY = 20
+    MAX_QUALITY = 85
+
+    # Encoding attempts for a keyframe that comes out over budget.
+    KEYFRAME_ATTEMPTS = 3
+
+    def __init__(self, byteBudget=12000, minScale=0.4, tileSize=16, keyframeInterval=30, changeThreshold=6.0,
+                 maxChangedFraction=0.5):
+        self.byteBudget = byteBudget
+        self.minScale = minScale
+        self.tileSize = tileSize
+        self.keyframeInterval = keyframeInterval
+        self.changeThreshold = changeThreshold
+        self.maxChangedFraction = maxChangedFraction
+
+        self.quality = 60
+        self.scale = 1.0
+        self.reference = None
+        # Per tile mean absolute difference between the frame and the reference when the tile was last sent.
+        self.codecError = None
+        self.seq = 0
+        self.sinceKeyframe = 0
+
+        # Statistics
+        self.keyframes = 0
+        self.deltas = 0
+        self.skipped = 0
+        self.bytesEncoded = 0
+
+
+    def Encode(self, thumbnail, sourceSize, keyframe=False):
+        """
+        Encodes a preview of a frame.
+        :param thumbnail: Downscaled frame (BGR or BGRx), see CommsMan.SendPreview.
+        :param sourceSize: (width, height) of the full frame, so the remote can map coordinates onto the preview.
+        :param keyframe: Force a keyframe (e.g. for the remote to pick a target on).
+        :return: Preview message, None if nothing changed since the last preview.
+        """
+        if thumbnail.ndim == 3 and thumbnail.shape[2] == 4:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGRA2BGR)
+
+        image = self.resize(thumbnail)
+
+        if (keyframe or self.reference is None or self.reference.shape != image.shape
+                or self.sinceKeyframe + 1 >= self.keyframeInterval):
+            return self.encodeKeyframe(thumbnail, image, sourceSize)
+
+        changed = self.changedTiles(image)
+        if not changed.any():
+            self.skipped += 1
+            return None
+
+        if changed.mean() > self.maxChangedFraction:
+            return self.encodeKeyframe(thumbnail, image, sourceSize)
+
+        # Pack the changed tiles side by side into a (T, k * T) strip.
+        T = self.tileSize
+        rows, cols = image.shape[0] // T, image.shape[1] // T
+        grid = changed.reshape(rows, cols)
+        tiles = image.reshape(rows, T, cols, T, -1).transpose(0, 2, 1, 3, 4)[grid]
+        strip = tiles.transpose(1, 0, 2, 3).reshape(T, -1, image.shape[2])
+
+        data = self.encodeImage(strip)
+        if len(data) > self.byteBudget:
+            # As big as a keyframe would be, might as well resynchronize.
+            return self.encodeKeyframe(thumbnail, image, sourceSize)
+
+        decoded = self.decodeImage(data).reshape(T, -1, T, image.shape[2]).transpose(1, 0, 2, 3)
+        self.reference.reshape(rows, T, cols, T, -1).transpose(0, 2, 1, 3, 4)[grid] = decoded
+        self.codecError[changed] = self.tileDifferences(image)[changed]
+
+        self.seq += 1
+        self.sinceKeyframe += 1
+        self.deltas += 1
+        self.bytesEncoded += len(data)
+
+        return Preview(False, self.seq, tuple(sourceSize), (image.shape[1], image.shape[0]), T,
+                       np.flatnonzero(changed), data)
+
+
+    def Stats(self):
+        return {
+            "keyframes": self.keyframes,
+            "deltas": self.deltas,
+            "skipped": self.skipped,
+            "bytesEncoded": self.bytesEncoded,
+            "quality": self.quality,
+            "scale": round(self.scale, 3),
+        }
+
+
+    def encodeKeyframe(self, thumbnail, image, sourceSize):
+        """
+        Internal function encoding a whole preview, adapting quality and resolution to the byte budget.
+        """
+        for _ in range(self.KEYFRAME_ATTEMPTS):
+            data = self.encodeImage(image)
+            if not self.adapt(len(data)):
+                break
+            image = self.resize(thumbnail)
+
+        self.reference = self.decodeImage(data)
+        self.codecError = self.tileDifferences(image)
+        self.seq += 1
+        self.sinceKeyframe = 0
+        self.keyframes += 1
+        self.bytesEncoded += len(data)
+
+        return Preview(True, self.seq, tuple(sourceSize), (image.shape[1], image.shape[0]), self.tileSize,
+                       np.empty(0, dtype=np.uint16), data)
+
+
+    def adapt(self, size):
+        """
+        Internal function adjusting quality and resolution after a keyframe of the given size.
+        :return: True if the keyframe was over budget and settings were lowered (worth encoding it again).
+        """
+        if size > self.byteBudget:
+            if self.quality > self.MIN_QUALITY:
+                self.quality = max(self.MIN_QUALITY, self.quality - 15)
+                return True
+            if self.scale > self.minScale:
+                self.scale = max(self.minScale, self.scale * 0.8)
+                return True
+            return False
+
+        # Comfortably under budget: spend it on quality first, then resolution.
+        if size < 0.6 * self.byteBudget:
+            if self.quality < self.MAX_QUALITY:
+                self.quality = min(self.MAX_QUALITY, self.quality + 5)
+            elif self.scale < 1.0:
+                self.scale = min(1.0, self.scale * 1.25)
+
+        return False
+
+
+    def resize(self, thumbnail):
+        """
+        Internal function scaling a thumbnail to the current resolution, rounded down to a whole number of tiles.
+        """
+        T = self.tileSize
+        height, width = thumbnail.shape[:2]
+        width = max(T, int(width * self.scale) // T * T)
+        height = max(T, int(height * self.scale) // T * T)
+
+        if (width, height) == (thumbnail.shape[1], thumbnail.shape[0]):
+            return thumbnail
+
+        return cv2.resize(thumbnail, (width, height), interpolation=cv2.INTER_AREA)
+
+
+    def changedTiles(self, image):
+        """
+        Internal function comparing an image against the reference tile by tile.
+        :return: Boolean (rows * cols) array, True for tiles that changed (row-major order).
+        """
+        return self.tileDifferences(image) > self.codecError + self.changeThreshold
+
+
+    def tileDifferences(self, image):
+        """
+        Internal function measuring how far an image is from the reference tile by tile.
+        :return: (rows * cols) array of mean absolute differences (row-major order).
+        """
+        T = self.tileSize
+        rows, cols = image.shape[0] // T, image.shape[1] // T
+
+        diff = cv2.absdiff(image, self.reference)
+        return diff.reshape(rows, T, cols, T, -1).mean(axis=(1, 3, 4)).reshape(-1)
+
+
+    def encodeImage(self, image):
+        success, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not success:
+            raise Exception('Could not encode preview')
+
+        return data.tobytes()
+
+
+    @staticmethod
+    def decodeImage(data):
+        """
+        Internal function decoding an encoded image the way the remote does (see PreviewDecoder).
+        """
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class PreviewDecoder:
+    """
+    Rebuilds previews on the receiving end (the remote interface, or tests).
+    """
+
+    def __init__(self):
+        self.canvas = None
+        self.seq = 0
+
+
+    def Apply(self, preview):
+        """
+        Applies a keyframe or tile update.
+        :param preview: Preview message.
+        :return: The current preview image, None until a keyframe has been received.
+        """
+        image = cv2.imdecode(np.frombuffer(preview.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+        if preview.keyframe:
+            self.canvas = image
+        elif self.canvas is not None and preview.seq == self.seq + 1:
+            T = preview.tileSize
+            rows, cols = self.canvas.shape[0] // T, self.canvas.shape[1] // T
+            tiles = image.reshape(T, -1, T, 3).transpose(1, 0, 2, 3)
+            tileRows, tileCols = np.divmod(preview.tiles, cols)
+            self.canvas.reshape(rows, T, cols, T, 3).transpose(0, 2, 1, 3, 4)[tileRows, tileCols] = tiles
+        else:
+            # Missed an update, wait for the next keyframe.
+            self.canvas = None
+
+        self.seq = preview.seq
+
+        return self.canvas
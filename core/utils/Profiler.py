@@ -0,0 +1,242 @@
+import bisect
+import collections
+import json
+import math
+import threading
+import time
+
+
+class Histogram:
+    """
+    Latency histogram with a fixed number of log-spaced buckets, so memory and recording cost
+    stay constant however long the system runs. Percentiles are accurate to the bucket width
+    (~12% with the default 20 buckets per decade).
+    args:
+    - minSeconds, maxSeconds: Range covered by the buckets (values outside go to the end buckets).
+    - bucketsPerDecade: Resolution of the buckets.
+    """
+
+    def __init__(self, minSeconds=1e-5, maxSeconds=100.0, bucketsPerDecade=20):
+        decades = math.log10(maxSeconds / minSeconds)
+        numEdges = int(round(decades * bucketsPerDecade)) + 1
+        self.edges = [minSeconds * 10 ** (i / bucketsPerDecade) for i in range(numEdges)]
+
+        # counts[i] holds values in (edges[i - 1], edges[i]], the last bucket values above maxSeconds.
+        self.counts = [0] * (numEdges + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def Record(self, seconds):
+        self.counts[bisect.bisect_left(self.edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+    def Percentile(self, p):
+        """
+        :param p: Percentile to look up (0-100).
+        :return: Upper bound (seconds) of the bucket the percentile falls in, 0 if empty.
+        """
+        if self.count == 0:
+            return 0.0
+
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # The max is a tighter bound than the bucket edge for the top bucket(s).
+                return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+
+        return self.max
+
+
+    def Snapshot(self):
+        """
+        :return: Dictionary with count and mean/p50/p90/p99/max latency in ms.
+        """
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50": round(self.Percentile(50) * 1000, 3),
+            "p90": round(self.Percentile(90) * 1000, 3),
+            "p99": round(self.Percentile(99) * 1000, 3),
+            "max": round(self.max * 1000, 3),
+        }
+
+
+class stageTimer:
+    """
+    Context manager timing a single stage (see Profiler.Stage).
+    """
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.Record(self.name, time.monotonic() - self.start)
+        return False
+
+
+class nullStage:
+    """
+    Context manager handed out while profiling is disabled.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = nullStage()
+
+
+class Profiler:
+    """
+    Instrumentation for the tracking pipeline. Stages are timed with a monotonic clock into
+    fixed-memory histograms, and frames are followed end to end with traces: a trace is
+    stamped with the frame's capture time (CameraMan.Capture) and ended once the frame has
+    been acted upon (e.g. motors commanded), recording glass-to-motor latency along with
+    the stages timed in between on the same thread.
+    While disabled, Stage returns a shared no-op context manager and the other calls return
+    immediately, so instrumentation can stay in place.
+    args:
+    - enabled: Whether to start collecting right away.
+    - traceHistory: Number of completed traces kept for snapshots.
+    """
+
+    def __init__(self, enabled=False, traceHistory=32):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.traces = collections.deque(maxlen=traceHistory)
+        self.nextTraceId = 1
+
+        # Each thread follows its own frame (e.g. the tracking loop vs. the reset worker).
+        self.local = threading.local()
+
+
+    def Stage(self, name):
+        """
+        Times a block of code: `with profiler.Stage("track"): ...`
+        :param name: Stage name, one histogram is kept per name.
+        """
+        if not self.enabled:
+            return NULL_STAGE
+
+        return stageTimer(self, name)
+
+
+    def Record(self, name, seconds):
+        """
+        Adds a duration to a stage's histogram (and to the calling thread's open trace, if any).
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.Record(seconds)
+
+        trace = getattr(self.local, "trace", None)
+        if trace is not None:
+            trace["stages"][name] = trace["stages"].get(name, 0.0) + seconds
+
+
+    def BeginTrace(self, captureTime):
+        """
+        Starts following a new frame on the calling thread (ending any trace left open).
+        :param captureTime: Time (time.monotonic) the frame was captured.
+        :return: Trace ID of the frame, 0 while disabled.
+        """
+        if not self.enabled:
+            return 0
+
+        with self.lock:
+            traceId = self.nextTraceId
+            self.nextTraceId += 1
+
+        self.local.trace = {"id": traceId, "captureTime": captureTime, "stages": {}}
+
+        return traceId
+
+
+    def EndTrace(self, name="glass_to_motor"):
+        """
+        Ends the calling thread's trace, recording the latency since its frame was captured.
+        :param name: Histogram the end-to-end latency is recorded in.
+        :return: Latency in seconds, None if no trace was open.
+        """
+        trace = getattr(self.local, "trace", None)
+        if not self.enabled or trace is None:
+            return None
+
+        self.local.trace = None
+        latency = time.monotonic() - trace["captureTime"]
+        self.Record(name, latency)
+
+        with self.lock:
+            self.traces.append({
+                "id": trace["id"],
+                name: round(latency * 1000, 3),
+                "stages": {stage: round(seconds * 1000, 3) for stage, seconds in trace["stages"].items()},
+            })
+
+        return latency
+
+
+    def CurrentTrace(self):
+        """
+        :return: ID of the calling thread's open trace, 0 if none.
+        """
+        trace = getattr(self.local, "trace", None)
+        return trace["id"] if trace is not None else 0
+
+
+    def Snapshot(self):
+        """
+        :return: Dictionary with per-stage latency summaries (ms) and the most recent traces.
+        """
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "stages": {name: histogram.Snapshot() for name, histogram in self.histograms.items()},
+                "traces": list(self.traces),
+            }
+
+
+    def StatusMessage(self):
+        """
+        :return: Snapshot formatted as a status message for the remote interface (see CommsMan).
+        """
+        return "Status;" + json.dumps(self.Snapshot(), sort_keys=True, separators=(",", ":"))
+
+
+    def Reset(self):
+        """
+        Clears all collected histograms and traces.
+        """
+        with self.lock:
+            self.histograms = {}
+            self.traces.clear()
+
+
+# Profiler shared by the managers (disabled until SystemMan or the benchmark enables it).
+PROFILER = Profiler()
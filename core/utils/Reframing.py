@@ -0,0 +1,238 @@
+import time
+
+import cv2
+import numpy as np
+
+from utils.ImageSources import LocalVideo
+from utils.PerceptionUtils import BoundingBox, IoUMatrix
+
+# Offline reframing of footage shot on a static camera: the target is tracked through the video in
+# independent chunks (so a long video can be spread over several processes, see Reframe.py), the
+# chunks' tracks are stitched into one, and a smoothly panning crop around the target is rendered.
+#
+#   frames   0 ............................................................ N
+#   chunks   [ chunk 0        ]
+#                        [ overlap ][ chunk 1         ]
+#                                               [ overlap ][ chunk 2        ]
+#
+# Two consecutive chunks both track the frames they overlap on, which tells whether they followed
+# the same target, and lets the track cross-fade from one to the other instead of jumping at the seam.
+
+
+def PlanChunks(numFrames, chunkFrames, overlapFrames):
+    """
+    Splits a video into chunks of about the same length, consecutive ones sharing overlapFrames frames.
+    :param numFrames: Length of the video.
+    :param chunkFrames: Longest chunk.
+    :param overlapFrames: Frames two consecutive chunks share.
+    :return: List of (start, end) frame ranges.
+    """
+    if 2 * overlapFrames >= chunkFrames:
+        raise ValueError("Chunks of %d frames can't overlap on %d frames" % (chunkFrames, overlapFrames))
+
+    numChunks = max(int(np.ceil((numFrames - overlapFrames) / (chunkFrames - overlapFrames))), 1)
+    step = (numFrames - overlapFrames) / numChunks
+
+    return [(int(round(k * step)), min(int(round((k + 1) * step)) + overlapFrames, numFrames))
+            for k in range(numChunks)]
+
+
+def TrackChunk(path, start, end, perceptionFactory, classID=1, seedBox=None, retryFrames=10):
+    """
+    Tracks the target through a range of frames of a video, independently of the rest of it (run in
+    a worker process). The target is found by object detection on the first frame, unless a seed
+    box is given, and the tracker is reset from detection whenever it loses the target or a reset
+    is due (see PerceptionMan.ResetDue). Resets run synchronously: offline, every frame can wait.
+    :param path: Video file.
+    :param start, end: Frame range to track.
+    :param perceptionFactory: Picklable callable building the PerceptionMan to track with.
+    :param classID: Class of the target (see PerceptionMan.FindClassInDetections).
+    :param seedBox: (left, top, right, bottom) box of the target in the first frame, if known.
+    :param retryFrames: Frames between two detections while the target is lost.
+    :return boxes: (end - start, 4) array of (left, top, right, bottom) boxes, NaN where the target wasn't found.
+    :return stats: Dictionary of frames tracked, resets and seconds spent.
+    """
+    startTime = time.monotonic()
+    per = perceptionFactory()
+    source = LocalVideo(path)
+    source.Seek(start)
+
+    boxes = np.full((end - start, 4), np.nan, dtype=np.float32)
+    frame = None
+    tracking = False
+    framesSinceDetection = retryFrames
+    resets = 0
+    processed = 0
+
+    try:
+        for index in range(end - start):
+            try:
+                frame = source.GetFrame()[0] if frame is None else source.ReadInto(frame)
+            except Exception:
+                # The container's frame count was only an estimate.
+                break
+            height, width = frame.shape[:2]
+            processed += 1
+            framesSinceDetection += 1
+
+            bbox = None
+            if not tracking:
+                if index == 0 and seedBox is not None:
+                    bbox = BoundingBox(*seedBox)
+                elif framesSinceDetection >= retryFrames:
+                    detections, _ = per.DetectObjects(per.PrepareFrame(frame), width, height)
+                    bbox = per.FindClassInDetections(detections, classID, frame=frame)
+                    framesSinceDetection = 0
+
+                if bbox is not None:
+                    per.InitTracker(frame, bbox)
+                    tracking = True
+            else:
+                success, _, newBbox = per.TrackObjectInNewFrame(frame)
+                bbox = newBbox if success else None
+
+                # Periodic resets keep the tracker from drifting, and it's retried every few frames once lost.
+                if per.ResetDue() if success else framesSinceDetection >= retryFrames:
+                    previous = per.currBoundingBox
+                    per.ResetTracker(frame, width, height, classID)
+                    framesSinceDetection = 0
+                    resets += 1
+                    if per.currBoundingBox is not previous:
+                        bbox = per.currBoundingBox
+
+            if bbox is not None:
+                boxes[index] = bbox.topLeft + bbox.bottomRight
+    finally:
+        source.Close()
+        per.Release()
+
+    return boxes, {"frames": processed, "resets": resets, "seconds": time.monotonic() - startTime}
+
+
+def StitchTracks(chunks, tracks, minAgreement=0.3):
+    """
+    Joins the tracks of consecutive chunks into one. On the frames two chunks overlap, the track
+    cross-fades from the first chunk's boxes to the second's. Chunks that followed something else
+    than the chunk before them (median IoU of their boxes on the overlap under minAgreement) are
+    reported, to be tracked again starting from the previous chunk's box (see SeedFor).
+    :param chunks: List of (start, end) frame ranges (see PlanChunks).
+    :param tracks: List of the chunks' boxes (see TrackChunk).
+    :param minAgreement: Median IoU on the overlap for two chunks to be considered on the same target.
+    :return track: (numFrames, 4) array of boxes, NaN where the target wasn't found.
+    :return mismatched: Indices of the chunks that disagree with the chunk before them.
+    """
+    track = np.full((chunks[-1][1], 4), np.nan, dtype=np.float32)
+    mismatched = []
+
+    for k, ((start, end), boxes) in enumerate(zip(chunks, tracks)):
+        overlap = chunks[k - 1][1] - start if k > 0 else 0
+        track[start + overlap:end] = boxes[overlap:]
+        if overlap == 0:
+            continue
+
+        previous = track[start:start + overlap]
+        current = boxes[:overlap]
+        validPrevious = ~np.isnan(previous[:, 0])
+        validCurrent = ~np.isnan(current[:, 0])
+        both = validPrevious & validCurrent
+
+        if both.any() and np.median(np.diag(IoUMatrix(previous[both], current[both]))) < minAgreement:
+            mismatched.append(k)
+
+        # Linear cross-fade where both chunks found the target, whichever did elsewhere.
+        weights = ((np.arange(overlap) + 1) / (overlap + 1))[:, None]
+        blended = np.where(both[:, None], previous * (1 - weights) + current * weights,
+                           np.where(validCurrent[:, None], current, previous))
+        track[start:start + overlap] = blended
+
+    return track, mismatched
+
+
+def SeedFor(chunks, tracks, k):
+    """
+    Finds where to track chunk k again from, for it to follow the same target as chunk k - 1: the
+    first frame of their overlap chunk k - 1 found the target in.
+    :return: (frame, (left, top, right, bottom) box), None if chunk k - 1 didn't find the target on the overlap.
+    """
+    start = chunks[k][0]
+    previousStart, previousEnd = chunks[k - 1]
+    overlap = tracks[k - 1][start - previousStart:previousEnd - previousStart]
+
+    found = np.flatnonzero(~np.isnan(overlap[:, 0]))
+    if len(found) == 0:
+        return None
+
+    return start + int(found[0]), tuple(float(v) for v in overlap[found[0]])
+
+
+def CameraPath(track, frameSize, cropSize, smoothing):
+    """
+    Plans the virtual camera: where the crop is centered on every frame. The target's center is
+    interpolated over the frames it wasn't found in and smoothed with a Gaussian over time (both
+    ways, the whole track being known), so the crop pans steadily rather than following every
+    jitter of the tracker, then kept so that the crop stays inside the frame.
+    :param track: (numFrames, 4) array of boxes, NaN where the target wasn't found (see StitchTracks).
+    :param frameSize: (width, height) of the video.
+    :param cropSize: (width, height) of the crop.
+    :param smoothing: Standard deviation of the Gaussian, in frames (no smoothing if 0).
+    :return: (numFrames, 2) array of crop centers.
+    """
+    width, height = frameSize
+    numFrames = len(track)
+    centers = (track[:, :2] + track[:, 2:]) / 2
+    found = ~np.isnan(centers[:, 0])
+
+    # Centered until the target is first found, and where it was last seen once it's gone for good.
+    if not found.any():
+        centers = np.tile(np.float32([width / 2, height / 2]), (numFrames, 1))
+    else:
+        indices = np.arange(numFrames)
+        centers = np.stack([np.interp(indices, indices[found], centers[found, axis]) for axis in range(2)], axis=1)
+
+    if smoothing > 0:
+        radius = int(np.ceil(3 * smoothing))
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / smoothing) ** 2)
+        kernel /= kernel.sum()
+        padded = np.pad(centers, ((radius, radius), (0, 0)), mode="edge")
+        centers = np.stack([np.convolve(padded[:, axis], kernel, mode="valid") for axis in range(2)], axis=1)
+
+    cropW, cropH = cropSize
+    centers[:, 0] = np.clip(centers[:, 0], cropW / 2, width - cropW / 2)
+    centers[:, 1] = np.clip(centers[:, 1], cropH / 2, height - cropH / 2)
+
+    return centers.astype(np.float32)
+
+
+def RenderChunk(path, start, end, centers, cropSize, outputPath, fps):
+    """
+    Writes the crops of a range of frames of a video to a new video (run in a worker process). Crops
+    are sampled at sub-pixel positions, so slow pans don't move in whole-pixel steps.
+    :param path: Video file.
+    :param start, end: Frame range to render.
+    :param centers: (end - start, 2) array of crop centers (see CameraPath).
+    :param cropSize: (width, height) of the crop.
+    :param outputPath: Video file to write.
+    :param fps: Frame rate of the output.
+    :return frames: Number of frames written.
+    :return seconds: Seconds spent.
+    """
+    startTime = time.monotonic()
+    source = LocalVideo(path)
+    source.Seek(start)
+    writer = cv2.VideoWriter(outputPath, cv2.VideoWriter_fourcc(*'mp4v'), fps, tuple(cropSize))
+
+    frame = None
+    written = 0
+    try:
+        for index in range(end - start):
+            try:
+                frame = source.GetFrame()[0] if frame is None else source.ReadInto(frame)
+            except Exception:
+                break
+            writer.write(cv2.getRectSubPix(frame, tuple(cropSize), tuple(float(v) for v in centers[index])))
+            written += 1
+    finally:
+        writer.release()
+        source.Close()
+
+    return written, time.monotonic() - startTime
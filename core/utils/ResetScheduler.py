@@ -0,0 +1,140 @@
+import math
+import time
+
+
+class ResetScheduler:
+    """
+    Decides when the tracker should be reset with object detection, based on a
+    per-frame tracking quality signal in [0, 1] instead of a fixed number of frames.
+    Low quality triggers an early reset, sustained high quality stretches the interval
+    between resets, and a token bucket caps how often the detector can be invoked.
+    args:
+    - minInterval: Minimum number of frames between scheduled resets.
+    - maxInterval: Number of frames between resets when quality is perfect.
+    - lowQuality: Smoothed quality under which a reset is requested as soon as allowed.
+    - maxResetsPerSecond: Cap on detector invocations per second (burst of at most one second's worth).
+    """
+
+    def __init__(self, minInterval=5, maxInterval=60, lowQuality=0.4, maxResetsPerSecond=2.0):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.lowQuality = lowQuality
+        self.maxResetsPerSecond = maxResetsPerSecond
+
+        self.framesSinceReset = 0
+        self.quality = 1.0
+
+        self.tokens = max(maxResetsPerSecond, 1.0)
+        self.lastRefill = time.monotonic()
+
+        # Whether the last claim was refused: a reset the cap holds back is asked for again on every frame
+        # until it goes through, and only counts as throttled once.
+        self.refused = False
+
+        # Statistics
+        self.resets = 0
+        self.earlyResets = 0
+        self.throttled = 0
+
+
+    def Update(self, quality):
+        """
+        Feeds the tracking quality of the latest frame to the scheduler.
+        :param quality: Value in [0, 1], 0 meaning tracking failed.
+        """
+        self.framesSinceReset += 1
+
+        # Smooth the signal a little so a single noisy frame doesn't trigger a reset,
+        # but let drops through quickly.
+        alpha = 0.5 if quality < self.quality else 0.1
+        self.quality += alpha * (quality - self.quality)
+
+
+    def ResetDue(self):
+        """
+        :return: True if the tracker should be reset now (subject to the rate cap, see Acquire).
+        """
+        if self.framesSinceReset < self.minInterval:
+            return False
+
+        if self.quality < self.lowQuality:
+            return True
+
+        return self.framesSinceReset >= self.Interval()
+
+
+    def Interval(self):
+        """
+        :return: Current number of frames between scheduled resets.
+        """
+        return self.minInterval + (self.maxInterval - self.minInterval) * self.quality ** 2
+
+
+    def Acquire(self, now=None):
+        """
+        Claims a detector invocation from the rate cap. Must be called (and return True)
+        before every reset, scheduled or not.
+        :return: True if a reset may be started now, False if the cap has been reached.
+        """
+        now = time.monotonic() if now is None else now
+        capacity = max(self.maxResetsPerSecond, 1.0)
+
+        self.tokens = min(capacity, self.tokens + (now - self.lastRefill) * self.maxResetsPerSecond)
+        self.lastRefill = now
+
+        if self.tokens < 1.0:
+            if not self.refused:
+                self.throttled += 1
+            self.refused = True
+            return False
+
+        self.refused = False
+        self.tokens -= 1.0
+        self.resets += 1
+        if self.framesSinceReset < self.Interval():
+            self.earlyResets += 1
+        self.framesSinceReset = 0
+
+        return True
+
+
+    def Stats(self):
+        """
+        :return: Dictionary with the scheduler's current state and counters.
+        """
+        return {
+            "quality": self.quality,
+            "interval": self.Interval(),
+            "resets": self.resets,
+            "earlyResets": self.earlyResets,
+            "throttled": self.throttled,
+        }
+
+
+def TrackingQuality(success, prevBbox, newBbox, velocity):
+    """
+    Estimates how trustworthy the latest tracker update is, from 1 (steady) down to 0 (lost).
+    OpenCV's MOSSE tracker doesn't expose its correlation peak, so the estimate is based on how
+    much the box moved relative to its own size, how abruptly its motion changed, and how
+    much its scale jumped.
+    :param success: Whether the tracker update succeeded.
+    :param prevBbox, newBbox: BoundingBox before and after the update.
+    :param velocity: (x, y) smoothed target motion in pixels per frame before the update.
+    :return: Quality in [0, 1].
+    """
+    if not success:
+        return 0.0
+
+    prevW = prevBbox.bottomRight[0] - prevBbox.topLeft[0]
+    prevH = prevBbox.bottomRight[1] - prevBbox.topLeft[1]
+    newW = newBbox.bottomRight[0] - newBbox.topLeft[0]
+    newH = newBbox.bottomRight[1] - newBbox.topLeft[1]
+    size = max(math.hypot(prevW, prevH), 1.0)
+
+    flowX = newBbox.center[0] - prevBbox.center[0]
+    flowY = newBbox.center[1] - prevBbox.center[1]
+    speed = math.hypot(flowX, flowY) / size
+    jerk = math.hypot(flowX - velocity[0], flowY - velocity[1]) / size
+    scaleJump = abs(math.log(max(newW * newH, 1) / max(prevW * prevH, 1)))
+
+    return math.exp(-(4.0 * speed + 8.0 * jerk + 2.0 * scaleJump))
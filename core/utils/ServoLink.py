@@ -0,0 +1,143 @@
+import os
+import select
+import struct
+import termios
+import tty
+
+# Binary protocol between MotorMan and the pan/tilt servo controller, over a serial line.
+#
+# Every command carries the absolute target of both axes, so a newer command supersedes
+# any older one (see ServoScheduler), and the controller acknowledges each of them:
+#   command = sync 0xA5 | seq (u8) | pan (i16) | tilt (i16) | checksum (u8)
+#   ack     = sync 0x5A | seq (u8) | status (u8) | checksum (u8)
+# Angles are in hundredths of a degree, integers little endian, and the checksum is the
+# low byte of the sum of the bytes before it.
+
+COMMAND_SYNC = 0xA5
+ACK_SYNC = 0x5A
+
+COMMAND_PACKET = struct.Struct("<BBhhB")
+ACK_PACKET = struct.Struct("<BBBB")
+
+# Ack status codes
+ACK_OK = 0
+# The target was out of the servos' range, they were sent to the nearest angle they can reach.
+ACK_CLAMPED = 1
+
+ANGLE_SCALE = 100
+
+
+def checksum(data):
+    return sum(data) & 0xFF
+
+
+def EncodeCommand(seq, pan, tilt):
+    """
+    :param seq: Sequence number of the command, echoed by its ack (wraps around at 256).
+    :param pan, tilt: Target angles (degrees).
+    :return: bytes
+    """
+    limit = 32767 / ANGLE_SCALE
+    pan = int(round(min(max(pan, -limit), limit) * ANGLE_SCALE))
+    tilt = int(round(min(max(tilt, -limit), limit) * ANGLE_SCALE))
+    body = COMMAND_PACKET.pack(COMMAND_SYNC, seq & 0xFF, pan, tilt, 0)[:-1]
+    return body + bytes([checksum(body)])
+
+
+def EncodeAck(seq, status=ACK_OK):
+    body = ACK_PACKET.pack(ACK_SYNC, seq & 0xFF, status, 0)[:-1]
+    return body + bytes([checksum(body)])
+
+
+class PacketReader:
+    """
+    Reassembles packets of one type (commands or acks) from a serial byte stream. Bytes that don't
+    start a packet with a valid checksum (line noise, a packet cut by a reconnection) are skipped
+    until the stream is in sync again.
+    args:
+    - packet: struct.Struct of the packets (COMMAND_PACKET or ACK_PACKET).
+    - sync: First byte of the packets.
+    """
+
+    def __init__(self, packet, sync):
+        self.packet = packet
+        self.sync = sync
+        self.buffer = bytearray()
+
+        # Statistics
+        self.skippedBytes = 0
+
+
+    def Feed(self, data):
+        """
+        Adds received bytes and decodes every packet completed by them.
+        :return: List of unpacked packets (tuples of the packet's fields, without sync and checksum).
+        """
+        self.buffer += data
+        size = self.packet.size
+        packets = []
+        offset = 0
+
+        while len(self.buffer) - offset >= size:
+            if self.buffer[offset] != self.sync or checksum(self.buffer[offset:offset + size - 1]) != self.buffer[offset + size - 1]:
+                offset += 1
+                self.skippedBytes += 1
+                continue
+
+            packets.append(self.packet.unpack_from(self.buffer, offset)[1:-1])
+            offset += size
+
+        del self.buffer[:offset]
+
+        return packets
+
+
+class SerialLink:
+    """
+    Raw serial line to the servo controller (a UART device such as /dev/ttyTHS1 on the Jetson, or a
+    pseudo-terminal, see FakeServo). The line is put in raw mode so bytes go through untouched.
+    args:
+    - path: Serial device.
+    - baudrate: Line speed (bits per second).
+    """
+
+    # Bytes read per system call.
+    READ_SIZE = 256
+
+    def __init__(self, path, baudrate=115200):
+        self.path = path
+        self.baudrate = baudrate
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+
+        tty.setraw(self.fd)
+        attributes = termios.tcgetattr(self.fd)
+        attributes[4] = attributes[5] = getattr(termios, "B%d" % baudrate)
+        termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+
+
+    def Write(self, data):
+        """
+        Writes all of data to the line (blocks until the driver took it).
+        """
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+
+
+    def Read(self, timeout):
+        """
+        Waits for data from the line.
+        :param timeout: Max seconds to wait.
+        :return: bytes received, empty if none came in time.
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0.0))
+        if not ready:
+            return b""
+
+        return os.read(self.fd, self.READ_SIZE)
+
+
+    def Close(self):
+        os.close(self.fd)
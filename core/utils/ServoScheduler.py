@@ -0,0 +1,187 @@
+import threading
+import time
+
+from utils.Profiler import Histogram
+from utils.ServoLink import EncodeCommand, PacketReader, ACK_PACKET, ACK_SYNC, ACK_CLAMPED
+
+
+class ServoScheduler:
+    """
+    Sends pan/tilt targets to the servo controller from its own thread, so the tracking loop never
+    blocks on the serial line. Targets are handed over without waiting, and the ones that come in
+    faster than the control rate are coalesced: only the newest one is sent, both axes in one write.
+    Commands go out at most once per control period, each one waiting for its ack for up to
+    ackTimeout (one in flight at a time, the controller can't take more); a command that isn't
+    acknowledged is sent again on the next period, unless a newer target replaced it. A target
+    that couldn't be sent before its deadline is dropped, the motors being better off holding
+    still than catching up on where the target was.
+    args:
+    - link: SerialLink (or anything with Write, Read(timeout) and Close) to the controller.
+    - rate: Control rate (commands per second).
+    - ackTimeout: Seconds to wait for a command's ack (within the control period by default).
+    - maxAge: Seconds after which a target that hasn't been sent is dropped (see Command's deadline).
+    """
+
+    def __init__(self, link, rate=50.0, ackTimeout=None, maxAge=0.1):
+        self.link = link
+        self.period = 1.0 / rate
+        self.ackTimeout = ackTimeout if ackTimeout is not None else 0.8 * self.period
+        self.maxAge = maxAge
+
+        self.reader = PacketReader(ACK_PACKET, ACK_SYNC)
+        self.seq = 0
+
+        # Newest target not acknowledged yet: (pan, tilt, time it was given, deadline).
+        self.cond = threading.Condition()
+        self.pending = None
+        self.pendingSent = False
+        self.running = True
+
+        # Statistics
+        self.commands = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.acked = 0
+        self.clamped = 0
+        self.timeouts = 0
+        self.lateAcks = 0
+        self.expired = 0
+        self.errors = 0
+        self.bytesSent = 0
+        # Time from a target being given to its ack, and from the command's write to its ack.
+        self.latency = Histogram()
+        self.roundTrip = Histogram()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def Command(self, pan, tilt, deadline=None):
+        """
+        Hands a new target to the scheduler without blocking, replacing any target not sent yet.
+        :param pan, tilt: Absolute target angles (degrees).
+        :param deadline: Time (time.monotonic) after which the target is dropped if it hasn't been sent,
+                         maxAge from now by default.
+        """
+        now = time.monotonic()
+        deadline = now + self.maxAge if deadline is None else deadline
+
+        with self.cond:
+            if self.pending is not None and not self.pendingSent:
+                self.coalesced += 1
+            self.pending = (pan, tilt, now, deadline)
+            self.pendingSent = False
+            self.commands += 1
+            self.cond.notify()
+
+
+    def Stop(self):
+        """
+        Signals the scheduler thread to terminate, waits for it to finish and closes the link.
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+        self.thread.join()
+        self.link.Close()
+
+
+    def Stats(self):
+        """
+        :return: Dictionary with command counts (given, coalesced, sent, acknowledged, timed out, dropped...),
+                 bytes sent and command to ack latency (ms).
+        """
+        with self.cond:
+            return {
+                "ratePerSecond": round(1.0 / self.period, 2),
+                "commands": self.commands,
+                "coalesced": self.coalesced,
+                "sent": self.sent,
+                "acked": self.acked,
+                "clamped": self.clamped,
+                "timeouts": self.timeouts,
+                "lateAcks": self.lateAcks,
+                "expired": self.expired,
+                "errors": self.errors,
+                "bytesSent": self.bytesSent,
+                "skippedBytes": self.reader.skippedBytes,
+                "latency": self.latency.Snapshot(),
+                "roundTrip": self.roundTrip.Snapshot(),
+            }
+
+
+    def run(self):
+        nextTick = time.monotonic()
+
+        while True:
+            with self.cond:
+                # Idle until there is a target, then wait for the next control period.
+                while self.running and (self.pending is None or time.monotonic() < nextTick):
+                    self.cond.wait(None if self.pending is None else nextTick - time.monotonic())
+
+                if not self.running:
+                    return
+
+                command = self.pending
+                now = time.monotonic()
+                if now > command[3]:
+                    self.expired += 1
+                    self.pending = None
+                    continue
+                self.pendingSent = True
+
+            # Periods are kept on a fixed grid, starting over after idling rather than catching up.
+            nextTick = max(nextTick + self.period, now)
+
+            pan, tilt, givenTime, _ = command
+            self.seq = (self.seq + 1) & 0xFF
+            packet = EncodeCommand(self.seq, pan, tilt)
+
+            try:
+                self.link.Write(packet)
+                sentTime = time.monotonic()
+                status = self.waitForAck(self.seq, sentTime + self.ackTimeout)
+            except OSError as e:
+                print("ServoSched   : Serial link error: %s" % e)
+                with self.cond:
+                    self.errors += 1
+                continue
+
+            ackTime = time.monotonic()
+            with self.cond:
+                self.sent += 1
+                self.bytesSent += len(packet)
+
+                if status is None:
+                    # Sent again on the next period, unless a newer target replaced it.
+                    self.timeouts += 1
+                    if self.pending is command:
+                        self.pendingSent = False
+                    continue
+
+                self.acked += 1
+                self.clamped += status == ACK_CLAMPED
+                self.latency.Record(ackTime - givenTime)
+                self.roundTrip.Record(ackTime - sentTime)
+                if self.pending is command:
+                    self.pending = None
+
+
+    def waitForAck(self, seq, deadline):
+        """
+        Internal function reading from the link until the ack of a command comes in.
+        :return: Status of the ack, None if it didn't come before the deadline.
+        """
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            for ackSeq, status in self.reader.Feed(self.link.Read(remaining)):
+                if ackSeq == seq:
+                    return status
+
+                # The ack of a command that already timed out (counted under the lock Stats reads it with).
+                with self.cond:
+                    self.lateAcks += 1
@@ -0,0 +1,325 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from utils.Exceptions import ProtocolError
+from utils.PerceptionUtils import Detections
+from utils.WireProtocol import EncodeMessage, DecodeMessages, Status
+
+# Session file layout, for replaying exactly what the system saw (see SessionRecorder and ReplaySource).
+#
+#   header  (64 bytes)  magic "IFSESS" | version (u32) | frame height, width, channels (u32) | index capacity (u32)
+#                       | record count (u32) | frame count (u32) | data start (u64) | data end (u64)
+#   index   (capacity * 32 bytes) one fixed-size entry per record, in recording order
+#   data    record payloads: raw frames (page aligned, so they can be mapped as arrays without copying)
+#           and messages encoded with WireProtocol.EncodeMessage
+#
+# The header's counts are only bumped once a record is fully written, so a session cut short
+# (power loss, crash) is still readable up to its last complete record.
+
+MAGIC = b"IFSESS\0\0"
+VERSION = 1
+
+HEADER = struct.Struct("<8sIIIIIIIQQ")
+HEADER_SIZE = 64
+INDEX_RECORD = np.dtype([("kind", "u1"), ("pad", "u1", (3,)), ("frame", "<u4"), ("time", "<f8"),
+                         ("offset", "<u8"), ("length", "<u8")])
+
+PAGE_SIZE = mmap.PAGESIZE
+
+# Record kinds
+FRAME = 1
+MESSAGE = 2      # Message received from the remote interface (through CommsMan)
+DETECTIONS = 3   # Object detection results
+TRACK = 4        # Tracking result of a frame (WireProtocol.Telemetry)
+
+
+def alignUp(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+class SessionRecorder:
+    """
+    Records a filming session (captured frames with their capture times, messages from the
+    remote interface, detections and tracker results) into an append-only memory-mapped
+    file. Recording a frame is a single copy into the mapping: the file is sized up front
+    (sparsely) and a background thread touches the pages ahead of the write position, so
+    neither growing the file nor page faults land on the tracking loop. The kernel writes
+    the pages back to disk on its own.
+    Records can be added from several threads (e.g. detections from the reset worker).
+    args:
+    - path: Session file to create.
+    - maxBytes: Size the file can grow to, recording stops once it is full.
+    - maxRecords: Capacity of the record index.
+    - prefaultBytes: How far ahead of the write position pages are touched.
+    """
+
+    def __init__(self, path, maxBytes=8 * 1024 ** 3, maxRecords=1 << 20, prefaultBytes=32 * 1024 ** 2):
+        self.path = path
+        self.maxRecords = maxRecords
+        self.prefaultBytes = prefaultBytes
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self.fd, maxBytes)
+        self.mm = mmap.mmap(self.fd, maxBytes)
+
+        self.index = np.ndarray((maxRecords,), dtype=INDEX_RECORD, buffer=self.mm, offset=HEADER_SIZE)
+        self.dataStart = alignUp(HEADER_SIZE + maxRecords * INDEX_RECORD.itemsize, PAGE_SIZE)
+        self.dataEnd = self.dataStart
+        self.size = maxBytes
+
+        self.frameShape = None
+        self.recordCount = 0
+        self.frameCount = 0
+        self.lock = threading.Lock()
+        self.writeHeader()
+
+        # Statistics
+        self.droppedRecords = 0
+        self.bytesRecorded = 0
+
+        # Page prefaulting thread.
+        self.prefaulted = self.dataStart
+        self.running = True
+        self.cond = threading.Condition()
+        self.prefaultThread = threading.Thread(target=self.prefault, daemon=True)
+        self.prefaultThread.start()
+
+
+    def RecordFrame(self, frame, captureTime):
+        """
+        Appends a frame. Every frame of a session must have the same shape (that of the first one).
+        :param frame: Frame (uint8 array), copied into the session.
+        :param captureTime: Time (time.monotonic) the frame was captured.
+        :return: Frame number in the session, -1 if the session is full.
+        """
+        shape = frame.shape if frame.ndim == 3 else frame.shape + (1,)
+
+        with self.lock:
+            if self.frameShape is None:
+                self.frameShape = shape
+                self.writeHeader()
+            elif shape != self.frameShape:
+                self.droppedRecords += 1
+                return -1
+
+            offset = alignUp(self.dataEnd, PAGE_SIZE)
+            if not self.reserve(offset, frame.nbytes):
+                return -1
+
+            np.copyto(np.ndarray(frame.shape, dtype=np.uint8, buffer=self.mm, offset=offset), frame)
+
+            self.frameCount += 1
+            self.commit(FRAME, captureTime, offset, frame.nbytes)
+            number = self.frameCount - 1
+
+        with self.cond:
+            self.cond.notify()
+
+        return number
+
+
+    def Record(self, kind, message, timestamp=None):
+        """
+        Appends a message, attached to the latest recorded frame.
+        :param kind: MESSAGE, DETECTIONS or TRACK.
+        :param message: String, detections (Detections or list of detection records) or any message WireProtocol can encode.
+        :param timestamp: Time (time.monotonic) of the message, now by default.
+        :return: True if the message was recorded, False if the session is full.
+        """
+        if isinstance(message, str):
+            message = Status(message)
+        elif kind == DETECTIONS:
+            message = Detections.FromRecords(message)
+
+        try:
+            encoded = EncodeMessage(message)
+        except ProtocolError:
+            self.droppedRecords += 1
+            return False
+
+        timestamp = time.monotonic() if timestamp is None else timestamp
+
+        with self.lock:
+            offset = self.dataEnd
+            if not self.reserve(offset, len(encoded)):
+                return False
+
+            self.mm[offset:offset + len(encoded)] = encoded
+            self.commit(kind, timestamp, offset, len(encoded))
+
+        return True
+
+
+    def Close(self):
+        """
+        Finishes the session: stops recording and trims the file down to what was recorded.
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.prefaultThread.join()
+
+        with self.lock:
+            self.writeHeader()
+            self.index = None
+            self.mm.close()
+            os.ftruncate(self.fd, self.dataEnd)
+            os.close(self.fd)
+
+
+    def Stats(self):
+        return {
+            "records": self.recordCount,
+            "frames": self.frameCount,
+            "bytes": self.dataEnd,
+            "bytesRecorded": self.bytesRecorded,
+            "droppedRecords": self.droppedRecords,
+        }
+
+
+    def reserve(self, offset, length):
+        """
+        Internal function checking that a record fits in the session (called with the lock held).
+        """
+        if offset + length > self.size or self.recordCount >= self.maxRecords:
+            if self.droppedRecords == 0:
+                print("SessionRec   : Session %s is full, recording stopped." % self.path)
+            self.droppedRecords += 1
+            return False
+
+        return True
+
+
+    def commit(self, kind, timestamp, offset, length):
+        """
+        Internal function adding a written record to the index and publishing it in the header (called with the lock held).
+        """
+        entry = self.index[self.recordCount]
+        entry["kind"] = kind
+        entry["frame"] = max(self.frameCount - 1, 0)
+        entry["time"] = timestamp
+        entry["offset"] = offset
+        entry["length"] = length
+
+        self.recordCount += 1
+        self.dataEnd = offset + length
+        self.bytesRecorded += length
+        self.writeHeader()
+
+
+    def writeHeader(self):
+        height, width, channels = self.frameShape if self.frameShape is not None else (0, 0, 0)
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, height, width, channels, self.maxRecords,
+                         self.recordCount, self.frameCount, self.dataStart, self.dataEnd)
+
+
+    def prefault(self):
+        """
+        Internal function run in the prefaulting thread: writes to one byte per page ahead of the
+        write position, so the pages are already backed when frames are copied into them.
+        """
+        while True:
+            with self.cond:
+                while self.running and self.prefaulted >= min(self.dataEnd + self.prefaultBytes, self.size):
+                    self.cond.wait()
+                if not self.running:
+                    return
+                start = max(self.prefaulted, alignUp(self.dataEnd, PAGE_SIZE))
+                end = min(self.dataEnd + self.prefaultBytes, self.size)
+
+            # Pages are touched in chunks, so the loop doesn't hold the GIL for long.
+            chunk = 256 * PAGE_SIZE
+            for chunkStart in range(start, end, chunk):
+                chunkEnd = min(chunkStart + chunk, end)
+                pages = np.ndarray((chunkEnd - chunkStart,), dtype=np.uint8, buffer=self.mm, offset=chunkStart)
+                pages[::PAGE_SIZE] = 0
+                del pages
+
+            self.prefaulted = end
+
+
+class SessionReader:
+    """
+    Random access to a session recorded by SessionRecorder. Frames are returned as read-only
+    views of the memory-mapped file (no copy), valid until the reader is closed.
+    args:
+    - path: Session file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, height, width, channels, maxRecords,
+         recordCount, frameCount, self.dataStart, self.dataEnd) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ProtocolError("%s is not a session file" % path)
+        if version != VERSION:
+            raise ProtocolError("Unsupported session version %d" % version)
+
+        self.frameShape = (height, width, channels) if channels != 1 else (height, width)
+        self.index = np.ndarray((recordCount,), dtype=INDEX_RECORD, buffer=self.mm, offset=HEADER_SIZE)
+
+        # Record numbers of the frames, and where each frame's records start in the index.
+        self.frameRecords = np.flatnonzero(self.index["kind"] == FRAME)
+        self.numFrames = len(self.frameRecords)
+
+
+    def __len__(self):
+        return self.numFrames
+
+
+    def Frame(self, number):
+        """
+        :param number: Frame number (0 to len - 1).
+        :return: Read-only view of the frame.
+        """
+        entry = self.index[self.frameRecords[number]]
+        return np.ndarray(self.frameShape, dtype=np.uint8, buffer=self.mm, offset=int(entry["offset"]))
+
+
+    def CaptureTime(self, number):
+        """
+        :param number: Frame number.
+        :return: Time (time.monotonic on the recording system) the frame was captured.
+        """
+        return float(self.index[self.frameRecords[number]]["time"])
+
+
+    def Records(self, number, kind=None):
+        """
+        Messages recorded while a frame was the latest one (i.e. derived from it, or received while it was processed).
+        :param number: Frame number.
+        :param kind: Only return records of this kind (MESSAGE, DETECTIONS or TRACK).
+        :return: List of (kind, timestamp, decoded message).
+        """
+        start = self.frameRecords[number] + 1
+        end = self.frameRecords[number + 1] if number + 1 < self.numFrames else len(self.index)
+
+        records = []
+        for entry in self.index[start:end]:
+            if kind is not None and entry["kind"] != kind:
+                continue
+            offset, length = int(entry["offset"]), int(entry["length"])
+            with memoryview(self.mm)[offset:offset + length] as payload:
+                (message,) = DecodeMessages(payload, 1)
+            records.append((int(entry["kind"]), float(entry["time"]), message))
+
+        return records
+
+
+    def Close(self):
+        self.index = None
+        try:
+            self.mm.close()
+        except BufferError:
+            # Frames are still being used, the mapping goes away with the last of them.
+            pass
@@ -0,0 +1,134 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedFrameRing:
+    """
+    Ring of frame slots in shared memory, so frames can be passed between processes without
+    pickling or copying them through a pipe. Only the sequence number of a frame has to be sent
+    to the other processes (see PipelineMan), which then read the frame straight out of its slot.
+    Each slot is guarded by its sequence number in a header (a seqlock): the writer marks the
+    slot as being written, fills it in, then stamps it with the frame's sequence number. Readers
+    check the stamp before and after reading, so a frame that was overwritten by a newer one in
+    the meantime is detected rather than returned torn.
+    There can be a single writer, any number of readers.
+    args:
+    - shape, dtype: Shape and type of the frames.
+    - numSlots: Number of frames the ring holds; readers must keep up to within this many frames.
+    - name: Name of an existing ring to attach to (see Name); a new one is created if not given.
+    """
+
+    # Sequence number stamped on a slot while it's being written.
+    WRITING = -1
+
+    def __init__(self, shape, dtype=np.uint8, numSlots=8, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.numSlots = numSlots
+        self.owner = name is None
+
+        frameBytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        # Header is padded to a cache line so the first slot stays aligned.
+        headerBytes = max(64, numSlots * 8)
+
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=headerBytes + numSlots * frameBytes)
+        else:
+            # Meant to be attached from processes started with multiprocessing, which share the owner's
+            # resource tracker, so the memory is still only freed once (by the owner, see Close).
+            self.memory = shared_memory.SharedMemory(name=name)
+
+        self.seqs = np.ndarray((numSlots,), dtype=np.int64, buffer=self.memory.buf)
+        self.slots = np.ndarray((numSlots,) + self.shape, dtype=self.dtype, buffer=self.memory.buf, offset=headerBytes)
+
+        if self.owner:
+            self.seqs[:] = 0
+
+
+    @property
+    def Name(self):
+        """
+        Name other processes attach to the ring with.
+        """
+        return self.memory.name
+
+
+    def Attach(self):
+        """
+        :return: Arguments to rebuild this ring in another process: SharedFrameRing(**ring.Attach()).
+        """
+        return {"shape": self.shape, "dtype": self.dtype.str, "numSlots": self.numSlots, "name": self.Name}
+
+
+    def BeginWrite(self, seq):
+        """
+        Claims the slot of a new frame so it can be written to in place (e.g. by ImageSource.ReadInto).
+        :param seq: Sequence number of the frame (starting at 1, increasing by 1 per frame).
+        :return: Array view of the slot.
+        """
+        slot = seq % self.numSlots
+        self.seqs[slot] = self.WRITING
+
+        return self.slots[slot]
+
+
+    def EndWrite(self, seq):
+        """
+        Publishes a frame written into the slot returned by BeginWrite.
+        """
+        self.seqs[seq % self.numSlots] = seq
+
+
+    def Write(self, seq, frame):
+        """
+        Copies a frame into the ring.
+        """
+        np.copyto(self.BeginWrite(seq), frame)
+        self.EndWrite(seq)
+
+
+    def Read(self, seq, out):
+        """
+        Copies a frame out of the ring.
+        :param seq: Sequence number of the frame.
+        :param out: Preallocated array with the ring's frame shape and dtype.
+        :return: True if out holds the frame, False if it was overwritten (the reader fell behind).
+        """
+        slot = seq % self.numSlots
+        if self.seqs[slot] != seq:
+            return False
+
+        np.copyto(out, self.slots[slot])
+
+        return self.seqs[slot] == seq
+
+
+    def View(self, seq):
+        """
+        Zero-copy access to a frame. The view can be overwritten by the writer at any time,
+        so check Valid afterwards before trusting anything derived from it.
+        :return: Array view of the frame, None if it was already overwritten.
+        """
+        slot = seq % self.numSlots
+
+        return self.slots[slot] if self.seqs[slot] == seq else None
+
+
+    def Valid(self, seq):
+        """
+        :return: Whether the frame with the given sequence number is still in the ring.
+        """
+        return self.seqs[seq % self.numSlots] == seq
+
+
+    def Close(self):
+        """
+        Detaches from the ring, freeing it if this process created it.
+        """
+        # Views into the buffer have to go before the memory can be closed.
+        del self.seqs, self.slots
+        self.memory.close()
+
+        if self.owner:
+            self.memory.unlink()
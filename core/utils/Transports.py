@@ -0,0 +1,144 @@
+import os
+import select
+import socket
+import threading
+import time
+import tty
+
+from utils.Profiler import Histogram
+from utils.WireProtocol import FrameReader
+
+class StreamTransport:
+    """
+    Byte stream link to the remote interface, standing in for Bluetooth (RFCOMM is a byte
+    stream too). Frames (see WireProtocol) are written whole and reassembled on the
+    receiving side, which also measures throughput and frame latency from the send time
+    stamped on each frame (valid since both ends share the host's monotonic clock).
+    Use SocketPair or Pty to create both ends of a local link.
+    args:
+    - readFd, writeFd: File descriptors the link reads from and writes to.
+    - closeFds: File descriptors to close along with the transport.
+    """
+
+    # Bytes read per system call.
+    READ_SIZE = 4096
+
+    def __init__(self, readFd, writeFd, closeFds=()):
+        self.readFd = readFd
+        self.writeFd = writeFd
+        self.closeFds = closeFds
+        self.reader = FrameReader()
+        self.writeLock = threading.Lock()
+        self.closed = False
+
+        # Statistics
+        self.start = time.monotonic()
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.framesSent = 0
+        self.framesReceived = 0
+        self.messagesReceived = 0
+        self.latency = Histogram()
+
+
+    @staticmethod
+    def SocketPair():
+        """
+        :return: Both ends (local, remote) of a link over a Unix socket pair.
+        """
+        local, remote = socket.socketpair()
+        return (StreamTransport(local.fileno(), local.fileno(), (local,)),
+                StreamTransport(remote.fileno(), remote.fileno(), (remote,)))
+
+
+    @staticmethod
+    def Pty():
+        """
+        :return: Both ends (local, remote) of a link over a pseudo-terminal, like a serial Bluetooth adapter.
+                 The local end is the master side, the remote end the slave side (in raw mode, so bytes go through untouched).
+        """
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        return (StreamTransport(master, master, (master,)),
+                StreamTransport(slave, slave, (slave,)))
+
+
+    def Send(self, frame):
+        """
+        Writes a whole frame to the link.
+        :param frame: bytes (see WireProtocol.EncodeFrame).
+        """
+        with self.writeLock:
+            view = memoryview(frame)
+            while view:
+                written = os.write(self.writeFd, view)
+                view = view[written:]
+
+            self.bytesSent += len(frame)
+            self.framesSent += 1
+
+
+    def Receive(self, timeout=None):
+        """
+        Waits for data and decodes the frames it completes.
+        :param timeout: Max seconds to wait (None waits forever).
+        :return: List of decoded messages (possibly empty), None once the link is closed.
+        """
+        if self.closed:
+            return None
+
+        try:
+            ready, _, _ = select.select([self.readFd], [], [], timeout)
+            if not ready:
+                return []
+
+            data = os.read(self.readFd, self.READ_SIZE)
+        except (OSError, ValueError):
+            # Closed from another thread, or a pty's master side once the slave side is closed (EIO).
+            data = b""
+
+        if not data:
+            self.closed = True
+            return None
+
+        now = time.monotonic()
+        self.bytesReceived += len(data)
+
+        messages = []
+        for sendTime, frameMessages in self.reader.Feed(data):
+            self.latency.Record(max(now - sendTime, 0.0))
+            self.framesReceived += 1
+            messages.extend(frameMessages)
+
+        self.messagesReceived += len(messages)
+
+        return messages
+
+
+    def Close(self):
+        """
+        Closes this end of the link (the other end's Receive then returns None).
+        """
+        self.closed = True
+        for fd in self.closeFds:
+            if isinstance(fd, socket.socket):
+                fd.close()
+            else:
+                os.close(fd)
+
+
+    def Stats(self):
+        """
+        :return: Dictionary with bytes/frames sent and received, throughput and received frame latency (ms).
+        """
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return {
+            "bytesSent": self.bytesSent,
+            "bytesReceived": self.bytesReceived,
+            "framesSent": self.framesSent,
+            "framesReceived": self.framesReceived,
+            "messagesReceived": self.messagesReceived,
+            "sentBytesPerSecond": round(self.bytesSent / elapsed, 1),
+            "receivedBytesPerSecond": round(self.bytesReceived / elapsed, 1),
+            "latency": self.latency.Snapshot(),
+        }
@@ -0,0 +1,299 @@
+import collections
+import struct
+import time
+
+import numpy as np
+
+from utils.Exceptions import ProtocolError
+from utils.PerceptionUtils import BoundingBox, Detections
+
+# Binary message format between CommsMan and the remote interface.
+#
+# Messages are sent in length-prefixed frames, each holding one or more messages:
+#   frame   = header (16 bytes) + messages
+#   header  = magic "IF" | version (u8) | message count (u8) | payload length (u32) | send time (f64)
+#   message = type (u8) | body length (u16) | body
+# All integers are little endian. The send time is the sender's time.monotonic(), only
+# meaningful to a receiver on the same host (see Transports), where it gives message latency.
+
+MAGIC = b"IF"
+VERSION = 1
+
+FRAME_HEADER = struct.Struct("<2sBBId")
+MESSAGE_HEADER = struct.Struct("<BH")
+
+# Largest message body (its length is a u16), and largest frame payload a receiver accepts (room for at least
+# one full message), anything bigger means the stream is corrupt.
+MAX_BODY = 0xFFFF
+MAX_PAYLOAD = MESSAGE_HEADER.size + MAX_BODY
+
+# Message types
+COMMAND = 1
+BBOX = 2
+DETECTIONS = 3
+TELEMETRY = 4
+STATUS = 5
+PREVIEW = 6
+
+# Commands are sent as a code rather than a string (see Command).
+COMMAND_CODES = {"Start": 1, "Finish": 2, "Terminate": 3, "Status": 4}
+COMMAND_NAMES = {code: name for name, code in COMMAND_CODES.items()}
+
+BBOX_BODY = struct.Struct("<4h")
+# seq (u32) | left, top, right, bottom (i16) | deltaTilt, deltaTurn (f16 degrees) | quality (u8, 0-255) | success (u8)
+TELEMETRY_BODY = struct.Struct("<I4h2eBB")
+# keyframe (u8) | seq (u32) | source width, height (u16) | width, height (u16) | tile size (u8) | tile count (u16),
+# followed by the tile indices (u16) and the image (see PreviewEncoder).
+PREVIEW_HEADER = struct.Struct("<BIHHHHBH")
+# Detections are a count (u16) followed by packed records, decoded as a NumPy view of the frame.
+DETECTION_COUNT = struct.Struct("<H")
+DETECTION_RECORD = np.dtype([("classID", "u1"), ("confidence", "u1"), ("box", "<i2", (4,))])
+
+# Decoded message types (bboxes decode to BoundingBox and detection lists to Detections).
+Command = collections.namedtuple("Command", ["name"])
+Telemetry = collections.namedtuple("Telemetry", ["seq", "bbox", "deltaTilt", "deltaTurn", "quality", "success"])
+Status = collections.namedtuple("Status", ["text"])
+Preview = collections.namedtuple("Preview", ["keyframe", "seq", "sourceSize", "size", "tileSize", "tiles", "data"])
+# Stands in for a message that was framed properly but couldn't be decoded (unknown type or command, malformed body),
+# so the receiver can skip it and keep the link and the rest of the frame.
+Invalid = collections.namedtuple("Invalid", ["msgType", "reason"])
+
+
+def EncodeMessage(message):
+    """
+    Encodes a single message (without frame).
+    :param message: Command, BoundingBox, Detections, Telemetry, Status or Preview.
+    :return: bytes
+    """
+    if isinstance(message, Command):
+        msgType, body = COMMAND, bytes([COMMAND_CODES[message.name]])
+    elif isinstance(message, BoundingBox):
+        msgType, body = BBOX, BBOX_BODY.pack(*message.topLeft, *message.bottomRight)
+    elif isinstance(message, Detections):
+        records = np.empty(len(message), dtype=DETECTION_RECORD)
+        records["classID"] = message.classes
+        records["confidence"] = np.clip(np.round(message.scores * 255), 0, 255)
+        records["box"] = np.clip(np.round(message.boxes), -32768, 32767)
+        msgType, body = DETECTIONS, DETECTION_COUNT.pack(len(records)) + records.tobytes()
+    elif isinstance(message, Telemetry):
+        (x1, y1), (x2, y2) = message.bbox.topLeft, message.bbox.bottomRight
+        quality = int(min(max(message.quality, 0.0), 1.0) * 255)
+        msgType, body = TELEMETRY, TELEMETRY_BODY.pack(message.seq & 0xFFFFFFFF, x1, y1, x2, y2,
+                                                       message.deltaTilt, message.deltaTurn, quality, bool(message.success))
+    elif isinstance(message, Status):
+        msgType, body = STATUS, message.text.encode("utf-8")
+    elif isinstance(message, Preview):
+        tiles = np.asarray(message.tiles, dtype="<u2")
+        header = PREVIEW_HEADER.pack(message.keyframe, message.seq & 0xFFFFFFFF, *message.sourceSize, *message.size,
+                                     message.tileSize, len(tiles))
+        msgType, body = PREVIEW, header + tiles.tobytes() + bytes(message.data)
+    else:
+        raise ProtocolError("Cannot encode %r" % (message,))
+
+    if len(body) > MAX_BODY:
+        raise ProtocolError("Message body too long (%d bytes)" % len(body))
+
+    return MESSAGE_HEADER.pack(msgType, len(body)) + body
+
+
+def EncodeFrame(encodedMessages, sendTime=None):
+    """
+    Packs encoded messages (see EncodeMessage) into a frame.
+    :param sendTime: Time (time.monotonic) stamped on the frame, now by default.
+    :return: bytes
+    """
+    payload = b"".join(encodedMessages)
+    sendTime = time.monotonic() if sendTime is None else sendTime
+
+    return FRAME_HEADER.pack(MAGIC, VERSION, len(encodedMessages), len(payload), sendTime) + payload
+
+
+def DecodeMessages(payload, count):
+    """
+    Decodes the messages of a frame's payload, without copying it (fields are unpacked in place).
+    :param payload: memoryview of the payload.
+    :param count: Number of messages in the payload.
+    :return: List of decoded messages (Invalid for the ones that couldn't be decoded).
+    """
+    messages = []
+    offset = 0
+
+    for _ in range(count):
+        if offset + MESSAGE_HEADER.size > len(payload):
+            raise ProtocolError("Truncated message header")
+        msgType, length = MESSAGE_HEADER.unpack_from(payload, offset)
+        offset += MESSAGE_HEADER.size
+
+        body = payload[offset:offset + length]
+        if len(body) != length:
+            raise ProtocolError("Truncated message body")
+        offset += length
+
+        # The message's length is known, so one that can't be decoded (a body too short for its type, bad text, a type
+        # or command from a newer remote) doesn't break the stream: it's handed on as Invalid for the receiver to skip.
+        try:
+            messages.append(decodeBody(msgType, body))
+        except (struct.error, IndexError, ValueError) as e:
+            messages.append(Invalid(msgType, "Malformed message of type %d: %s" % (msgType, e)))
+        except ProtocolError as e:
+            messages.append(Invalid(msgType, str(e)))
+
+    return messages
+
+
+def decodeBody(msgType, body):
+    if msgType == COMMAND:
+        if body[0] not in COMMAND_NAMES:
+            raise ProtocolError("Unknown command code %d" % body[0])
+        return Command(COMMAND_NAMES[body[0]])
+
+    if msgType == BBOX:
+        return BoundingBox(*BBOX_BODY.unpack_from(body))
+
+    if msgType == DETECTIONS:
+        (count,) = DETECTION_COUNT.unpack_from(body)
+        records = np.frombuffer(body, dtype=DETECTION_RECORD, count=count, offset=DETECTION_COUNT.size)
+        return Detections(records["box"], records["confidence"] / 255.0, records["classID"])
+
+    if msgType == TELEMETRY:
+        seq, x1, y1, x2, y2, deltaTilt, deltaTurn, quality, success = TELEMETRY_BODY.unpack_from(body)
+        return Telemetry(seq, BoundingBox(x1, y1, x2, y2), deltaTilt, deltaTurn, quality / 255.0, bool(success))
+
+    if msgType == STATUS:
+        return Status(str(body, "utf-8"))
+
+    if msgType == PREVIEW:
+        keyframe, seq, sourceW, sourceH, width, height, tileSize, count = PREVIEW_HEADER.unpack_from(body)
+        tilesEnd = PREVIEW_HEADER.size + 2 * count
+        tiles = np.frombuffer(body, dtype="<u2", count=count, offset=PREVIEW_HEADER.size).copy()
+        return Preview(bool(keyframe), seq, (sourceW, sourceH), (width, height), tileSize, tiles, bytes(body[tilesEnd:]))
+
+    raise ProtocolError("Unknown message type %d" % msgType)
+
+
+class FrameReader:
+    """
+    Reassembles frames from a byte stream that may split or merge them arbitrarily.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+
+    def Feed(self, data):
+        """
+        Adds received bytes and decodes every frame completed by them.
+        :return: List of (send time, [messages]) per complete frame.
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+
+        with memoryview(self.buffer) as view:
+            while len(view) - offset >= FRAME_HEADER.size:
+                magic, version, count, length, sendTime = FRAME_HEADER.unpack_from(view, offset)
+                if magic != MAGIC:
+                    raise ProtocolError("Bad frame magic %r" % bytes(magic))
+                if version != VERSION:
+                    raise ProtocolError("Unsupported protocol version %d" % version)
+                if length > MAX_PAYLOAD:
+                    raise ProtocolError("Frame too long (%d bytes)" % length)
+
+                end = offset + FRAME_HEADER.size + length
+                if end > len(view):
+                    break
+
+                # Decoded messages don't keep references to the buffer, so it can be compacted below.
+                with view[offset + FRAME_HEADER.size:end] as payload:
+                    frames.append((sendTime, DecodeMessages(payload, count)))
+                offset = end
+
+        del self.buffer[:offset]
+
+        return frames
+
+
+class Batcher:
+    """
+    Collects outbound messages into frames. Telemetry is coalesced: only the newest
+    telemetry message queued since the last flush is sent, since older ones are stale
+    by the time the frame goes out. Every other message is sent in order.
+    args:
+    - interval: Seconds between flushes.
+    - maxPayload: Frames are flushed early once their payload reaches this size.
+    """
+
+    def __init__(self, interval=0.05, maxPayload=512):
+        self.interval = interval
+        self.maxPayload = maxPayload
+
+        self.pending = []
+        self.pendingBytes = 0
+        self.telemetry = None
+        self.coalesced = 0
+        self.nextFlush = time.monotonic() + interval
+
+
+    def Add(self, message):
+        """
+        Queues a message for the next frame.
+        """
+        if isinstance(message, Telemetry):
+            if self.telemetry is not None:
+                self.coalesced += 1
+            self.telemetry = message
+            return
+
+        encoded = EncodeMessage(message)
+        self.pending.append(encoded)
+        self.pendingBytes += len(encoded)
+
+
+    def Due(self, now=None):
+        """
+        :return: Whether the queued messages should be flushed.
+        """
+        if not self.pending and self.telemetry is None:
+            return False
+
+        now = time.monotonic() if now is None else now
+        return now >= self.nextFlush or self.pendingBytes >= self.maxPayload
+
+
+    def TimeToFlush(self, now=None):
+        """
+        :return: Seconds until the next flush is due (None if nothing is queued).
+        """
+        if not self.pending and self.telemetry is None:
+            return None
+
+        now = time.monotonic() if now is None else now
+        return max(self.nextFlush - now, 0.0)
+
+
+    def Flush(self):
+        """
+        :return: List of frames (bytes) holding every queued message, in order. Messages are
+                 split over several frames if they don't fit into one.
+        """
+        if self.telemetry is not None:
+            self.pending.append(EncodeMessage(self.telemetry))
+            self.telemetry = None
+
+        frames = []
+        batch, batchBytes = [], 0
+        for encoded in self.pending:
+            if batch and (batchBytes + len(encoded) > MAX_PAYLOAD or len(batch) == 255):
+                frames.append(EncodeFrame(batch))
+                batch, batchBytes = [], 0
+            batch.append(encoded)
+            batchBytes += len(encoded)
+
+        if batch:
+            frames.append(EncodeFrame(batch))
+
+        self.pending = []
+        self.pendingBytes = 0
+        self.nextFlush = time.monotonic() + self.interval
+
+        return frames